@@ -2,15 +2,18 @@ import logging
 import asyncio
 from pympler import asizeof
 from random import seed
-import pickle
+import os
+from hashlib import sha256
 
 from ndn.encoding import Name, Component
 
 import Config
-from Interests import send_init_interests, send_sync_request, fetch_segments, fetch_segments_batch
-from Util import pack_data
+from Interests import send_init_interests, send_sync_request, stream_segments
+from Util import pack_data, pack_updates, compress_data, UPDATES_FULL, COMPRESSION_NONE
 from Spasy import Spasy
-from Callbacks import on_direct_root_hash_interest, on_direct_geocode_interest, on_direct_asset_interest
+from TreeCodec import encode_tree, TreeDecoder
+from Clock import node_id_for
+from Callbacks import on_direct_root_hash_interest, on_direct_geocode_interest, on_direct_asset_interest, on_direct_node_interest
 
 type Options = list[str]
 
@@ -48,16 +51,45 @@ async def init(opts: Options) -> None:
 
     logging.info(f'Action: Init with geocode {opts[0]}')
 
-    Config.spasy = Spasy(opts[0], int(opts[2]))
-    if Config.config["build_tree_method"] == "file":
-        Config.spasy.build_tree_from_file(opts[0], Config.config["word_list_path"], int(opts[1]), Config.config["use_timestamp"])
-    elif Config.config["build_tree_method"] == "random":
-        Config.spasy.build_tree(opts[0], int(opts[1]), Config.config["use_timestamp"])
-        # Reset seeding for nonce generation
-        seed()
+    Config.spasy = Spasy(opts[0], int(opts[2]), Config.config["lazy_merkle"], Config.config["leaf_hash"],
+                         Config.config["branching"], Config.config["change_log_size"], node_id_for(Config.config["node_name"]),
+                         int(Config.config["max_clock_offset"] * 10**9))
+    snapshot_path = Config.config["snapshot_path"]
+    loaded = False
+    if snapshot_path:
+        # Describe how the tree is built, so a snapshot of a tree built from other names is not loaded
+        build = f"{Config.config['build_tree_method']} {opts[1]}"
+        if Config.config["build_tree_method"] == "file":
+            with open(Config.config["word_list_path"], 'rb') as file:
+                build += f" {sha256(file.read()).hexdigest()}"
+    if snapshot_path and os.path.exists(snapshot_path):
+        # Map the tree saved by an earlier run instead of rebuilding it, unless it was built another way or with another layout
+        try:
+            Config.spasy.load_snapshot(opts[0], snapshot_path, Config.config["lazy_merkle"], build)
+            loaded = True
+            logging.info(f"Loaded tree snapshot from {snapshot_path}")
+        except ValueError as e:
+            logging.info(f"Rebuilding the tree instead of loading the snapshot: {e}")
+    if not loaded:
+        if Config.config["build_tree_method"] == "file":
+            Config.spasy.build_tree_from_file(opts[0], Config.config["word_list_path"], int(opts[1]), Config.config["use_timestamp"])
+        elif Config.config["build_tree_method"] == "random":
+            Config.spasy.build_tree(opts[0], int(opts[1]), Config.config["use_timestamp"])
+            # Reset seeding for nonce generation
+            seed()
+        if snapshot_path:
+            Config.spasy.save_snapshot(opts[0], snapshot_path, build)
+            logging.info(f"Saved tree snapshot to {snapshot_path}")
 
     Config.geocode = opts[0]
-    logging.info(f"Tree created for geocode {opts[0]} with root hashcode {Config.spasy.trees[opts[0]].root.hashcode} with update queue of size {Config.spasy.trees[opts[0]].max_number_recent_updates}")
+    Config.spasy.trees[Config.geocode].checkpoint()
+
+    # Serve the tree's nodes so that peers without overlapping recent updates can reconcile with it
+    node_route = Config.config["direct_node_prefix"] + f"/{Config.geocode}"
+    await Config.app.register(node_route, on_direct_node_interest)
+    logging.info(f"Registered route for {node_route}")
+
+    logging.info(f"Tree created for geocode {opts[0]} with root hashcode {Config.spasy.trees[opts[0]].root.hashcode.hex()} with update queue of size {Config.spasy.trees[opts[0]].max_number_recent_updates}")
     logging.info(f"Number of assets: {opts[1]}\n Size: {asizeof.asizeof(Config.spasy.trees[opts[0]])} bytes")
 
     # Size of full initialized tree uncompressed
@@ -100,38 +132,77 @@ async def add(opts: Options) -> None:
     return
 
 
+async def clear(opts: Options) -> None:
+    """
+    Delete all assets in a region of the tree in one step and start sync process to update other nodes
+
+    Args:
+        opts: Action options:
+                opts[0] = Geohash prefix of the region to clear,
+                opts[-1] = wait time after action
+    """
+
+    logging.info(f"Action: Clear region {opts[0]}")
+
+    logging.info("Starting sync_update timer")
+    Config.timer.start_global_timer("sync_update")
+
+    Config.timer.start_timer("clear_region")
+    removed = Config.spasy.remove_region_from_tree(Config.geocode, opts[0])
+    Config.timer.stop_timer("clear_region")
+    logging.info(f"Removed {len(removed)} assets in region {opts[0]}")
+
+    # Peers are notified with a single range tombstone for the region, so the region is the notified asset
+    task = asyncio.create_task(prep_queue(f"/{opts[0]}", 'r'))
+    task = asyncio.create_task(update())
+
+    await asyncio.sleep(int(opts[-1]))
+    return
+
+
 async def join(opts: Options) -> None:
     """
-    Join a sync group using a geocode
+    Join a sync group using a geocode. A geocode longer than the geocode of the sync group's tree (a level 6 geohash) joins
+    only that region of the tree, receiving a partial tree that keeps the names in the region
 
     Args:
         opts: Action options:
-                opts[0] = Geocode of sync group to join,
+                opts[0] = Geocode of sync group (or region of sync group) to join,
                 opts[-1] = wait time after action
     """
 
     logging.info(f"Action: Join geocode {opts[0]}")
 
     Config.timer.start_timer(f"join_update")
-    name = Config.config["direct_geocode_prefix"] + f"/{opts[0]}"
-
-    batch_size = int(Config.config["batch_size"])
-    if batch_size > 0:
-        data, num_seg = await fetch_segments_batch(name, batch_size)
+    if len(opts[0]) > 6:
+        name = Config.config["direct_geocode_prefix"] + f"/{opts[0][:6]}/{opts[0]}"
     else:
-        data, num_seg = await fetch_segments(name)
+        name = Config.config["direct_geocode_prefix"] + f"/{opts[0]}"
 
-    received_tree = pickle.loads(data)
+    # The tree is decoded segment by segment as the segments arrive, so decoding overlaps the transfer
+    batch_size = int(Config.config["batch_size"])
+    window = batch_size if batch_size > 0 else Config.config["max_packets"]
+    decoder = TreeDecoder()
+    received_size = 0
+    try:
+        async for segment in stream_segments(name, window):
+            received_size += len(segment)
+            decoder.feed(segment)
+        received_tree = decoder.finish()
+    except ValueError as e:
+        Config.timer.stop_timer(f"join_update")
+        logging.error(f"Could not receive the tree for geocode {opts[0]}: {e}")
+        return
     Config.spasy.add_tree(received_tree)
     Config.timer.stop_timer(f"join_update")
 
     logging.info(f"Receieved tree for geocode {opts[0]} with size {asizeof.asizeof(Config.spasy)}")
-    logging.info(f"Root of tree is {Config.spasy.trees[Config.geocode].root.hashcode}")
+    logging.info(f"Root of tree is {Config.spasy.trees[Config.geocode].root.hashcode.hex()}")
 
     # Size of full tree uncompressed received through join request
     Config.stats.record_stat(f"{Config.config["node_name"]}_received_tree_size", f"{asizeof.asizeof(received_tree)}")
     # Size of full tree compressed received through join request
-    Config.stats.record_stat(f"{Config.config["node_name"]}_received_compressed_tree_size", f"{asizeof.asizeof(data)}")
+    Config.stats.record_stat(f"{Config.config["node_name"]}_received_compressed_tree_size", f"{received_size}")
 
     await asyncio.sleep(int(opts[-1]))
     return
@@ -143,12 +214,13 @@ async def update() -> None:
     """
 
     logging.info("Sending notification interests")
-    root_hash, seg_cnt, asset_name = Config.packed_updates_queue[-1]
+    root_hash, seg_cnt, asset_name, action = Config.packed_updates_queue[-1]
+    clock = Config.spasy.clock.now()
 
     sync_requests = []
     Config.timer.start_global_timer(f"notification_interest")
     for route in Config.config["multi_cast_routes"]:
-        sync_requests.append(send_sync_request(route, root_hash, asset_name, seg_cnt))
+        sync_requests.append(send_sync_request(route, root_hash, asset_name, action, seg_cnt, clock))
     await asyncio.gather(*sync_requests)
 
     return
@@ -182,8 +254,8 @@ async def serve_tree(opts: Options) -> None:
     Config.timer.start_timer(f"prep_tree")
     geocode_route = Config.config["direct_geocode_prefix"] + f"/{Config.geocode}"
     logging.info(f"Packing tree with geocode {Config.geocode}")
-    serialized_data = pickle.dumps(Config.spasy.trees[Config.geocode])
-    packets, seg_cnt = pack_data(serialized_data, geocode_route)
+    serialized_data = encode_tree(Config.spasy.materialize_tree(Config.geocode))
+    packets, seg_cnt = pack_data(serialized_data, geocode_route, Config.config["compression"])
     Config.packed_tree_geocode = (packets, seg_cnt)
 
     await Config.app.register(geocode_route, on_direct_geocode_interest)
@@ -197,25 +269,36 @@ async def serve_tree(opts: Options) -> None:
     return
 
 
-async def prep_queue(asset_name: str) -> None:
+async def prep_queue(asset_name: str, action: str = 'i') -> None:
     """
     Prepare signed packets for recent updates queue for tree and register route to enable receiving interests for queue. Used after making a change to the tree.
 
     Args:
         asset_name: Name of asset associated with change
+        action: Action of the change ('i' for an insertion, 'r' for the deletion of a region)
     """
 
-    logging.info(f"Packing queue with hashcode {Config.spasy.trees[Config.geocode].root.hashcode} with asset {asset_name}")
+    # The root hash is kept as a raw digest, it is only converted to hex to be used in names
+    # Checkpointing it lets requesters be sent just the changes made since their own root hash
+    root_hash = Config.spasy.trees[Config.geocode].checkpoint()
+    logging.info(f"Packing queue with hashcode {root_hash.hex()} with asset {asset_name}")
 
     Config.timer.start_timer(f"prep_queue")
 
-    # Pack recent updates
-    root_hash_route = Config.config["direct_root_hash_prefix"] + f"/{Config.spasy.trees[Config.geocode].root.hashcode}"
-    serialized_data = pickle.dumps(Config.spasy.trees[Config.geocode].recent_updates)
-    packets, seg_cnt = pack_data(serialized_data, root_hash_route)
-
-    Config.packed_updates_dict[Config.spasy.trees[Config.geocode].root.hashcode] = (packets, seg_cnt, asset_name)
-    Config.packed_updates_queue.append((Config.spasy.trees[Config.geocode].root.hashcode, seg_cnt, asset_name))
+    # Serialize and compress recent updates, which are served (and packed under the requester's name) when the requester's
+    # root hash is not in the change log and its IBLT cannot be decoded; the updates are kept to decode requesters' IBLTs
+    root_hash_route = Config.config["direct_root_hash_prefix"] + f"/{root_hash.hex()}"
+    updates = list(Config.spasy.trees[Config.geocode].recent_updates)
+    compressed_data = compress_data(pack_updates(UPDATES_FULL, updates), Config.config["compression"])
+    seg_cnt = (len(compressed_data) + Config.config["packet_segment_size"] - 1) // Config.config["packet_segment_size"]
+
+    Config.packed_updates_dict[root_hash.hex()] = (compressed_data, seg_cnt, asset_name, updates)
+    # Nodes packed for reconciliation and packed deltas are addressed by digest, so the ones packed for older trees are
+    # dropped (they are packed again if still requested), as are the partial trees packed for regions
+    Config.packed_nodes_dict.clear()
+    Config.packed_deltas_dict.clear()
+    Config.packed_regions_dict.clear()
+    Config.packed_updates_queue.append((root_hash, seg_cnt, asset_name, action))
 
     Config.timer.start_timer("register_root_hash_route")
     await Config.app.register(root_hash_route, on_direct_root_hash_interest)
@@ -245,7 +328,8 @@ async def prep_asset(asset_name: str, asset_path: str) -> None:
 
     with open(asset_path, 'rb') as asset_file:
         data = asset_file.read()
-    packets, seg_cnt = pack_data(data, asset_route)
+    compression = Config.config["compression"] if Config.config["compress_assets"] else COMPRESSION_NONE
+    packets, seg_cnt = pack_data(data, asset_route, compression)
     logging.info(f'Created {seg_cnt} chunks under name {Name.to_str(asset_route)}')
     Config.stats.record_stat(f"num_packets_asset", f"{seg_cnt}")
 
@@ -264,6 +348,7 @@ actions = {
     "SETUP": setup,
     "INIT": init,
     "ADD": add,
+    "CLEAR": clear,
     "JOIN": join,
     "WAIT": wait,
     "SERVE_TREE": serve_tree,
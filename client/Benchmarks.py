@@ -0,0 +1,363 @@
+import argparse
+import heapq
+import os
+import pickle
+import tempfile
+import time
+from os import path
+from random import randint, seed
+
+from pympler import asizeof
+
+from Geohash import bounding_box, decode, distance
+from Node import Node, GEOHASH_BASE32
+from SpasyTree import SpasyTree
+from CompactSpasyTree import CompactSpasyTree
+from Snapshot import MappedSpasyTree, write_snapshot
+from TreeCodec import encode_tree, decode_tree
+
+
+WORD_LIST_PATH = path.join(path.dirname(path.abspath(__file__)), '..', 'simulation', 'resources', 'words.txt')
+
+
+def generate_names(geocode: str, size: int, max_depth: int=9, max_length: int=10,
+                   word_list_path: str=WORD_LIST_PATH, seed_value: int=0) -> list[str]:
+    """
+    Generate a reproducible list of random named data in the same format as Spasy._generate_name.
+
+    Args:
+        geocode: Geocode of the tree's root
+        size: Number of names to generate
+        max_depth: Maximum depth of the tree (leaf geocodes have max_depth + 1 characters)
+        max_length: Maximum number of components in a name (excluding version and geocode)
+        word_list_path: File containing the words names are built from
+        seed_value: Random seed
+
+    Returns:
+        List of names with geocodes
+    """
+
+    with open(word_list_path) as file:
+        word_list = [word.strip() for word in file]
+
+    seed(seed_value)
+    names = []
+    for i in range(size):
+        number_elements = randint(2, max_length)
+        name = ''.join('/' + word_list[randint(0, len(word_list) - 1)] for j in range(number_elements))
+        if number_elements % 2 == 0:
+            name += '/_v' + str(randint(1, 10))
+
+        insert_geocode = geocode
+        while len(insert_geocode) <= max_depth:
+            insert_geocode += GEOHASH_BASE32[randint(0, len(GEOHASH_BASE32) - 1)]
+        names.append(name + '/' + insert_geocode)
+
+    return names
+
+
+def benchmark_memory(geocode: str, sizes: list[int]) -> None:
+    """
+    Compare the memory used by the Node-based SpasyTree and the array-backed CompactSpasyTree.
+
+    Args:
+        geocode: Geocode of the tree's root
+        sizes: Tree sizes (number of assets) to measure
+    """
+
+    print(f"{'assets':>10} {'engine':>8} {'bytes':>14} {'bytes/asset':>12} {'build (s)':>10}")
+    for size in sizes:
+        names = generate_names(geocode, size)
+        trees = {
+            "node": lambda: SpasyTree(9, 0, Node(geocode)),
+            "compact": lambda: CompactSpasyTree(9, geocode),
+        }
+        hashes = set()
+        for engine, make_tree in trees.items():
+            tree = make_tree()
+            start = time.perf_counter()
+            for name in names:
+                tree.insert(name)
+            elapsed = time.perf_counter() - start
+            hashes.add(tree.root.hashcode)
+
+            size_bytes = asizeof.asizeof(tree)
+            print(f"{size:>10} {engine:>8} {size_bytes:>14} {size_bytes / size:>12.1f} {elapsed:>10.3f}")
+
+        if len(hashes) != 1:
+            print(f"WARNING: engines disagree on the root hash for {size} assets")
+
+
+def benchmark_build(geocode: str, sizes: list[int]) -> None:
+    """
+    Compare building a tree by inserting names one at a time against SpasyTree.bulk_insert.
+
+    Args:
+        geocode: Geocode of the tree's root
+        sizes: Tree sizes (number of assets) to measure
+    """
+
+    print(f"{'assets':>10} {'method':>12} {'build (s)':>10}")
+    for size in sizes:
+        names = generate_names(geocode, size)
+
+        incremental_tree = SpasyTree(9, 0, Node(geocode))
+        start = time.perf_counter()
+        for name in names:
+            incremental_tree.insert(name)
+        print(f"{size:>10} {'incremental':>12} {time.perf_counter() - start:>10.3f}")
+
+        bulk_tree = SpasyTree(9, 0, Node(geocode))
+        start = time.perf_counter()
+        bulk_tree.bulk_insert(names)
+        print(f"{size:>10} {'bulk':>12} {time.perf_counter() - start:>10.3f}")
+
+        if incremental_tree.root.hashcode != bulk_tree.root.hashcode:
+            print(f"WARNING: bulk and incremental trees disagree on the root hash for {size} assets")
+
+
+def count_nodes(node: Node) -> int:
+    """Count the nodes in the subtree rooted at the given node."""
+    count = 0
+    stack = [node]
+    while stack:
+        current_node = stack.pop()
+        count += 1
+        stack.extend(child for child in current_node.children if child is not None)
+    return count
+
+
+def benchmark_layout(geocode: str, sizes: list[int]) -> None:
+    """
+    Compare the quaternary (bucketed) tree layout against the 32-ary layout, which gives
+    every geohash character its own child.
+
+    Args:
+        geocode: Geocode of the tree's root
+        sizes: Tree sizes (number of assets) to measure
+    """
+
+    print(f"{'assets':>10} {'branching':>9} {'nodes':>10} {'bulk (s)':>10} {'insert (s)':>10} {'find (s)':>10}")
+    for size in sizes:
+        names = generate_names(geocode, size)
+        for branching in (4, 32):
+            bulk_tree = SpasyTree(9, 0, Node(geocode, branching=branching), branching=branching)
+            start = time.perf_counter()
+            bulk_tree.bulk_insert(names)
+            bulk_time = time.perf_counter() - start
+
+            incremental_tree = SpasyTree(9, 0, Node(geocode, branching=branching), branching=branching)
+            start = time.perf_counter()
+            for name in names:
+                incremental_tree.insert(name)
+            insert_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for name in names:
+                incremental_tree.find_data(name)
+            find_time = time.perf_counter() - start
+
+            print(f"{size:>10} {branching:>9} {count_nodes(bulk_tree.root):>10} {bulk_time:>10.3f}"
+                  f" {insert_time:>10.3f} {find_time:>10.3f}")
+
+            if incremental_tree.root.hashcode != bulk_tree.root.hashcode:
+                print(f"WARNING: bulk and incremental {branching}-ary trees disagree on the root hash for {size} assets")
+
+
+def benchmark_snapshot(geocode: str, sizes: list[int]) -> None:
+    """
+    Compare building a tree at startup with memory-mapping a snapshot of it, both to
+    the first root hash and to a materialized, mutable tree.
+
+    Args:
+        geocode: Geocode of the tree's root
+        sizes: Tree sizes (number of assets) to measure
+    """
+
+    print(f"{'assets':>10} {'build (s)':>10} {'write (s)':>10} {'map (s)':>10} {'materialize (s)':>16} {'bytes':>12}")
+    for size in sizes:
+        names = generate_names(geocode, size)
+        start = time.perf_counter()
+        tree = SpasyTree(9, 0, Node(geocode))
+        tree.bulk_insert(names)
+        tree.root.hashcode
+        build_time = time.perf_counter() - start
+
+        with tempfile.TemporaryDirectory() as directory:
+            snapshot_path = path.join(directory, 'tree.snapshot')
+            start = time.perf_counter()
+            write_snapshot(tree, snapshot_path)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            mapped_tree = MappedSpasyTree(snapshot_path)
+            mapped_hash = mapped_tree.root.hashcode
+            map_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            materialized_tree = mapped_tree.materialize()
+            materialize_time = time.perf_counter() - start
+            mapped_tree.close()
+
+            print(f"{size:>10} {build_time:>10.3f} {write_time:>10.3f} {map_time:>10.5f} {materialize_time:>16.3f}"
+                  f" {os.path.getsize(snapshot_path):>12}")
+
+        if mapped_hash != tree.root.hashcode or materialized_tree.root.hashcode != tree.root.hashcode:
+            print(f"WARNING: the snapshot of the tree with {size} assets has a different root hash")
+
+
+def benchmark_serialize(geocode: str, sizes: list[int]) -> None:
+    """
+    Compare the binary tree encoding sent to joining peers against pickling the tree.
+
+    Args:
+        geocode: Geocode of the tree's root
+        sizes: Tree sizes (number of assets) to measure
+    """
+
+    print(f"{'assets':>10} {'branching':>9} {'format':>8} {'bytes':>12} {'encode (s)':>10} {'decode (s)':>10}")
+    for size in sizes:
+        names = generate_names(geocode, size)
+        for branching in (4, 32):
+            tree = SpasyTree(9, 0, Node(geocode, branching=branching), branching=branching)
+            tree.bulk_insert(names)
+            for method, dump, load in (('pickle', pickle.dumps, pickle.loads), ('binary', encode_tree, decode_tree)):
+                start = time.perf_counter()
+                encoded = dump(tree)
+                encode_time = time.perf_counter() - start
+
+                start = time.perf_counter()
+                decoded = load(encoded)
+                decode_time = time.perf_counter() - start
+
+                print(f"{size:>10} {branching:>9} {method:>8} {len(encoded):>12} {encode_time:>10.3f} {decode_time:>10.3f}")
+
+                if decoded.root.hashcode != tree.root.hashcode:
+                    print(f"WARNING: the {method} {branching}-ary tree with {size} assets decoded with a different root hash")
+
+
+def benchmark_clear(geocode: str, sizes: list[int]) -> None:
+    """
+    Compare clearing a region (a level 7 geohash) by deleting its names one at a time against SpasyTree.delete_prefix.
+
+    Args:
+        geocode: Geocode of the tree's root
+        sizes: Tree sizes (number of assets) to measure
+    """
+
+    region = geocode + GEOHASH_BASE32[0]
+    print(f"{'assets':>10} {'branching':>9} {'method':>12} {'removed':>8} {'clear (s)':>10}")
+    for size in sizes:
+        names = generate_names(geocode, size)
+        in_region = [name for name in names if name.split('/')[-1].startswith(region)]
+        for branching in (4, 32):
+            one_by_one_tree = SpasyTree(9, 0, Node(geocode, branching=branching), branching=branching)
+            one_by_one_tree.bulk_insert(names)
+            start = time.perf_counter()
+            for name in in_region:
+                one_by_one_tree.delete(one_by_one_tree.root, name, len(geocode))
+            print(f"{size:>10} {branching:>9} {'one by one':>12} {len(in_region):>8} {time.perf_counter() - start:>10.3f}")
+
+            prefix_tree = SpasyTree(9, 0, Node(geocode, branching=branching), branching=branching)
+            prefix_tree.bulk_insert(names)
+            start = time.perf_counter()
+            removed = prefix_tree.delete_prefix(region)
+            print(f"{size:>10} {branching:>9} {'prefix':>12} {len(removed):>8} {time.perf_counter() - start:>10.3f}")
+
+            if one_by_one_tree.root.hashcode != prefix_tree.root.hashcode:
+                print(f"WARNING: the {branching}-ary trees with {size} assets disagree on the root hash after clearing {region}")
+
+
+def benchmark_query(geocode: str, sizes: list[int]) -> None:
+    """
+    Compare a radius query around the center of the tree's region (a quarter of the region's height)
+    scanning every geocode of the tree against SpasyTree.query_radius.
+
+    Args:
+        geocode: Geocode of the tree's root
+        sizes: Tree sizes (number of assets) to measure
+    """
+
+    latitude, longitude = decode(geocode)
+    min_latitude, _, max_latitude, _ = bounding_box(geocode)
+    radius = distance(min_latitude, longitude, max_latitude, longitude) / 4
+    print(f"{'assets':>10} {'branching':>9} {'method':>8} {'found':>8} {'query (s)':>10}")
+    for size in sizes:
+        names = generate_names(geocode, size)
+        for branching in (4, 32):
+            tree = SpasyTree(9, 0, Node(geocode, branching=branching), branching=branching)
+            tree.bulk_insert(names)
+
+            start = time.perf_counter()
+            scanned = {name for leaf_geocode, leaf_names in tree.find_data_by_geocode(tree.root).items()
+                       if distance(latitude, longitude, *decode(leaf_geocode)) <= radius for name in leaf_names}
+            print(f"{size:>10} {branching:>9} {'scan':>8} {len(scanned):>8} {time.perf_counter() - start:>10.3f}")
+
+            start = time.perf_counter()
+            found = set(tree.query_radius(latitude, longitude, radius))
+            print(f"{size:>10} {branching:>9} {'tree':>8} {len(found):>8} {time.perf_counter() - start:>10.3f}")
+
+            if scanned != found:
+                print(f"WARNING: the {branching}-ary tree with {size} assets disagrees with the scan")
+
+
+def benchmark_nearest(geocode: str, sizes: list[int], k: int=20) -> None:
+    """
+    Compare finding the k nearest assets to the center of the tree's region by scanning every
+    geocode of the tree against SpasyTree.query_nearest.
+
+    Args:
+        geocode: Geocode of the tree's root
+        sizes: Tree sizes (number of assets) to measure
+        k: Number of nearest assets to find
+    """
+
+    latitude, longitude = decode(geocode)
+    print(f"{'assets':>10} {'branching':>9} {'method':>8} {'farthest (m)':>12} {'query (s)':>10}")
+    for size in sizes:
+        names = generate_names(geocode, size)
+        for branching in (4, 32):
+            tree = SpasyTree(9, 0, Node(geocode, branching=branching), branching=branching)
+            tree.bulk_insert(names)
+
+            def name_distance(name: str) -> float:
+                return distance(latitude, longitude, *decode(name.split('/')[-1]))
+
+            start = time.perf_counter()
+            scanned = heapq.nsmallest(k, (name for leaf_names in tree.find_data_by_geocode(tree.root).values()
+                                          for name in leaf_names), key=name_distance)
+            elapsed = time.perf_counter() - start
+            print(f"{size:>10} {branching:>9} {'scan':>8} {name_distance(scanned[-1]):>12.2f} {elapsed:>10.4f}")
+
+            start = time.perf_counter()
+            found = tree.query_nearest(latitude, longitude, k)
+            elapsed = time.perf_counter() - start
+            print(f"{size:>10} {branching:>9} {'tree':>8} {name_distance(found[-1]):>12.2f} {elapsed:>10.4f}")
+
+            if [name_distance(name) for name in scanned] != [name_distance(name) for name in found]:
+                print(f"WARNING: the {branching}-ary tree with {size} assets disagrees with the scan")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="SpasyTree micro-benchmarks")
+    parser.add_argument('benchmark', choices=['memory', 'build', 'layout', 'snapshot', 'serialize', 'clear', 'query', 'nearest'])
+    parser.add_argument('--geocode', default='dpwhwt')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    args = parser.parse_args()
+
+    if args.benchmark == 'memory':
+        benchmark_memory(args.geocode, args.sizes)
+    elif args.benchmark == 'build':
+        benchmark_build(args.geocode, args.sizes)
+    elif args.benchmark == 'layout':
+        benchmark_layout(args.geocode, args.sizes)
+    elif args.benchmark == 'snapshot':
+        benchmark_snapshot(args.geocode, args.sizes)
+    elif args.benchmark == 'serialize':
+        benchmark_serialize(args.geocode, args.sizes)
+    elif args.benchmark == 'clear':
+        benchmark_clear(args.geocode, args.sizes)
+    elif args.benchmark == 'query':
+        benchmark_query(args.geocode, args.sizes)
+    elif args.benchmark == 'nearest':
+        benchmark_nearest(args.geocode, args.sizes)
@@ -7,12 +7,20 @@ from ndn.encoding import Name, InterestParam, BinaryStr, FormalName, MetaInfo
 from ndn.encoding import Name, Component
 
 import Config
-from Interests import send_root_request, send_asset_request
+from Interests import send_root_request, send_asset_request, send_node_request
+from Reconcile import index_nodes, encode_node, reconcile
+from Util import pack_data, pack_updates, UPDATES_DELTA, UPDATES_MISSING
+from IBLT import IBLT, updates_iblt, find_missing_updates
+from TreeCodec import encode_tree
+from Node import Node
 
 
 def on_direct_root_hash_interest(name: FormalName, param: InterestParam, app_param: Optional[BinaryStr]) -> None:
     """
-    Callback function to handle an interest for a root hash, will respond with the signed packets with recent updates queue associated with the tree at the time of having the given root hash
+    Callback function to handle an interest for a root hash, will respond with the signed packets with the changes made between
+    the requester's root hash and the given root hash. If the change log does not reach back to the requester's root hash, the
+    requester's IBLT of its recent updates is subtracted from ours to find the updates it is missing, and if that fails the
+    response is the recent updates queue associated with the tree at the time of having the given root hash
 
     Args:
         name: Name requested
@@ -22,11 +30,44 @@ def on_direct_root_hash_interest(name: FormalName, param: InterestParam, app_par
 
     logging.info(f"Received direct root hash interest {Name.to_str(name)}")
 
-    packets, seg_cnt, asset_name = Config.packed_updates_dict[Name.to_str(name).split("/")[-2]]
+    partitions = Name.to_str(name).split("/")
+    update_name = "/".join(partitions[:-1])
+    root_hash, requester_hash, requester_iblt = partitions[-4], partitions[-3], partitions[-2]
+
+    if update_name not in Config.packed_deltas_dict:
+        # the recent updates queue was compressed when it was prepared, so it is only packed if no smaller response is found
+        compressed_data, _, asset_name, updates = Config.packed_updates_dict[root_hash]
+        serialized_data = None
+        try:
+            changes = Config.spasy.trees[Config.geocode].changes_since(bytes.fromhex(requester_hash), bytes.fromhex(root_hash))
+        except ValueError:
+            logging.info(f"Malformed root hash in {update_name}, serving the recent updates queue")
+        else:
+            if changes is not None:
+                serialized_data = pack_updates(UPDATES_DELTA, changes)
+                logging.info(f"Serving {len(changes)} changes since root hash {requester_hash}")
+            else:
+                try:
+                    missing = find_missing_updates(updates, IBLT.from_component(requester_iblt))
+                except ValueError:
+                    missing = None
+                if missing is not None:
+                    serialized_data = pack_updates(UPDATES_MISSING, missing)
+                    logging.info(f"Serving {len(missing)} updates missing from the IBLT of root hash {requester_hash}")
+                else:
+                    logging.info(f"Root hash {requester_hash} is not in the change log and its IBLT could not be decoded,"
+                                 f" serving the recent updates queue")
+        if serialized_data is None:
+            Config.packed_deltas_dict[update_name] = pack_data(compressed_data, update_name, Config.config["compression"],
+                                                               compressed=True)
+        else:
+            Config.packed_deltas_dict[update_name] = pack_data(serialized_data, update_name, Config.config["compression"])
+
+    packets, seg_cnt = Config.packed_deltas_dict[update_name]
     seg_no = Component.to_number(name[-1])
 
     if seg_no < seg_cnt:
-        Config.app.put_raw_packet(packets[Component.to_number(name[-1])])
+        Config.app.put_raw_packet(packets[seg_no])
 
     logging.info(f"Returned response for direct root hash interest {Name.to_str(name)}")
     return
@@ -34,7 +75,8 @@ def on_direct_root_hash_interest(name: FormalName, param: InterestParam, app_par
 
 def on_direct_geocode_interest(name: FormalName, param: InterestParam, app_param: Optional[BinaryStr]) -> None:
     """
-    Callback function to handle an interest for the tree associated with the given geocode, will respond with the signed packets with the tree associated with the given geocode
+    Callback function to handle an interest for the tree associated with the given geocode, will respond with the signed packets with the tree associated with the given geocode.
+    If the name also has a longer geocode (a region of the tree), the response is a partial tree holding only that region, which is packed when first requested
 
     Args:
         name: Name requested
@@ -44,16 +86,95 @@ def on_direct_geocode_interest(name: FormalName, param: InterestParam, app_param
 
     logging.info(f"Received direct geocode interest for {Name.to_str(name)}")
 
-    packets, seg_cnt = Config.packed_tree_geocode
+    partitions = Name.to_str(name).split("/")
+    region = partitions[-2]
+
+    if region == Config.geocode:
+        packets, seg_cnt = Config.packed_tree_geocode
+    else:
+        region_name = "/".join(partitions[:-1])
+        if region_name not in Config.packed_regions_dict:
+            try:
+                serialized_data = encode_tree(Config.spasy.materialize_tree(Config.geocode), region)
+            except ValueError as e:
+                logging.info(f"Cannot serve region {region} of tree {Config.geocode}: {e}")
+                return
+            Config.packed_regions_dict[region_name] = pack_data(serialized_data, region_name, Config.config["compression"])
+        packets, seg_cnt = Config.packed_regions_dict[region_name]
     seg_no = Component.to_number(name[-1])
 
     if seg_no < seg_cnt:
-        Config.app.put_raw_packet(packets[Component.to_number(name[-1])])
+        Config.app.put_raw_packet(packets[seg_no])
 
     logging.info(f"Returned response for direct geocode interest for {Name.to_str(name)}")
     return
 
 
+def on_direct_node_interest(name: FormalName, param: InterestParam, app_param: Optional[BinaryStr]) -> None:
+    """
+    Callback function to handle an interest for a node of a tree by its digest (e.g. during reconciliation), will respond with
+    the signed packets with the encoded node if the tree still has a node with the requested digest. Nodes are named by digest
+    alone, so their packets stay valid, can be cached by the network and are shared by every version of the tree that has the node
+
+    Args:
+        name: Name requested
+        param: Interest parameters
+        app_param: Optional interest parameters
+    """
+
+    logging.info(f"Received direct node interest for {Name.to_str(name)}")
+
+    partitions = Name.to_str(name).split("/")
+    node_name = "/".join(partitions[:-1])
+    geocode, digest = partitions[-3], partitions[-2]
+
+    if node_name not in Config.packed_nodes_dict:
+        node = find_node_by_digest(geocode, digest)
+        if node is None:
+            logging.info(f"No node with digest {digest} in tree {geocode}")
+            return
+        Config.packed_nodes_dict[node_name] = pack_data(encode_node(node), node_name)
+
+    packets, seg_cnt = Config.packed_nodes_dict[node_name]
+    seg_no = Component.to_number(name[-1])
+
+    if seg_no < seg_cnt:
+        Config.app.put_raw_packet(packets[seg_no])
+
+    logging.info(f"Returned response for direct node interest for {Name.to_str(name)}")
+    return
+
+
+def find_node_by_digest(geocode: str, digest: str) -> Optional[Node]:
+    """
+    Find a node of a tree by its digest. The tree's nodes are indexed by digest when first needed, and indexed again once the
+    tree has changed
+
+    Args:
+        geocode: Geocode of the tree
+        digest: Merkle hash of the node, hex encoded
+
+    Returns:
+        node: Node with the digest, None if the tree has no such node
+    """
+
+    if geocode not in Config.spasy.trees:
+        return None
+    tree = Config.spasy.trees[geocode]
+
+    root_hash, index = Config.node_indexes.get(geocode, (None, {}))
+    if root_hash != tree.root.hashcode:
+        Config.timer.start_timer("index_nodes")
+        root_hash, index = tree.root.hashcode, index_nodes(tree)
+        Config.node_indexes[geocode] = (root_hash, index)
+        Config.timer.stop_timer("index_nodes")
+
+    try:
+        return index.get(bytes.fromhex(digest))
+    except ValueError:
+        return None
+
+
 def on_direct_asset_interest(name: FormalName, param: InterestParam, app_param: Optional[BinaryStr]) -> None:
     """
     Callback function to handle interest for an asset, will respond with signed packets responding to the desired asset
@@ -108,20 +229,33 @@ def on_multi_interest(name: FormalName, param: InterestParam, app_param: Optiona
 
     name = Name.to_str(name)
     partitions = name.split("/")
-    asset_name = "/".join(partitions[4:-4])
-    action = partitions[-4]
-    root_hash = partitions[-3]
-    geocode = partitions[-2]
-    seg_cnt = partitions[-1]
+    asset_name = "/".join(partitions[4:-5])
+    action = partitions[-5]
+    root_hash = partitions[-4]
+    geocode = partitions[-3]
+    seg_cnt = partitions[-2]
+    clock = partitions[-1]
+
+    try:
+        root_digest = bytes.fromhex(root_hash)
+    except ValueError:
+        logging.info(f"Ignoring malformed notification with root hash {root_hash}")
+        return
+
+    # the sender's clock may be ahead of ours; ours is moved past it so our next changes are ordered after the notified ones
+    try:
+        Config.spasy.clock.update(int(clock))
+    except ValueError:
+        logging.info(f"Ignoring malformed or out of range clock {clock} in notification")
 
     logging.info(f"Checking asset name {asset_name}")
     if Config.spasy.is_subscribed(asset_name):
         logging.info(f"Checking hash {root_hash}")
-        if Config.spasy.is_newer_tree(geocode, root_hash):
+        if Config.spasy.is_newer_tree(geocode, root_digest):
+            logging.info('Requesting data')
+            asyncio.create_task(update_tree(root_hash, seg_cnt))
             logging.info(f"Checking action {action}")
             if Config.spasy.can_request_item(action):
-                logging.info('Requesting data')
-                asyncio.create_task(update_tree(root_hash, seg_cnt))
                 if Config.config["request_asset"]:
                     asyncio.create_task(request_asset(asset_name))
             else:
@@ -136,32 +270,84 @@ def on_multi_interest(name: FormalName, param: InterestParam, app_param: Optiona
 
 async def update_tree(root_hash: str, seg_cnt: int) -> None:
     """
-    Requests data to update tree, this includes recent update queue and/or asset if desired. The recent update queue will be applied to the tree.
+    Requests data to update tree, this includes the changes since our root hash (or the recent update queue) and/or asset if desired.
+    The changes will be applied to the tree.
 
     Args:
         root_hash: Root hash of tree at time of recent update queue state
-        seg_cnt: Number of packets received making up the recent update queue state
+        seg_cnt: Number of packets making up the recent update queue state
     """
 
-    name = Config.config["direct_root_hash_prefix"] + f"/{root_hash}"
+    # our current root hash (or, failing that, the IBLT of our recent updates) lets the producer send just the changes we are missing
+    current_hash = Config.spasy.trees[Config.geocode].root.hashcode.hex()
+    iblt = updates_iblt(Config.spasy.trees[Config.geocode].recent_updates, Config.config["iblt_cells"])
+    name = Config.config["direct_root_hash_prefix"] + f"/{root_hash}" + f"/{current_hash}" + f"/{iblt.to_component()}"
 
     Config.timer.start_timer(f"receive_updates")
-    received_update, num_seg, data = await send_root_request(name, seg_cnt)
+    response, num_seg, data = await send_root_request(name)
     Config.timer.stop_timer(f"receive_updates")
+    if response is None:
+        return
+    kind, received_update = response
 
     Config.timer.start_timer(f"update_tree")
-    Config.spasy.update_tree(Config.geocode, received_update)
+    if kind in (UPDATES_DELTA, UPDATES_MISSING):
+        Config.spasy.apply_changes(Config.geocode, received_update)
+        result = True
+    else:
+        result = Config.spasy.update_tree(Config.geocode, received_update)
+    # the recent updates can apply cleanly and still miss changes (e.g. to a stub of a partial tree), so the result is checked
+    if result != -1 and Config.spasy.is_newer_tree(Config.geocode, bytes.fromhex(root_hash)):
+        result = -1
     Config.timer.stop_timer(f"update_tree")
 
+    # the updates did not bring the tree up to date, so the trees are compared by their Merkle hashes instead
+    if result == -1:
+        await reconcile_tree(root_hash, received_update)
+
     Config.timer.stop_global_timer("sync_update")
     logging.info("Stopping sync_update timer")
 
-    logging.info(f"Received new tree updates with resulting hash {root_hash} of size {asizeof.asizeof(received_update)}")
+    logging.info(f"Received new tree updates ({kind}) with resulting hash {root_hash} of size {asizeof.asizeof(received_update)}")
+    Config.stats.record_stat(f"{Config.config["node_name"]}_received_tree_update_type", kind)
     Config.stats.record_stat(f"{Config.config["node_name"]}_received_tree_update_uncompressed", asizeof.asizeof(received_update))
     Config.stats.record_stat(f"{Config.config["node_name"]}_received_tree_update_compressed", asizeof.asizeof(data))
     return
 
 
+async def reconcile_tree(root_hash: str, received_update: list) -> None:
+    """
+    Bring the tree up to date with a tree whose recent update queue does not overlap with ours, by walking both trees
+    top-down and fetching only the nodes whose hashes differ
+
+    Args:
+        root_hash: Root hash of the other tree
+        received_update: Recent update queue received with the root hash
+    """
+
+    logging.info(f"No overlap with recent updates, reconciling with tree with root hash {root_hash}")
+
+    async def fetch(digest: bytes) -> Optional[BinaryStr]:
+        return await send_node_request(Config.geocode, digest)
+
+    Config.timer.start_timer(f"reconcile_tree")
+    # a tree loaded from a snapshot is materialized, since the reconciliation is applied to it anyway
+    result = await reconcile(Config.spasy.materialize_tree(Config.geocode), bytes.fromhex(root_hash), fetch)
+    if result is None:
+        Config.timer.stop_timer(f"reconcile_tree")
+        logging.info(f"Reconciliation with tree with root hash {root_hash} failed, a node could not be fetched")
+        return
+
+    additions, deletions, num_nodes = result
+    Config.spasy.apply_reconciliation(Config.geocode, additions, deletions, received_update)
+    Config.timer.stop_timer(f"reconcile_tree")
+
+    logging.info(f"Reconciled tree by fetching {num_nodes} nodes ({len(additions)} insertions, {len(deletions)} deletions),"
+                 f" root hash is now {Config.spasy.trees[Config.geocode].root.hashcode.hex()}")
+    Config.stats.record_stat(f"{Config.config["node_name"]}_reconciliation_nodes_fetched", num_nodes)
+    return
+
+
 async def request_asset(asset_name: str) -> None:
     """
     Request an asset by name
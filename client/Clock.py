@@ -0,0 +1,154 @@
+import time
+from hashlib import sha256
+
+
+# A hybrid logical clock (HLC) timestamp packs the clock's logical time (in units of 2^20 nanoseconds, about a
+# millisecond), a counter that orders the events within one unit of time and the id of the node that made the
+# timestamp into one integer. The logical time fills the high bits, so a packed timestamp is within a unit of
+# time of the nanoseconds since the epoch and fits the update log's signed 64-bit timestamps; comparing packed
+# timestamps compares the logical time, then the counter, then the node id, so timestamps never tie across nodes.
+TIME_SHIFT = 20
+COUNTER_BITS = 10
+NODE_BITS = 10
+MAX_COUNTER = (1 << COUNTER_BITS) - 1
+MAX_NODE_ID = (1 << NODE_BITS) - 1
+MAX_TIMESTAMP = (1 << 63) - 1 # the update log stores timestamps as signed 64-bit integers
+
+
+def pack_timestamp(logical_time: int, counter: int, node_id: int) -> int:
+    """
+    Pack the parts of an HLC timestamp into an integer.
+
+    Args:
+        logical_time (int): the logical time, in units of 2^TIME_SHIFT nanoseconds.
+        counter (int): the counter, at most MAX_COUNTER.
+        node_id (int): the id of the node that made the timestamp, at most MAX_NODE_ID.
+
+    Returns:
+        int: the packed timestamp.
+    """
+    return (logical_time << TIME_SHIFT) | (counter << NODE_BITS) | node_id
+
+
+def unpack_timestamp(timestamp: int) -> tuple[int, int, int]:
+    """
+    Unpack an HLC timestamp. Any integer timestamp can be unpacked, so nanosecond timestamps
+    made without a clock are read as the logical time they fall in.
+
+    Args:
+        timestamp (int): the packed timestamp.
+
+    Returns:
+        tuple[int, int, int]: the logical time, the counter and the node id.
+    """
+    return timestamp >> TIME_SHIFT, (timestamp >> NODE_BITS) & MAX_COUNTER, timestamp & MAX_NODE_ID
+
+
+def node_id_for(node_name: str) -> int:
+    """
+    Derive a node id for the clock from a node's name.
+
+    Args:
+        node_name (str): the node's name.
+
+    Returns:
+        int: the node id, at most MAX_NODE_ID.
+    """
+    return int.from_bytes(sha256(node_name.encode()).digest()[:4], 'big') & MAX_NODE_ID
+
+
+class HybridLogicalClock:
+    """
+    A hybrid logical clock. Its timestamps follow the physical clock, never go backwards and
+    always come after every timestamp the clock has seen from other nodes, so updates made on
+    nodes with skewed clocks are still ordered causally and every node orders them the same way.
+    Timestamps too far ahead of the physical clock are rejected, so one node whose clock is far 
+    in the future cannot drag every other node's clock along with it.
+    """
+
+    def __init__(self, node_id: int = 0, max_offset: int = 60 * 10**9) -> None:
+        """
+        Args:
+            node_id (int, optional): the id of the node the clock runs on, at most MAX_NODE_ID
+                                     (see node_id_for). Defaults to 0.
+            max_offset (int, optional): how far ahead of the physical clock, in nanoseconds, a received
+                                        timestamp may be. Defaults to 60 seconds.
+        """
+        if not 0 <= node_id <= MAX_NODE_ID:
+            raise ValueError(f'A node id must be between 0 and {MAX_NODE_ID}, not {node_id}')
+        if max_offset < 0:
+            raise ValueError(f'The maximum offset must not be negative, not {max_offset}')
+
+        self._node_id = node_id
+        self._max_offset = max_offset
+        self._logical_time = 0
+        self._counter = 0
+
+    ######### ACCESSORS #########
+    @property
+    def node_id(self) -> int:
+        """Get the id of the node the clock runs on."""
+        return self._node_id
+
+    @property
+    def last(self) -> int:
+        """Get the latest timestamp made by the clock, without advancing it."""
+        return pack_timestamp(self._logical_time, self._counter, self._node_id)
+
+    ######### MUTATORS #########
+    def now(self) -> int:
+        """
+        Make a timestamp for a local event (e.g. adding or deleting named data, or sending a notification).
+
+        Returns:
+            int: the packed timestamp.
+        """
+        physical_time = time.time_ns() >> TIME_SHIFT
+        if physical_time > self._logical_time:
+            self._logical_time, self._counter = physical_time, 0
+        else:
+            self._tick(self._counter)
+        return self.last
+
+    def update(self, timestamp: int) -> int:
+        """
+        Advance the clock past a timestamp received from another node (e.g. an update being
+        applied), and make a timestamp for receiving it. The clock is left as it is if the 
+        timestamp is rejected.
+
+        Args:
+            timestamp (int): the received packed timestamp.
+
+        Raises:
+            ValueError: if the timestamp is negative, does not fit in MAX_TIMESTAMP, or is more 
+                        than the maximum offset ahead of the physical clock.
+
+        Returns:
+            int: the packed timestamp.
+        """
+        now = time.time_ns()
+        if not 0 <= timestamp <= min(MAX_TIMESTAMP, now + self._max_offset):
+            raise ValueError(f'Timestamp {timestamp} is out of range or too far ahead of the physical clock')
+
+        remote_time, remote_counter, _ = unpack_timestamp(timestamp)
+        physical_time = now >> TIME_SHIFT
+        logical_time = max(self._logical_time, remote_time, physical_time)
+
+        if logical_time == physical_time and logical_time > max(self._logical_time, remote_time):
+            self._logical_time, self._counter = logical_time, 0
+        elif logical_time == self._logical_time == remote_time:
+            self._tick(max(self._counter, remote_counter))
+        elif logical_time == self._logical_time:
+            self._tick(self._counter)
+        else:
+            self._logical_time = logical_time
+            self._tick(remote_counter)
+        return self.last
+
+    def _tick(self, counter: int) -> None:
+        """Move the counter past a given value, moving on to the next unit of logical time if the counter is full."""
+        if counter < MAX_COUNTER:
+            self._counter = counter + 1
+        else:
+            self._logical_time += 1
+            self._counter = 0
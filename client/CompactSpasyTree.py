@@ -0,0 +1,311 @@
+from array import array
+from hashlib import sha256
+
+from Node import Node, CHILD_SLOTS, insert_named_data, delete_named_data, split_version
+
+
+# the four quadtree buckets a geohash character can fall into (see Node.slot)
+_SLOTS = CHILD_SLOTS[4]
+_BRANCHING = 4
+_DIGEST_SIZE = sha256().digest_size
+_NO_NODE = -1
+
+
+class CompactNode:
+    """
+    A lightweight, read-only view of one node stored in a CompactSpasyTree.
+    Mirrors the accessors of Node so callers can treat both engines alike.
+    """
+
+    __slots__ = ('_tree', '_index')
+
+    def __init__(self, tree: 'CompactSpasyTree', index: int) -> None:
+        """
+        Args:
+            tree (CompactSpasyTree): the tree holding the node's arrays.
+            index (int): the node's position in those arrays.
+        """
+        self._tree = tree
+        self._index = index
+
+    ######### ACCESSORS #########
+    @property
+    def index(self) -> int:
+        """Get the node's position in the tree's arrays."""
+        return self._index
+
+    @property
+    def hashcode(self) -> bytes:
+        """Get the current Merkle hash (the raw sha256 digest)."""
+        return self._tree._digest(self._index)
+
+    @property
+    def parent(self) -> 'CompactNode | None':
+        """Get the parent of the current node."""
+        parent = self._tree._parents[self._index]
+        if parent == _NO_NODE:
+            return None
+        return CompactNode(self._tree, parent)
+
+    @property
+    def geocode(self) -> set:
+        """Get the geocode prefix the node was created for."""
+        return {self._tree._geocode(self._index)}
+
+    @property
+    def children(self) -> list:
+        """Get the node's children."""
+        start = self._index * _BRANCHING
+        return [None if child == _NO_NODE else CompactNode(self._tree, child)
+                for child in self._tree._children[start:start + _BRANCHING]]
+
+    @property
+    def data(self) -> list:
+        """Get the list of assets."""
+        data = self._tree._data[self._index]
+        return data if data is not None else []
+
+    def number_children(self) -> int:
+        """Determine how many children hold data."""
+        start = self._index * _BRANCHING
+        return sum(1 for child in self._tree._children[start:start + _BRANCHING] if child != _NO_NODE)
+
+    def length_geocode(self) -> int:
+        """Returns the length of the geocode associated with this node."""
+        return len(self._tree._geocode(self._index))
+
+    ######### COMPARISONS #########
+    def __eq__(self, node: 'CompactNode') -> bool:
+        """Check if another node has the same Merkle hash as this node."""
+        return self.hashcode == node.hashcode
+
+    ######### STRINGS #########
+    def __str__(self) -> str:
+        return f'\nNode hash: {self.hashcode.hex()}\nNode geocode: {self.geocode}' +\
+              ''.join(f'\nChild: {child}' for child in self.children)
+
+
+class CompactSpasyTree:
+    """
+    An alternative storage engine for a SpasyTree that keeps every node in flat,
+    index-addressed arrays instead of a graph of Node objects. Each node costs
+    four child slots, a parent index, a raw digest and a single geocode character
+    (a node's geocode is the root geocode plus the characters on its path), while
+    leaves additionally hold a sorted list of named data and its version index.
+
+    Offers the same public API as SpasyTree for inserting, finding and deleting
+    named data and produces the same Merkle hashes.
+    """
+
+    def __init__(self, max_depth: int, node: Node | str = None) -> None:
+        """
+        Args:
+            max_depth (int): the tree's maximum depth.
+            node (Node | str, optional): the root node (or just its geocode).
+                                         Defaults to None, which is an empty geocode.
+        """
+        if isinstance(node, Node):
+            node = next(iter(node.geocode), '')
+        self._root_geocode = node if node is not None else ''
+        self._max_depth = max_depth
+
+        self._children = array('i')
+        self._parents = array('i')
+        self._digests = bytearray()
+        self._chars = bytearray()
+        self._data = []
+        self._versions = []
+        self._free = []
+
+        self._new_node(_NO_NODE, 0)
+        self._rehash(0)
+
+    ######### ACCESSORS #########
+    @property
+    def root(self) -> CompactNode:
+        """Get the tree's root."""
+        return CompactNode(self, 0)
+
+    @property
+    def max_depth(self) -> int:
+        """Get the tree's maximum allowable depth."""
+        return self._max_depth
+
+    @property
+    def size(self) -> int:
+        """Get the number of nodes currently stored in the tree."""
+        return len(self._parents) - len(self._free)
+
+    def find_data(self, named_data: str) -> bool:
+        """
+        Determine if an element of named data is in the tree.
+
+        Args:
+            named_data (str): the full hierarchical data name (with geocode).
+
+        Returns:
+            bool: True if in the tree;
+                  False otherwise.
+        """
+        named_data = named_data.lower()
+        leaf = self._find_leaf(named_data.split('/')[-1], 0)
+        if leaf == _NO_NODE or self._versions[leaf] is None:
+            return False
+        return self._versions[leaf].get(split_version(named_data)[0]) == named_data
+
+    def _find_leaf(self, geocode: str, node: int) -> int:
+        """Follow the child slots for a geocode from the given node down to the leaf level."""
+        for level in range(len(self._geocode(node)), len(geocode)):
+            slot = _SLOTS.get(geocode[level])
+            if slot is None:
+                return _NO_NODE
+            node = self._children[node * _BRANCHING + slot]
+            if node == _NO_NODE:
+                return _NO_NODE
+        return node
+
+    def _digest(self, node: int) -> bytes:
+        """Get the raw Merkle digest of a node."""
+        return bytes(self._digests[node * _DIGEST_SIZE:(node + 1) * _DIGEST_SIZE])
+
+    def _geocode(self, node: int) -> str:
+        """Rebuild a node's geocode from the characters along its path."""
+        chars = []
+        while self._parents[node] != _NO_NODE:
+            chars.append(chr(self._chars[node]))
+            node = self._parents[node]
+        return self._root_geocode + ''.join(reversed(chars))
+
+    ######### MUTATORS #########
+    def insert(self, named_data: str) -> None:
+        """
+        Add named data to the tree at the maximum depth of the tree.
+
+        Args:
+            named_data (str): the data to insert in the tree
+        """
+        named_data = named_data.lower()
+        insert_geocode = named_data.split('/')[-1]
+
+        # because all data is at leaf level, the geocode must match the height of the tree
+        if self._max_depth != len(insert_geocode) - 1:
+            print(f'The leaf level {self._max_depth} does not match the length of the geocode being inserted {len(insert_geocode) - 1}')
+            return
+
+        if not insert_geocode.startswith(self._root_geocode):
+            print(f"{insert_geocode} does not belong in this tree because it does not match the"
+                  f" substring of the tree's geocode: {self._root_geocode}." )
+            return
+
+        node = 0
+        for level in range(len(self._root_geocode), len(insert_geocode)):
+            slot = _SLOTS[insert_geocode[level]]
+            child = self._children[node * _BRANCHING + slot]
+            if child == _NO_NODE:
+                child = self._new_node(node, ord(insert_geocode[level]))
+                self._children[node * _BRANCHING + slot] = child
+            node = child
+
+        if self._data[node] is None:
+            self._data[node] = []
+            self._versions[node] = {}
+        if insert_named_data(self._data[node], self._versions[node], named_data)[0]:
+            self._update_merkle(node)
+
+    def delete(self, node: CompactNode, data_to_delete: str, current_position: int) -> bool:
+        """
+        Removes a specific piece of named data from the tree, pruning any nodes left empty.
+
+        Args:
+            node (CompactNode): the node to start searching from (normally the root).
+            data_to_delete (str): The named data to be removed.
+            current_position (int): The length of the geocode being considered.
+
+        Returns:
+            bool: True if the starting node no longer has any children;
+                  False otherwise.
+        """
+        data_to_delete = data_to_delete.lower()
+        start = node.index
+        leaf = self._find_leaf(data_to_delete.split('/')[-1], start)
+        if leaf == _NO_NODE or leaf == start or self._data[leaf] is None:
+            return False
+
+        if not delete_named_data(self._data[leaf], self._versions[leaf], data_to_delete):
+            return False
+        if self._data[leaf]:
+            self._update_merkle(leaf)
+            return False
+
+        # prune the emptied leaf and every ancestor it leaves without children
+        current = leaf
+        while current != start:
+            parent = self._parents[current]
+            slot = _SLOTS[chr(self._chars[current])]
+            self._children[parent * _BRANCHING + slot] = _NO_NODE
+            self._free_node(current)
+            current = parent
+            if self._number_children(current):
+                break
+        self._update_merkle(current)
+        return self._number_children(start) == 0
+
+    def _number_children(self, node: int) -> int:
+        """Determine how many children the node at the given index has."""
+        start = node * _BRANCHING
+        return sum(1 for child in self._children[start:start + _BRANCHING] if child != _NO_NODE)
+
+    def _new_node(self, parent: int, char: int) -> int:
+        """Allocate a node (reusing a freed slot when possible) and return its index."""
+        if self._free:
+            node = self._free.pop()
+            self._parents[node] = parent
+            self._chars[node] = char
+            self._data[node] = None
+            self._versions[node] = None
+            for slot in range(_BRANCHING):
+                self._children[node * _BRANCHING + slot] = _NO_NODE
+            return node
+
+        self._children.extend([_NO_NODE] * _BRANCHING)
+        self._parents.append(parent)
+        self._digests.extend(bytes(_DIGEST_SIZE))
+        self._chars.append(char)
+        self._data.append(None)
+        self._versions.append(None)
+        return len(self._parents) - 1
+
+    def _free_node(self, node: int) -> None:
+        """Release a node's slot so it can be reused."""
+        self._data[node] = None
+        self._versions[node] = None
+        self._parents[node] = _NO_NODE
+        self._free.append(node)
+
+    def _rehash(self, node: int) -> None:
+        """Generate a node's hash from its data (leaves) or its children's hashes (internal nodes)."""
+        hash_value = sha256()
+        data = self._data[node]
+        if data:
+            for named_data in data:
+                hash_value.update(named_data.encode())
+        else:
+            start = node * _BRANCHING
+            for child in self._children[start:start + _BRANCHING]:
+                if child != _NO_NODE:
+                    hash_value.update(self._digest(child))
+        self._digests[node * _DIGEST_SIZE:(node + 1) * _DIGEST_SIZE] = hash_value.digest()
+
+    def _update_merkle(self, node: int) -> None:
+        """Update each of the Merkle hashes along a path (from the given node to the root)."""
+        while node != _NO_NODE:
+            self._rehash(node)
+            node = self._parents[node]
+
+    ######### STRINGS #########
+    def __str__(self) -> str:
+        return f"Root: {self.root.geocode}"
+
+    ######### BUILT-INS #########
+    def __eq__(self, node_hashcode: bytes) -> bool:
+        return self.root.hashcode == node_hashcode
@@ -16,9 +16,13 @@ spasy = Spasy("")
 geocode = ""
 
 packed_updates_dict = {}
+packed_deltas_dict = {}
 packed_updates_queue = deque()
 packed_tree_geocode = None
 packed_assets_dict = {}
+packed_nodes_dict = {}
+packed_regions_dict = {}
+node_indexes = {}
 
 timer = None
 stats = None
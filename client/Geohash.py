@@ -0,0 +1,211 @@
+import math
+
+from Node import GEOHASH_BASE32
+
+
+# Each geohash character holds 5 bits, which alternate between the longitude and the latitude (starting with the
+# longitude), so a geohash of a given precision is a pair of grid indices: one per axis, of ceil(5p / 2) longitude
+# bits and floor(5p / 2) latitude bits. Cells are found by working with the indices rather than bisecting coordinates.
+EARTH_RADIUS = 6371008.8 # mean radius in meters
+_CHAR_VALUES = {char: value for value, char in enumerate(GEOHASH_BASE32)}
+
+
+def _axis_bits(precision: int) -> tuple[int, int]:
+    """The number of latitude and longitude bits in a geohash of a given precision."""
+    return precision * 5 // 2, (precision * 5 + 1) // 2
+
+
+def _to_geohash(latitude_index: int, longitude_index: int, precision: int) -> str:
+    """Interleave the grid indices of a cell into its geohash."""
+    latitude_bits, longitude_bits = _axis_bits(precision)
+    value = 0
+    for bit in range(precision * 5):
+        if bit % 2 == 0:
+            longitude_bits -= 1
+            value = value << 1 | (longitude_index >> longitude_bits & 1)
+        else:
+            latitude_bits -= 1
+            value = value << 1 | (latitude_index >> latitude_bits & 1)
+    return ''.join(GEOHASH_BASE32[value >> shift & 31] for shift in range(precision * 5 - 5, -1, -5))
+
+
+def _to_indices(geohash: str) -> tuple[int, int]:
+    """Split a geohash into the grid indices of its cell."""
+    latitude_index = longitude_index = 0
+    bit = 0
+    for char in geohash.lower():
+        value = _CHAR_VALUES.get(char)
+        if value is None:
+            raise ValueError(f'{geohash!r} is not a geohash')
+        for shift in range(4, -1, -1):
+            if bit % 2 == 0:
+                longitude_index = longitude_index << 1 | (value >> shift & 1)
+            else:
+                latitude_index = latitude_index << 1 | (value >> shift & 1)
+            bit += 1
+    return latitude_index, longitude_index
+
+
+def _grid_index(value: float, minimum: float, span: float, bits: int) -> int:
+    """The index of the grid cell holding a coordinate, along an axis split into 2^bits cells."""
+    return min(max(int((value - minimum) / span * (1 << bits)), 0), (1 << bits) - 1)
+
+
+def _last_grid_index(value: float, minimum: float, span: float, bits: int) -> int:
+    """The index of the last grid cell reaching a coordinate, so a cell that only starts at the coordinate is left out."""
+    return min(max(math.ceil((value - minimum) / span * (1 << bits)) - 1, 0), (1 << bits) - 1)
+
+
+def encode(latitude: float, longitude: float, precision: int = 10) -> str:
+    """
+    Encode a position as a geohash.
+
+    Args:
+        latitude (float): the latitude in degrees.
+        longitude (float): the longitude in degrees.
+        precision (int, optional): the number of geohash characters. Defaults to 10 (the level of the tree's leaves).
+
+    Returns:
+        str: the geohash of the cell holding the position.
+    """
+    latitude_bits, longitude_bits = _axis_bits(precision)
+    return _to_geohash(_grid_index(latitude, -90, 180, latitude_bits), _grid_index(longitude, -180, 360, longitude_bits),
+                       precision)
+
+
+def bounding_box(geohash: str) -> tuple[float, float, float, float]:
+    """
+    Get the cell of a geohash.
+
+    Args:
+        geohash (str): the geohash.
+
+    Returns:
+        tuple[float, float, float, float]: the cell's minimum latitude, minimum longitude, maximum latitude and
+                                           maximum longitude, in degrees.
+    """
+    latitude_index, longitude_index = _to_indices(geohash)
+    latitude_bits, longitude_bits = _axis_bits(len(geohash))
+    height = 180 / (1 << latitude_bits)
+    width = 360 / (1 << longitude_bits)
+    return (-90 + latitude_index * height, -180 + longitude_index * width,
+            -90 + (latitude_index + 1) * height, -180 + (longitude_index + 1) * width)
+
+
+def decode(geohash: str) -> tuple[float, float]:
+    """
+    Decode a geohash into the position at the center of its cell.
+
+    Args:
+        geohash (str): the geohash.
+
+    Returns:
+        tuple[float, float]: the latitude and longitude in degrees.
+    """
+    min_latitude, min_longitude, max_latitude, max_longitude = bounding_box(geohash)
+    return (min_latitude + max_latitude) / 2, (min_longitude + max_longitude) / 2
+
+
+def cover_cells(min_latitude: float, min_longitude: float, max_latitude: float, max_longitude: float,
+                precision: int) -> list[str]:
+    """
+    Find the geohash cells of a precision that cover a bounding box (the cells that only touch
+    its maximum latitude or longitude are left out). The number of cells grows quickly with the
+    precision, so it should be chosen to suit the size of the box.
+
+    Args:
+        min_latitude (float): the box's minimum latitude in degrees.
+        min_longitude (float): the box's minimum longitude in degrees.
+        max_latitude (float): the box's maximum latitude in degrees.
+        max_longitude (float): the box's maximum longitude in degrees.
+        precision (int): the number of characters of the cells' geohashes.
+
+    Returns:
+        list[str]: the geohashes of the cells that intersect the box.
+    """
+    latitude_bits, longitude_bits = _axis_bits(precision)
+    return [_to_geohash(latitude_index, longitude_index, precision)
+            for latitude_index in range(_grid_index(min_latitude, -90, 180, latitude_bits),
+                                        max(_last_grid_index(max_latitude, -90, 180, latitude_bits),
+                                            _grid_index(min_latitude, -90, 180, latitude_bits)) + 1)
+            for longitude_index in range(_grid_index(min_longitude, -180, 360, longitude_bits),
+                                         max(_last_grid_index(max_longitude, -180, 360, longitude_bits),
+                                             _grid_index(min_longitude, -180, 360, longitude_bits)) + 1)]
+
+
+def distance(latitude: float, longitude: float, other_latitude: float, other_longitude: float) -> float:
+    """
+    Get the great-circle (haversine) distance between two positions.
+
+    Args:
+        latitude (float): the first position's latitude in degrees.
+        longitude (float): the first position's longitude in degrees.
+        other_latitude (float): the second position's latitude in degrees.
+        other_longitude (float): the second position's longitude in degrees.
+
+    Returns:
+        float: the distance in meters.
+    """
+    latitude, other_latitude = math.radians(latitude), math.radians(other_latitude)
+    haversine = (math.sin((other_latitude - latitude) / 2) ** 2 +
+                 math.cos(latitude) * math.cos(other_latitude) * math.sin(math.radians(other_longitude - longitude) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(haversine)))
+
+
+def distance_to_box(latitude: float, longitude: float, box: tuple[float, float, float, float]) -> float:
+    """
+    Get the distance from a position to the nearest point of a bounding box (0 if the position
+    is inside it). The nearest point is found in degrees, which is exact enough for boxes the
+    size of the cells of a tree.
+
+    Args:
+        latitude (float): the position's latitude in degrees.
+        longitude (float): the position's longitude in degrees.
+        box (tuple[float, float, float, float]): the minimum latitude, minimum longitude, maximum latitude and
+                                                 maximum longitude of the box (see bounding_box).
+
+    Returns:
+        float: the distance in meters.
+    """
+    min_latitude, min_longitude, max_latitude, max_longitude = box
+    return distance(latitude, longitude, min(max(latitude, min_latitude), max_latitude),
+                    min(max(longitude, min_longitude), max_longitude))
+
+
+def farthest_distance_to_box(latitude: float, longitude: float, box: tuple[float, float, float, float]) -> float:
+    """
+    Get the distance from a position to the farthest point of a bounding box, which is one
+    of its corners.
+
+    Args:
+        latitude (float): the position's latitude in degrees.
+        longitude (float): the position's longitude in degrees.
+        box (tuple[float, float, float, float]): the minimum latitude, minimum longitude, maximum latitude and
+                                                 maximum longitude of the box (see bounding_box).
+
+    Returns:
+        float: the distance in meters.
+    """
+    min_latitude, min_longitude, max_latitude, max_longitude = box
+    return max(distance(latitude, longitude, corner_latitude, corner_longitude)
+               for corner_latitude in (min_latitude, max_latitude) for corner_longitude in (min_longitude, max_longitude))
+
+
+def radius_box(latitude: float, longitude: float, radius: float) -> tuple[float, float, float, float]:
+    """
+    Get a bounding box that holds a circle.
+
+    Args:
+        latitude (float): the latitude of the circle's center in degrees.
+        longitude (float): the longitude of the circle's center in degrees.
+        radius (float): the circle's radius in meters.
+
+    Returns:
+        tuple[float, float, float, float]: the minimum latitude, minimum longitude, maximum latitude and
+                                           maximum longitude of the box, in degrees.
+    """
+    latitude_radius = math.degrees(radius / EARTH_RADIUS)
+    cos_latitude = math.cos(math.radians(min(abs(latitude) + latitude_radius, 90)))
+    longitude_radius = 180 if cos_latitude < 1e-12 else min(180, latitude_radius / cos_latitude)
+    return (max(latitude - latitude_radius, -90), max(longitude - longitude_radius, -180),
+            min(latitude + latitude_radius, 90), min(longitude + longitude_radius, 180))
@@ -0,0 +1,219 @@
+import struct
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from hashlib import sha256
+from typing import Self
+
+
+# each cell holds a count, the XOR of the keys stored in it and the XOR of their checksums
+_CELL = struct.Struct('<iQI')
+
+
+class IBLT:
+    """
+    An Invertible Bloom Lookup Table (as used by PSync) that summarizes a set of items
+    by 64-bit keys. Subtracting the table of another set leaves a table of the symmetric
+    difference, which can be listed as long as it is small compared to the number of cells.
+    """
+
+    def __init__(self, cells: int=60, hash_count: int=3) -> None:
+        """
+        Args:
+            cells (int, optional): the number of cells, rounded up to a multiple of hash_count.
+                                   About 1.5 cells are needed per differing item. Defaults to 60.
+            hash_count (int, optional): the number of cells each key is stored in. Defaults to 3.
+        """
+        self._hash_count = hash_count
+        self._cells_per_hash = max(1, -(-cells // hash_count))
+        size = self._cells_per_hash * hash_count
+        self._counts = [0] * size
+        self._key_sums = [0] * size
+        self._check_sums = [0] * size
+
+    ######### ACCESSORS #########
+    @property
+    def cells(self) -> int:
+        """Get the number of cells."""
+        return len(self._counts)
+
+    @property
+    def hash_count(self) -> int:
+        """Get the number of cells each key is stored in."""
+        return self._hash_count
+
+    @staticmethod
+    def key(item: bytes) -> int:
+        """Get the 64-bit key of an item."""
+        return int.from_bytes(sha256(item).digest()[:8], 'little')
+
+    def _check(self, key: int) -> int:
+        """Get the checksum of a key, used to recognize cells that hold a single key."""
+        return int.from_bytes(sha256(b'check' + key.to_bytes(8, 'little')).digest()[:4], 'little')
+
+    def _indexes(self, key: int) -> list[int]:
+        """Get the cells a key is stored in, one in each of the hash_count parts of the table."""
+        digest = sha256(key.to_bytes(8, 'little')).digest()
+        return [i * self._cells_per_hash + int.from_bytes(digest[4 * i:4 * i + 4], 'little') % self._cells_per_hash
+                for i in range(self._hash_count)]
+
+    def list_entries(self) -> tuple[set[int], set[int]] | None:
+        """
+        List the keys stored in the table by repeatedly removing cells that hold a single key.
+        For a table that is the difference of two tables, the keys that were added are the keys
+        only in the first set and the keys that were removed are the keys only in the second.
+
+        Returns:
+            tuple[set[int], set[int]] | None: the keys added and the keys removed; or None if
+                                              the table holds too many keys to list them all.
+        """
+        counts = list(self._counts)
+        key_sums = list(self._key_sums)
+        check_sums = list(self._check_sums)
+        added = set()
+        removed = set()
+
+        pure = [index for index in range(len(counts)) if counts[index] in (1, -1)]
+        while pure:
+            index = pure.pop()
+            key = key_sums[index]
+            if counts[index] not in (1, -1) or check_sums[index] != self._check(key):
+                continue
+
+            sign = counts[index]
+            (added if sign == 1 else removed).add(key)
+            check = self._check(key)
+            for cell in self._indexes(key):
+                counts[cell] -= sign
+                key_sums[cell] ^= key
+                check_sums[cell] ^= check
+                if counts[cell] in (1, -1):
+                    pure.append(cell)
+
+        if any(counts) or any(key_sums) or any(check_sums):
+            return None
+        return added, removed
+
+    ######### MUTATORS #########
+    def insert(self, item: bytes) -> None:
+        """Add an item to the table."""
+        self._update(self.key(item), 1)
+
+    def erase(self, item: bytes) -> None:
+        """Remove an item from the table."""
+        self._update(self.key(item), -1)
+
+    def _update(self, key: int, sign: int) -> None:
+        """Add (sign 1) or remove (sign -1) a key from each of its cells."""
+        check = self._check(key)
+        for cell in self._indexes(key):
+            self._counts[cell] += sign
+            self._key_sums[cell] ^= key
+            self._check_sums[cell] ^= check
+
+    def subtract(self, other: Self) -> Self:
+        """
+        Get the difference of this table and another table of the same size.
+
+        Args:
+            other (IBLT): the table to subtract.
+
+        Returns:
+            IBLT: a table of the items in only one of the two sets (see list_entries).
+        """
+        if other.cells != self.cells or other.hash_count != self.hash_count:
+            raise ValueError(f'Cannot subtract a table with {other.cells} cells from a table with {self.cells} cells')
+
+        difference = IBLT(self.cells, self._hash_count)
+        difference._counts = [a - b for a, b in zip(self._counts, other._counts)]
+        difference._key_sums = [a ^ b for a, b in zip(self._key_sums, other._key_sums)]
+        difference._check_sums = [a ^ b for a, b in zip(self._check_sums, other._check_sums)]
+        return difference
+
+    ######### ENCODING #########
+    def to_bytes(self) -> bytes:
+        """Encode the table's cells."""
+        return b''.join(_CELL.pack(*cell) for cell in zip(self._counts, self._key_sums, self._check_sums))
+
+    @classmethod
+    def from_bytes(cls, data: bytes, hash_count: int=3) -> Self:
+        """
+        Decode a table encoded by to_bytes.
+
+        Args:
+            data (bytes): the encoded cells.
+            hash_count (int, optional): the number of cells each key is stored in. Defaults to 3.
+
+        Returns:
+            IBLT: the table.
+        """
+        if not data or len(data) % _CELL.size or (len(data) // _CELL.size) % hash_count:
+            raise ValueError(f'Malformed table of {len(data)} bytes')
+
+        table = cls(len(data) // _CELL.size, hash_count)
+        for index, (count, key_sum, check_sum) in enumerate(_CELL.iter_unpack(data)):
+            table._counts[index] = count
+            table._key_sums[index] = key_sum
+            table._check_sums[index] = check_sum
+        return table
+
+    def to_component(self) -> str:
+        """Encode the table as an NDN name component (unpadded base64url)."""
+        return urlsafe_b64encode(self.to_bytes()).decode().rstrip('=')
+
+    @classmethod
+    def from_component(cls, component: str, hash_count: int=3) -> Self:
+        """Decode a table encoded by to_component."""
+        return cls.from_bytes(urlsafe_b64decode(component + '=' * (-len(component) % 4)), hash_count)
+
+
+def encode_update(update: tuple) -> bytes:
+    """
+    Encode a recent update (a timestamp, action and named data) as an IBLT item.
+
+    Args:
+        update (tuple): the update.
+
+    Returns:
+        bytes: the item.
+    """
+    return '\x1f'.join(str(element) for element in update).encode()
+
+
+def updates_iblt(updates: list, cells: int) -> IBLT:
+    """
+    Summarize a queue of recent updates.
+
+    Args:
+        updates (list): the recent updates.
+        cells (int): the number of cells in the table.
+
+    Returns:
+        IBLT: a table holding every update.
+    """
+    table = IBLT(cells)
+    for update in updates:
+        table.insert(encode_update(update))
+    return table
+
+
+def find_missing_updates(updates: list, other_table: IBLT) -> list | None:
+    """
+    Find the updates that another user is missing from their summary of their recent updates.
+
+    Args:
+        updates (list): our recent updates.
+        other_table (IBLT): the other user's table of their recent updates.
+
+    Returns:
+        list | None: the updates only we have, oldest first; or None if the difference is too
+                     large for the table to be listed.
+    """
+    by_key = {IBLT.key(encode_update(update)): update for update in updates}
+    table = updates_iblt(updates, other_table.cells)
+
+    entries = table.subtract(other_table).list_entries()
+    if entries is None:
+        return None
+    added, removed = entries
+    if any(key not in by_key for key in added):
+        return None
+    return sorted(by_key[key] for key in added)
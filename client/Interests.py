@@ -1,12 +1,13 @@
 import logging
-import pickle
 import asyncio
-from typing import Optional
+from collections import deque
+from typing import AsyncIterator, Optional
 
 from ndn.types import InterestNack, InterestTimeout, InterestCanceled, ValidationFailure
 from ndn.encoding import Name, Component, MetaInfo, FormalName, BinaryStr
 
 import Config
+from Util import unpack_updates, SegmentDecompressor
 from SpasyTree import SpasyTree
 
 
@@ -56,22 +57,31 @@ async def send_init_interests() -> None:
     return
 
 
-async def send_root_request(name: Name, seg_cnt: int) -> tuple[list, int, Optional[BinaryStr]]:
+async def send_root_request(name: Name) -> tuple[Optional[tuple[str, list]], int, Optional[BinaryStr]]:
     """
-    Send request(s) for a root hash, sends requests concurrently and requires the total number of segments to send for be known in advance
+    Send request(s) for the updates leading to a root hash. The name holds the newer root hash, the requester's current root
+    hash and a summary of its recent updates, and the size of the response (a delta or the full queue) is not known in advance, so the number of
+    segments is read from the first segment
 
     Args:
-        name: Name containing root hash (str)
-        seg_cnt: Total number of segments for requested update queue
+        name: Name containing the newer root hash, the requester's root hash and the IBLT of the requester's recent updates (str)
 
     Returns:
-        received_update: Unserialized update queue
-        num_seg: Number of segments received making up update queue
-        data: Unserialized update queue
+        received_update: Unserialized response, a marker (Util.UPDATES_DELTA, Util.UPDATES_MISSING or Util.UPDATES_FULL) and the updates,
+                         None if it could not be fetched or decoded
+        num_seg: Number of segments received making up the response
+        data: Serialized response
     """
 
-    data, num_seg = await fetch_segments_concurrent(name, seg_cnt)
-    received_update = pickle.loads(data)
+    data, num_seg = await fetch_segments(name)
+    if data is None:
+        logging.info(f"No response for interest {name}")
+        return None, num_seg, data
+    try:
+        received_update = unpack_updates(data)
+    except ValueError as e:
+        logging.info(f"Malformed response for interest {name}: {e}")
+        return None, num_seg, data
     logging.info(f"Received response for interest {name}")
     return received_update, num_seg, data
 
@@ -92,6 +102,50 @@ async def send_asset_request(name: Name) -> tuple[Optional[BinaryStr], int]:
     return data, num_seg
 
 
+async def send_node_request(geocode: str, digest: bytes) -> Optional[BinaryStr]:
+    """
+    Send request(s) for one node of a tree by its digest (e.g. during reconciliation). As the node is named by its digest
+    alone, a cached response is never stale and identical nodes are fetched once
+
+    Args:
+        geocode: Geocode of the tree
+        digest: Merkle hash of the node (raw digest, hex encoded in the name)
+
+    Returns:
+        data: Encoded node (see Reconcile.encode_node), None if it could not be fetched
+    """
+
+    name = Config.config["direct_node_prefix"] + f"/{geocode}" + f"/{digest.hex()}"
+    data, num_seg = await fetch_segments(name)
+    return data
+
+
+def join_segments(name: Name, segments: list[tuple[FormalName, MetaInfo, Optional[BinaryStr]]]) -> Optional[BinaryStr]:
+    """
+    Join the content of the received segments of a response in order. If the content type in the MetaInfo of the first
+    segment names a compression codec, each segment is decompressed as it is joined
+
+    Args:
+        name: Name of content
+        segments: Name, meta information and content of each segment, in order
+
+    Returns:
+        data: Binary data of response, None if a segment was not received or the content could not be decompressed
+    """
+
+    if not segments or any(segment is None for _, _, segment in segments):
+        return None
+
+    try:
+        decompressor = SegmentDecompressor(segments[0][1].content_type)
+        data = b''.join([decompressor.feed(bytes(segment)) for _, _, segment in segments])
+        decompressor.finish()
+    except ValueError as e:
+        logging.info(f"Content of {name} could not be decompressed: {e}")
+        return None
+    return data
+
+
 async def fetch_segments(name: Name) -> tuple[Optional[BinaryStr], int]:
     """
     Fetches all segments making up content with given name, done concurrently, with an initial interest being sent to determine the number of segments
@@ -100,7 +154,7 @@ async def fetch_segments(name: Name) -> tuple[Optional[BinaryStr], int]:
         name: Name of content
 
     Returns:
-        data: Binary data of response
+        data: Binary data of response, None if a segment was not received
         current_seg: Total number of segments received making up response
     """
 
@@ -109,6 +163,8 @@ async def fetch_segments(name: Name) -> tuple[Optional[BinaryStr], int]:
 
     logging.info(f"Sending initial interest for tree with root {name}")
     data_name, meta_info, seg = await send_interest(Name.normalize(name) + [Component.from_segment(current_seg)])
+    if meta_info is None:
+        return None, current_seg
     segments.append((data_name, meta_info, seg))
 
     if meta_info.final_block_id != Component.from_segment(0):
@@ -122,11 +178,7 @@ async def fetch_segments(name: Name) -> tuple[Optional[BinaryStr], int]:
             current_seg += 1
         segments.extend(await asyncio.gather(*requests))
 
-    data = b''
-    for _, _, segment in segments:
-        data += bytes(segment)
-
-    return data, current_seg
+    return join_segments(name, segments), current_seg
 
 
 async def fetch_segments_concurrent(name: Name, seg_cnt: int) -> tuple[Optional[BinaryStr], int]:
@@ -155,11 +207,7 @@ async def fetch_segments_concurrent(name: Name, seg_cnt: int) -> tuple[Optional[
         current_seg += 1
     segments.extend(await asyncio.gather(*requests))
 
-    data = b''
-    for _, _, segment in segments:
-        data += bytes(segment)
-
-    return data, current_seg
+    return join_segments(name, segments), current_seg
 
 
 async def fetch_segments_sequential(name: Name) -> tuple[Optional[BinaryStr], int]:
@@ -176,17 +224,17 @@ async def fetch_segments_sequential(name: Name) -> tuple[Optional[BinaryStr], in
 
     logging.info(f"Sending interests for tree with root {name}")
 
-    data = b''
+    segments = []
     current_seg = 0
     while current_seg < Config.config["max_packets"]:
         logging.info(f"Requesting segment {current_seg} of tree with root {name}")
         data_name, meta_info, seg = await send_interest(Name.normalize(name) + [Component.from_segment(current_seg)])
-        data += bytes(seg)
-        if meta_info.final_block_id == Component.from_segment(current_seg):
+        segments.append((data_name, meta_info, seg))
+        if meta_info is None or meta_info.final_block_id == Component.from_segment(current_seg):
             break
         current_seg += 1
 
-    return data, current_seg
+    return join_segments(name, segments), current_seg
 
 
 async def fetch_segments_batch(name: Name, batch_size: int) -> tuple[Optional[BinaryStr], int]:
@@ -207,6 +255,8 @@ async def fetch_segments_batch(name: Name, batch_size: int) -> tuple[Optional[Bi
     current_seg = 0
     logging.info(f"Sending initial interest for tree with root {name}")
     data_name, meta_info, seg = await send_interest(Name.normalize(name) + [Component.from_segment(current_seg)])
+    if meta_info is None:
+        return None, current_seg
     segments.append((data_name, meta_info, seg))
 
     if meta_info.final_block_id != Component.from_segment(0):
@@ -226,24 +276,69 @@ async def fetch_segments_batch(name: Name, batch_size: int) -> tuple[Optional[Bi
                 break
             batch += 1
 
-    data = b''
-    for _, _, segment in segments:
-        data += bytes(segment)
+    return join_segments(name, segments), current_seg
+
+
+async def stream_segments(name: Name, window: int) -> AsyncIterator[BinaryStr]:
+    """
+    Fetches all segments making up content with given name and yields their content in order as it arrives, so it can be
+    decoded while later segments are still in flight. Up to window interests are kept in flight, each received segment
+    making room for the next. Compressed content is decompressed segment by segment
+
+    Args:
+        name: Name of content
+        window: Maximum number of segments requested at once
+
+    Yields:
+        data: Binary data of the next segment
+
+    Raises:
+        ValueError: If a segment is not received or the content cannot be decompressed
+    """
 
-    return data, current_seg
+    logging.info(f"Sending initial interest for {name}")
+    data_name, meta_info, seg = await send_interest(Name.normalize(name) + [Component.from_segment(0)])
+    if meta_info is None or seg is None:
+        raise ValueError(f"Segment 0 of {name} was not received")
+    seg_cnt = 1
+    if meta_info.final_block_id is not None:
+        seg_cnt = min(Component.to_number(meta_info.final_block_id) + 1, Config.config["max_packets"])
+
+    decompressor = SegmentDecompressor(meta_info.content_type)
+    yield decompressor.feed(bytes(seg))
+
+    requests = deque()
+    current_seg = 1
+    try:
+        while current_seg < seg_cnt or requests:
+            while current_seg < seg_cnt and len(requests) < max(window, 1):
+                logging.info(f"Requesting segment {current_seg} of {name}")
+                requests.append(asyncio.create_task(send_interest(Name.normalize(name) + [Component.from_segment(current_seg)])))
+                current_seg += 1
+            _, _, seg = await requests.popleft()
+            if seg is None:
+                raise ValueError(f"Segment {current_seg - len(requests) - 1} of {name} was not received")
+            yield decompressor.feed(bytes(seg))
+        decompressor.finish()
+    finally:
+        for request in requests:
+            request.cancel()
 
 
-async def send_sync_request(route: str, root_hash: str, asset_name: str, seg_cnt: int) -> None:
+async def send_sync_request(route: str, root_hash: bytes, asset_name: str, action: str, seg_cnt: int, clock: int) -> None:
     """
     Send notification request to a given node
 
     Args:
         route: Node prefix of desired node
-        root_hash: Notification interest root hash
-        asset_name: Name of asset associated with update
+        root_hash: Notification interest root hash (raw digest, hex encoded in the name)
+        asset_name: Name of asset associated with update (a region's geohash prefix for the deletion of a region)
+        action: Action of the update ('i', 'd' or 'r')
         seg_cnt: Number of segments making up update queue
+        clock: Hybrid logical clock timestamp of the notification (see Clock.HybridLogicalClock), so the receiver's clock
+               is advanced past it
     """
 
-    name = route + Config.config["multi_path"] + f"{asset_name}" + f"/i" + f"/{root_hash}" + f"/{Config.geocode}" + f"/{seg_cnt}"
+    name = route + Config.config["multi_path"] + f"{asset_name}" + f"/{action}" + f"/{root_hash.hex()}" + f"/{Config.geocode}" + f"/{seg_cnt}" + f"/{clock}"
     await send_interest(name, 5)
     return
@@ -1,5 +1,27 @@
 from typing import Self
 from hashlib import sha256
+from bisect import bisect_left, insort
+
+
+# Leaf hashing schemes. 'sequential' hashes the sorted list of data, so every change rehashes the 
+# whole leaf. 'additive' sums the sha256 of each element modulo 2^256 (a multiset hash), so adding 
+# or removing one element updates the leaf hash in constant time.
+LEAF_HASH_SEQUENTIAL = 'sequential'
+LEAF_HASH_ADDITIVE = 'additive'
+LEAF_HASHES = (LEAF_HASH_SEQUENTIAL, LEAF_HASH_ADDITIVE)
+_SET_HASH_MODULUS = 1 << 256
+
+# The geohash alphabet and, for each supported number of children per Node, the child slot
+# each character is stored in. With 4 children, consecutive runs of 8 characters share a slot 
+# (and the slot's Node holds all of their geocodes); with 32, every character has its own slot.
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+CHILD_SLOTS = {
+    4: {char: index // 8 for index, char in enumerate(GEOHASH_BASE32)},
+    32: {char: index for index, char in enumerate(GEOHASH_BASE32)},
+}
+# A Node's list of children is only allocated when it gets its first child, so leaves
+# share one empty tuple of children per number of children.
+_NO_CHILDREN = {branching: (None,) * branching for branching in CHILD_SLOTS}
 
 
 class Node:
@@ -8,29 +30,55 @@ class Node:
     Merkle hash indicate changes in the data stored in that Node.
     """
 
-    def __init__(self, geocode: set = set()) -> None:
+    def __init__(self, geocode: set = set(), leaf_hash: str = LEAF_HASH_SEQUENTIAL, branching: int = 4) -> None:
         """
         Args:
             merkle (str): the node's Merkle hash.
             geocode (list): a list containing the geospatial index/indices 
                            associated with the Node.
+            leaf_hash (str, optional): the scheme used to hash the node's data if it is a leaf,
+                                       one of LEAF_HASHES. Defaults to 'sequential'.
+            branching (int, optional): the number of children, one of the keys of CHILD_SLOTS. 
+                                       Defaults to 4.
         """
-        self._hashcode = sha256().hexdigest() # Note: since it is on the empty string, it'll always be the same hash
+        self._hashcode = sha256().digest() # Note: since it is on the empty string, it'll always be the same hash
         if isinstance(geocode, str):
             self._geocode = {geocode}
         else:
             self._geocode = geocode
         
-        self._children = [None, None, None, None]
+        self._children = _NO_CHILDREN[branching]
         self._data = list()
+        self._versions = dict() # unversioned name -> stored name, for the data in self._data
         self._parent = None
+        self._dirty = False # True when the hash must be regenerated before it is next read
+        self._count = 0 # number of named data in the subtree, kept with the hash (None if not yet counted)
+        self._leaf_hash = leaf_hash
+        self._set_hash = 0 # running sum of element hashes for the additive leaf hash
 
     ######### ACCESSORS #########
     @property
-    def hashcode(self) -> str:
-        """Get or set the current Merkle hash."""
+    def hashcode(self) -> bytes:
+        """
+        Get or set the current Merkle hash (the raw sha256 digest).
+        A Node marked dirty regenerates its hash (and those of its dirty descendants) first.
+        """
+        if self._dirty:
+            self.generate_hash()
         return self._hashcode
     
+    @property
+    def count(self) -> int:
+        """
+        Get the number of pieces of named data stored in the Node's subtree. It is kept up to date 
+        with the Merkle hash, so a Node marked dirty regenerates its hash first.
+        """
+        if self._dirty:
+            self.generate_hash()
+        elif self._count is None:
+            self._count = len(self._data) or sum(child.count for child in self._children if child is not None)
+        return self._count
+
     @property
     def parent(self) -> Self:
         """Get or set the parent of the current Node."""
@@ -50,7 +98,29 @@ class Node:
     def data(self) -> list:
         """Get, set, or delete the list of assets."""
         return self._data
+
+    @property
+    def leaf_hash(self) -> str:
+        """Get or set the scheme used to hash the node's data."""
+        return self._leaf_hash
     
+    @property
+    def branching(self) -> int:
+        """Get the number of child slots."""
+        return len(self._children)
+
+    def slot(self, geocode_char: str) -> int | None:
+        """
+        Find the child slot a geocode character is stored in.
+
+        Args:
+            geocode_char (str): the last character of a child's geocode.
+
+        Returns:
+            int | None: the index in the children list, or None if the character is not in GEOHASH_BASE32.
+        """
+        return CHILD_SLOTS[len(self._children)].get(geocode_char)
+
     def number_children(self) -> int:
         """Determine how many children hold data."""
         number = 0
@@ -59,20 +129,41 @@ class Node:
                 number += 1
         return number
     
+    def stored_data(self, named_data: str) -> str | None:
+        """
+        Get the version of a name (with geocode) that is currently stored in the node, if any.
+
+        Returns:
+            str | None: the stored name, or None if no version of it is stored.
+        """
+        return self._versions.get(split_version(named_data)[0])
+
+    def has_data(self, named_data: str) -> bool:
+        """
+        Determine if this exact piece of named data (with its version and geocode) is stored 
+        in the node. Uses the index of unversioned names, so the data list is not scanned.
+
+        Returns:
+            bool: True if the data is in the node's data list;
+                  False otherwise.
+        """
+        return self.stored_data(named_data) == named_data
+
     def in_data(self, named_data: str) -> bool:
         """
-        Determine if the string being sought is in the node's 
-        list of data. 
+        Determine if the string being sought (a name without its geocode) is in the node's 
+        list of data. Only the names sharing the sought prefix are examined.
 
         Returns:
             bool: True if the data is in the node's data list;
                   False otherwise.
         """
-        for element in self._data:
-            data_string = element.split('/')
-            data_without_geocode = '/'.join(data_string[:-1])
-            if data_without_geocode == named_data.lower():
+        prefix = named_data.lower() + '/'
+        index = bisect_left(self._data, prefix)
+        while index < len(self._data) and self._data[index].startswith(prefix):
+            if '/' not in self._data[index][len(prefix):]:
                 return True
+            index += 1
         return False
     
     def length_geocode(self) -> int:
@@ -88,20 +179,38 @@ class Node:
     def parent(self, parent_node: Self) -> None:
         self._parent = parent_node
 
+    @leaf_hash.setter
+    def leaf_hash(self, scheme: str) -> None:
+        self._leaf_hash = scheme
+
     def add_geocode(self, geocode: str) -> None:
         """Add a geocode to the set of geocodes associated with this node."""
         self._geocode.add(geocode)
 
-    def delete_data(self, named_data: str) -> None:
-        """Delete a piece of named data from the node."""
+    def delete_data(self, named_data: str, rehash: bool=True) -> bool:
+        """
+        Delete a piece of named data from the node.
+
+        Args:
+            named_data (str): the named data object's name.
+            rehash (bool, optional): regenerate the hash right away. Defaults to True.
+
+        Returns:
+            bool: True if the data was removed;
+                  False if the node did not hold it.
+        """
         
-        if named_data.lower() in self._data:
-            self._data.remove(named_data)
-            self.generate_hash()
+        if delete_named_data(self._data, self._versions, named_data):
+            self._update_set_hash(named_data.lower(), -1)
+            if rehash:
+                self.generate_hash()
+            return True
+        return False
 
     def add_child(self, node_to_add: Self) -> int:
         """
-        Adds a child Node to the list of children.
+        Adds a child Node to the list of children. If the child's slot is already taken,
+        the child's geocode is added to the Node in that slot instead.
 
         Args:
             node_to_add (Self): the child being added.
@@ -109,111 +218,107 @@ class Node:
         Returns:
             int: the index where the child Node was inserted in the children list.
         """
-        geocode_to_add = list(node_to_add.geocode)[0]
-        geocode_char = geocode_to_add[-1].lower()
-        index = None
-        if geocode_char in '01234567':
-            index = 0
-            if self._children[0] is None:
+        geocode_to_add = next(iter(node_to_add.geocode))
+        index = self.slot(geocode_to_add[-1].lower())
+        if index is not None:
+            if self._children[index] is None:
+                if isinstance(self._children, tuple):
+                    self._children = [None] * len(self._children)
                 node_to_add.parent = self
-                self._children[0] = node_to_add
+                self._children[index] = node_to_add
             else:
-                self._children[0].add_geocode(geocode_to_add)
-        elif geocode_char in '89bcdefg':
-            index = 1
-            if self._children[1] is None:
-                node_to_add.parent = self
-                self._children[1] = node_to_add
-            else:
-                self._children[1].add_geocode(geocode_to_add)
-        elif geocode_char in 'hjkmnpqr':
-            index = 2
-            if self._children[2] is None:
-                node_to_add.parent = self
-                self._children[2] = node_to_add
-            else:
-                self._children[2].add_geocode(geocode_to_add)
-        elif geocode_char in 'stuvwxyz':
-            index = 3
-            if self._children[3] is None:
-                node_to_add.parent = self
-                self._children[3] = node_to_add
-            else:
-                self._children[3].add_geocode(geocode_to_add)
+                self._children[index].add_geocode(geocode_to_add)
 
         return index
 
-    def insert_data(self, named_data: str) -> None:
+    def set_children(self, children: list) -> None:
+        """
+        Give a Node without children all of its children at once (e.g. while a tree is decoded),
+        rather than adding them one at a time.
+
+        Args:
+            children (list): a child or None for each slot, with each child in the slot of its geocodes.
         """
-        Inserts new named data into the list of data. Checks if the new data is a version 
+        if len(children) != len(self._children):
+            raise ValueError(f'A node has {len(self._children)} child slots, not {len(children)}')
+        self._children = children if any(child is not None for child in children) else _NO_CHILDREN[len(children)]
+        for child in children:
+            if child is not None:
+                child.parent = self
+
+    def insert_data(self, named_data: str, rehash: bool=True) -> bool:
+        """
+        Inserts new named data into the sorted list of data. Checks if the new data is a version 
         (signified by '_v<number>' in the penultimate component) of previous data or new data.
-        The final value in the string is the geohash.
+        The final value in the string is the geohash. Lookups use the index of unversioned names,
+        so no stored name has to be split.
 
         Args:
             named_data (str): the named data object's name.
+            rehash (bool, optional): regenerate the hash right away. Defaults to True.
+
+        Returns:
+            bool: True if the list of data changed;
+                  False otherwise.
         """
-        existing_data = self._data
-        named_data = named_data.lower() # all names added to a list should follow the same format
-        
-        # if the list is empty, we can safely insert the data
-        if len(existing_data) == 0:
-            self._data.append(named_data)
-            self.generate_hash()
-        else:
-            # split the string to be inserted; get a version number if there is one
-            split_data = named_data.split('/')
-            if split_data[-2].startswith('_v'):
-                data_to_check = ''.join(split_data[0:-2]) + split_data[-1]
-                insert_version = split_data[-2]
-            else:
-                data_to_check = ''.join(split_data)
-                insert_version = None
-
-            for i in range(len(existing_data)):
-                # the data is already stored; do nothing
-                if existing_data[i] == named_data:
-                    return
-                
-                # split the named data element in the list and check if there is a version number
-                element_split = existing_data[i].split('/')
-                if element_split[-2].startswith('_v'):  # this can't be None because there will always be data and a geocode
-                    # this removes the version number from the string to check if data matches
-                    element_without_version = ''.join(element_split[0:-2]) + element_split[-1]
-                    current_version = element_split[-2]
-                else:
-                    element_without_version = ''.join(element_split)
-                    current_version = None
-
-                # the hierarchical names match
-                if element_without_version == data_to_check:
-                    if insert_version is not None:
-                        if current_version is not None:
-                            # the current version is older than the one to be inserted
-                            if current_version < insert_version:
-                                self._data[i] = named_data
-                                self.generate_hash()
-                                return
-                            elif current_version >= insert_version:
-                                return
-                        # current version must be older, as it didn't have a version number
-                        elif current_version is None:
-                            self._data[i] = named_data
-                            self.generate_hash()
-                            return
-                    # the current version is already up-to-date   
-                    elif current_version is not None:
-                        return
-                    
-            # the data is new and should be added
-            self._data.append(named_data)
-            self._data.sort()
-            self.generate_hash()
+        changed, replaced = insert_named_data(self._data, self._versions, named_data)
+        if changed:
+            self._update_set_hash(named_data.lower(), 1)
+            if replaced is not None:
+                self._update_set_hash(replaced, -1)
+            if rehash:
+                self.generate_hash()
+            return True
+        return False
+
+    def _update_set_hash(self, named_data: str, sign: int) -> None:
+        """
+        Add (sign 1) or remove (sign -1) an element from the additive leaf hash.
+
+        Args:
+            named_data (str): the element being added or removed.
+            sign (int): 1 to add the element, -1 to remove it.
+        """
+        if self._leaf_hash == LEAF_HASH_ADDITIVE:
+            element_hash = int.from_bytes(sha256(named_data.encode()).digest(), 'big')
+            self._set_hash = (self._set_hash + sign * element_hash) % _SET_HASH_MODULUS
+
+    def restore(self, sorted_data: list, hashcode: bytes) -> None:
+        """
+        Restore a node's data and hash (e.g. from a snapshot) without regenerating the hash.
+
+        Args:
+            sorted_data (list): the node's named data, already sorted.
+            hashcode (bytes): the node's Merkle hash (raw digest).
+        """
+        self._data = list(sorted_data)
+        self._versions = {split_version(named_data)[0]: named_data for named_data in self._data}
+        self._set_hash = 0
+        for named_data in self._data:
+            self._update_set_hash(named_data, 1)
+        self._hashcode = hashcode
+        self._dirty = False
+        self._count = None
+
+    def invalidate(self) -> None:
+        """
+        Mark this Node and its ancestors as dirty so their hashes are regenerated 
+        the next time they are read. Stops at the first ancestor that is already dirty,
+        since all of its ancestors must be dirty as well.
+        """
+        node = self
+        while node is not None and not node._dirty:
+            node._dirty = True
+            node = node._parent
 
     def generate_hash(self) -> None:
         """Uses the Node's list of data to generate a hashcode for the Node."""
         # leaf nodes store data, so we generate hashes on the data
         hash_value = sha256()
-        if self._data:
+        self._count = len(self._data)
+        if self._data and self._leaf_hash == LEAF_HASH_ADDITIVE:
+            hash_value.update(self._set_hash.to_bytes(32, 'big'))
+        elif self._data:
             for named_data in self._data:
                 hash_value.update(named_data.encode())
 
@@ -221,9 +326,11 @@ class Node:
         else:
             for child in self._children:
                 if child is not None:
-                    hash_value.update(child.hashcode.encode())
+                    hash_value.update(child.hashcode)
+                    self._count += child.count
         
-        self._hashcode = hash_value.hexdigest()
+        self._hashcode = hash_value.digest()
+        self._dirty = False
 
     ######### DELETERS #########
     def remove_children(self) -> None:
@@ -231,7 +338,7 @@ class Node:
         Remove all children from the node. 
         Turns the node into a leaf node.
         """
-        self._children = [None, None, None, None]
+        self._children = _NO_CHILDREN[len(self._children)]
 
     def remove_child(self, child_to_remove: int) -> None:
         """
@@ -240,18 +347,112 @@ class Node:
         Args:
             child_to_remove (int): the index of the removed child
         """
-        self._children[child_to_remove] = None
+        if self._children[child_to_remove] is not None:
+            self._children[child_to_remove] = None
     
+    ######### PICKLING #########
+    def __getstate__(self) -> dict:
+        """Leave the version index out of pickled Nodes; it is rebuilt from the data."""
+        state = self.__dict__.copy()
+        del state['_versions']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        if isinstance(self._children, tuple):
+            self._children = _NO_CHILDREN[len(self._children)]
+        self._versions = {split_version(named_data)[0]: named_data for named_data in self._data}
+
     ######### COMPARISONS #########
     def __eq__(self, node: Self) -> bool:
         """Check if another Node has the same Merkle hash as this Node."""
-        return self._hashcode == node.hashcode
+        return self.hashcode == node.hashcode
 
     ######### STRINGS #########
     def __str__(self) -> str:
-        return f'\nNode hash: {self._hashcode}\nNode geocode: {self._geocode}' +\
+        return f'\nNode hash: {self.hashcode.hex()}\nNode geocode: {self._geocode}' +\
               ''.join(f'\nChild: {child}' for child in self._children)
-        
+
+
+def split_version(named_data: str) -> tuple[str, int | None]:
+    """
+    Separate the version (signified by '_v<number>' in the penultimate component) from a name.
+
+    Args:
+        named_data (str): the named data object's name (with geocode).
+
+    Returns:
+        tuple[str, int | None]: the name without its version component and the numeric 
+                                version, or None if the name is not versioned.
+    """
+    # only the last two components are examined, so the rest of the name is not split
+    end = named_data.rfind('/')
+    start = named_data.rfind('/', 0, end) if end > 0 else -1
+    if start >= 0 and named_data.startswith('_v', start + 1) and named_data[start + 3:end].isdigit():
+        return named_data[:start] + named_data[end:], int(named_data[start + 3:end])
+    return named_data, None
+
+
+def insert_named_data(existing_data: list, versions: dict, named_data: str) -> tuple[bool, str | None]:
+    """
+    Inserts named data into a leaf's sorted list of data. A version (signified by '_v<number>' 
+    in the penultimate component) replaces an older version of the same name, including an 
+    unversioned one; versions are compared numerically. The final value in the string is 
+    the geohash. Shared by every tree storage engine so that leaves hash identically.
+
+    Args:
+        existing_data (list): the leaf's list of named data, kept sorted.
+        versions (dict): the leaf's index from unversioned names to the stored names.
+        named_data (str): the named data object's name.
+
+    Returns:
+        tuple[bool, str | None]: True if the list changed (so the leaf must be rehashed), False otherwise; 
+                                 and the older version that was replaced, if any.
+    """
+    # all names added to a list should follow the same format; a name that already does is stored 
+    # as it is, so the caller's (e.g. the tree's interned) copy is shared rather than duplicated
+    lowered = named_data.lower()
+    if lowered != named_data:
+        named_data = lowered
+    unversioned, insert_version = split_version(named_data)
+
+    current = versions.get(unversioned)
+    if current is not None:
+        current_version = split_version(current)[1]
+        # the stored data is the same or newer; do nothing
+        if insert_version is None or (current_version is not None and current_version >= insert_version):
+            return False, None
+        # the stored data is older and is replaced
+        del existing_data[bisect_left(existing_data, current)]
+
+    insort(existing_data, named_data)
+    versions[unversioned] = named_data
+    return True, current
+
+
+def delete_named_data(existing_data: list, versions: dict, named_data: str) -> bool:
+    """
+    Deletes named data from a leaf's sorted list of data.
+
+    Args:
+        existing_data (list): the leaf's list of named data, kept sorted.
+        versions (dict): the leaf's index from unversioned names to the stored names.
+        named_data (str): the named data object's name.
+
+    Returns:
+        bool: True if the data was removed;
+              False if the leaf did not hold it.
+    """
+    named_data = named_data.lower()
+    unversioned = split_version(named_data)[0]
+    if versions.get(unversioned) != named_data:
+        return False
+
+    del versions[unversioned]
+    del existing_data[bisect_left(existing_data, named_data)]
+    return True
+
+
 # TESTING
 if __name__ == '__main__':
     print(f'\nTesting Node...\n')
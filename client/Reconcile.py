@@ -0,0 +1,205 @@
+import asyncio
+from hashlib import sha256
+from typing import Awaitable, Callable
+
+from Node import Node, GEOHASH_BASE32
+from SpasyTree import SpasyTree
+
+
+# the first byte of an encoded node says whether it lists child digests or leaf data
+NODE_INTERNAL = 0
+NODE_LEAF = 1
+_DIGEST_SIZE = sha256().digest_size
+
+
+def child_path(path: str, slot: int) -> str:
+    """
+    Get the path of a child node. A path names a node by the child slots leading to it
+    from the root, one geohash character per slot; the root's path is empty.
+
+    Args:
+        path (str): the path of the parent node.
+        slot (int): the child's slot in the parent.
+
+    Returns:
+        str: the path of the child node.
+    """
+    return path + GEOHASH_BASE32[slot]
+
+
+def find_node(tree: SpasyTree, path: str) -> Node | None:
+    """
+    Follow a path of child slots from the root of a tree.
+
+    Args:
+        tree (SpasyTree): the tree to search.
+        path (str): the path of the node (see child_path).
+
+    Returns:
+        Node | None: the node, or None if the tree has no node at that path.
+    """
+    node = tree.root
+    for char in path:
+        slot = GEOHASH_BASE32.find(char)
+        if node is None or not 0 <= slot < len(node.children):
+            return None
+        node = node.children[slot]
+    return node
+
+
+def index_nodes(tree: SpasyTree) -> dict[bytes, Node]:
+    """
+    Index the nodes of a tree by their digests, so nodes can be served by digest alone. The
+    stubs of a partial tree (see SpasyTree.region) are left out, as only their digests are known.
+
+    Args:
+        tree (SpasyTree): the tree to index.
+
+    Returns:
+        dict[bytes, Node]: each node by its Merkle hash (raw digest).
+    """
+    index = {tree.root.hashcode: tree.root}
+    stack = [tree.root]
+    while stack:
+        for child in stack.pop().children:
+            if child is not None and (child.data or child.number_children()):
+                index[child.hashcode] = child
+                stack.append(child)
+    return index
+
+
+def encode_node(node: Node) -> bytes:
+    """
+    Encode the part of a node a peer needs to compare it with its own tree: the slot and
+    digest of each child for an internal node, or the named data of a leaf.
+
+    Args:
+        node (Node): the node to encode.
+
+    Returns:
+        bytes: the encoded node.
+    """
+    if node.data:
+        return bytes([NODE_LEAF]) + '\n'.join(node.data).encode()
+
+    encoded = bytearray([NODE_INTERNAL])
+    for slot, child in enumerate(node.children):
+        if child is not None:
+            encoded.append(slot)
+            encoded += child.hashcode
+    return bytes(encoded)
+
+
+def decode_node(data: bytes) -> tuple[dict[int, bytes] | None, list[str] | None]:
+    """
+    Decode a node encoded by encode_node.
+
+    Args:
+        data (bytes): the encoded node.
+
+    Returns:
+        tuple[dict[int, bytes] | None, list[str] | None]: the digest of each child by slot and None
+                                                           for an internal node, or None and the named
+                                                           data for a leaf.
+    """
+    if not data:
+        raise ValueError('An encoded node cannot be empty')
+
+    if data[0] == NODE_LEAF:
+        return None, bytes(data[1:]).decode().split('\n')
+    if data[0] != NODE_INTERNAL or (len(data) - 1) % (_DIGEST_SIZE + 1):
+        raise ValueError('Malformed encoded node')
+
+    children = {}
+    for start in range(1, len(data), _DIGEST_SIZE + 1):
+        children[data[start]] = bytes(data[start + 1:start + 1 + _DIGEST_SIZE])
+    return children, None
+
+
+def collect_data(node: Node) -> set[str]:
+    """
+    Gather all of the named data stored below (and in) a node.
+
+    Args:
+        node (Node): the root of the subtree.
+
+    Returns:
+        set[str]: the named data in the subtree.
+    """
+    collected = set()
+    stack = [node]
+    while stack:
+        current_node = stack.pop()
+        collected.update(current_node.data)
+        stack.extend(child for child in current_node.children if child is not None)
+    return collected
+
+
+async def reconcile(tree: SpasyTree, root_digest: bytes,
+                    fetch: Callable[[bytes], Awaitable[bytes | None]]) -> tuple[set[str], set[str], int] | None:
+    """
+    Compare a tree with a peer's tree top-down by their Merkle hashes. Nodes whose digests
+    match are skipped, so only the branches that differ are fetched (one tree level at a
+    time, concurrently, and each digest once), and only the leaves that changed are downloaded. Both trees must
+    use the same branching factor and leaf hash scheme. For a partial tree (see
+    SpasyTree.region), the branches outside the region are not fetched; their stubs are
+    given the peer's digests instead, so the root hash still matches the peer's.
+
+    Args:
+        tree (SpasyTree): the local tree.
+        root_digest (bytes): the root hash (raw digest) of the peer's tree.
+        fetch (Callable): fetches the encoded node (see encode_node) of the peer's tree with
+                          the given digest, returning None if it is unavailable.
+
+    Returns:
+        tuple[set[str], set[str], int] | None: the named data to insert and to delete so the local tree
+                                               matches the peer's, and the number of nodes fetched;
+                                               or None if a node could not be fetched or decoded.
+    """
+    additions = set()
+    deletions = set()
+    fetched = 0
+    region_path = ''
+    if tree.region is not None:
+        root_length = tree.root.length_geocode()
+        region_path = ''.join(GEOHASH_BASE32[tree.root.slot(char)] for char in tree.region[root_length:])
+
+    # each entry is a node's path, the local node (None if the local tree lacks it) and the peer's digest
+    level = [('', tree.root, root_digest)]
+    while level:
+        differing = [(path, node, digest) for path, node, digest in level if node is None or node.hashcode != digest]
+        digests = list(dict.fromkeys(digest for _, _, digest in differing))
+        responses = dict(zip(digests, await asyncio.gather(*(fetch(digest) for digest in digests))))
+        if None in responses.values():
+            return None
+        fetched += len(responses)
+
+        level = []
+        for path, node, digest in differing:
+            data = responses[digest]
+            try:
+                children, names = decode_node(data)
+            except ValueError:
+                return None
+
+            # a leaf: only the names that differ are applied
+            if names is not None:
+                local_data = set(node.data) if node is not None else set()
+                additions.update(set(names) - local_data)
+                deletions.update(local_data - set(names))
+                continue
+
+            local_children = node.children if node is not None else [None] * tree.branching
+            if any(slot >= len(local_children) for slot in children):
+                return None
+            for slot, local_child in enumerate(local_children):
+                if not child_path(path, slot).startswith(region_path[:len(path) + 1]):
+                    if node is not None:
+                        tree.update_stub(node, slot, children.get(slot))
+                elif slot in children:
+                    level.append((child_path(path, slot), local_child, children[slot]))
+                elif local_child is not None:
+                    # the peer no longer has anything in this branch
+                    deletions.update(collect_data(local_child))
+
+    return additions, deletions, fetched
@@ -0,0 +1,425 @@
+import mmap
+import os
+import struct
+from hashlib import sha256
+
+from Node import Node, CHILD_SLOTS, LEAF_HASHES
+from SpasyTree import SpasyTree
+from UpdateLog import UpdateLog
+
+
+# A snapshot is a header (followed by the root geocode and a description of how the tree was
+# built, so a snapshot of another tree is not mistaken for this one), a table of fixed-size node records (in preorder, so the root is
+# record 0), the leaf geocodes sorted with the record of the leaf storing them, the offset
+# of every name, the names themselves (each leaf's names sorted and stored together) and
+# the encoded update log. All integers are little-endian.
+SNAPSHOT_MAGIC = b'SPSY'
+SNAPSHOT_VERSION = 2
+
+# magic, version, branching, leaf hash scheme (index in LEAF_HASHES), max depth, recent updates
+# size, node count, name count, leaf geocode count, length of the root geocode, length of the build description
+_HEADER = struct.Struct('<4sHBBHIIIIHH')
+# offsets of the node table, leaf geocodes, name offsets, names and update log, and the log's length
+_SECTIONS = struct.Struct('<QQQQQQ')
+_NO_NODE = -1
+_DIGEST_SIZE = sha256().digest_size
+
+
+def _node_struct(branching: int) -> struct.Struct:
+    """A node record: digest, parent, children, geocode length, and the first and number of the leaf's names."""
+    return struct.Struct(f'<{_DIGEST_SIZE}si{branching}iHII')
+
+
+def write_snapshot(tree: SpasyTree, path: str, build: str = '') -> None:
+    """
+    Write a tree to a snapshot file that can be opened with MappedSpasyTree. The file is
+    written next to its destination and moved into place, so readers never see a partial file.
+
+    Args:
+        tree (SpasyTree): the tree to write.
+        path (str): the snapshot file.
+        build (str, optional): a description of how the tree was built (e.g. the number of names
+                               and where they came from), checked when the snapshot is loaded. 
+                               Defaults to ''.
+    """
+    nodes = []
+    parents = []
+    stack = [(tree.root, _NO_NODE)]
+    while stack:
+        node, parent = stack.pop()
+        nodes.append(node)
+        parents.append(parent)
+        index = len(nodes) - 1
+        stack.extend((child, index) for child in reversed(node.children) if child is not None)
+    indexes = {id(node): index for index, node in enumerate(nodes)}
+
+    node_struct = _node_struct(tree.branching)
+    node_table = bytearray()
+    names = []
+    for node, parent in zip(nodes, parents):
+        children = [indexes[id(child)] if child is not None else _NO_NODE for child in node.children]
+        node_table += node_struct.pack(node.hashcode, parent, *children, node.length_geocode(), len(names), len(node.data))
+        names.extend(node.data)
+
+    leaf_struct = struct.Struct(f'<{tree.max_depth + 1}sI')
+    leaf_geocodes = sorted((geocode.encode(), index) for index, node in enumerate(nodes)
+                           if node.length_geocode() == tree.max_depth + 1 for geocode in node.geocode)
+    leaf_table = b''.join(leaf_struct.pack(geocode, index) for geocode, index in leaf_geocodes)
+
+    encoded_names = [name.encode() for name in names]
+    name_offsets = [0]
+    for name in encoded_names:
+        name_offsets.append(name_offsets[-1] + len(name))
+    name_offset_table = struct.pack(f'<{len(name_offsets)}Q', *name_offsets)
+    name_table = b''.join(encoded_names)
+    log = tree.update_log.to_bytes()
+
+    root_geocode = next(iter(tree.root.geocode), '').encode()
+    encoded_build = build.encode()
+    header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, tree.branching, LEAF_HASHES.index(tree.leaf_hash),
+                          tree.max_depth, tree.max_number_recent_updates, len(nodes), len(names),
+                          len(leaf_geocodes), len(root_geocode), len(encoded_build)) + root_geocode + encoded_build
+
+    offset = len(header) + _SECTIONS.size
+    sections = []
+    for section in (node_table, leaf_table, name_offset_table, name_table):
+        sections.append(offset)
+        offset += len(section)
+    sections.extend((offset, len(log)))
+
+    temporary_path = f'{path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(header)
+        file.write(_SECTIONS.pack(*sections))
+        for section in (node_table, leaf_table, name_offset_table, name_table, log):
+            file.write(section)
+    os.replace(temporary_path, path)
+
+
+class MappedNode:
+    """
+    A lightweight, read-only view of one node record in a memory-mapped snapshot.
+    Mirrors the accessors of Node so callers can treat both alike; fields are read
+    from the mapped file when accessed.
+    """
+
+    __slots__ = ('_tree', '_index')
+
+    def __init__(self, tree: 'MappedSpasyTree', index: int) -> None:
+        """
+        Args:
+            tree (MappedSpasyTree): the tree whose snapshot holds the node.
+            index (int): the node's record number.
+        """
+        self._tree = tree
+        self._index = index
+
+    ######### ACCESSORS #########
+    @property
+    def index(self) -> int:
+        """Get the node's record number."""
+        return self._index
+
+    @property
+    def hashcode(self) -> bytes:
+        """Get the current Merkle hash (the raw sha256 digest)."""
+        return self._tree._record(self._index)[0]
+
+    @property
+    def parent(self) -> 'MappedNode | None':
+        """Get the parent of the current node."""
+        parent = self._tree._record(self._index)[1]
+        return MappedNode(self._tree, parent) if parent != _NO_NODE else None
+
+    @property
+    def children(self) -> list:
+        """Get the node's children."""
+        children = self._tree._record(self._index)[2:2 + self._tree.branching]
+        return [MappedNode(self._tree, child) if child != _NO_NODE else None for child in children]
+
+    @property
+    def data(self) -> list:
+        """Get the list of assets."""
+        first, count = self._tree._record(self._index)[-2:]
+        return [self._tree._name(position) for position in range(first, first + count)]
+
+    @property
+    def geocode(self) -> set:
+        """Get the set of geocodes associated with this node (rebuilt from the leaves below it)."""
+        if self._index == 0:
+            return {self._tree.root_geocode}
+        length = self.length_geocode()
+        return {geocode[:length] for geocode, leaf in self._tree._leaf_geocodes() if self._is_ancestor_of(leaf)}
+
+    @property
+    def branching(self) -> int:
+        """Get the number of child slots."""
+        return self._tree.branching
+
+    def _is_ancestor_of(self, index: int) -> bool:
+        """Check if this node is the node with the given record number or one of its ancestors."""
+        while index != _NO_NODE:
+            if index == self._index:
+                return True
+            index = self._tree._record(index)[1]
+        return False
+
+    def number_children(self) -> int:
+        """Determine how many children hold data."""
+        return sum(1 for child in self._tree._record(self._index)[2:2 + self._tree.branching] if child != _NO_NODE)
+
+    def length_geocode(self) -> int:
+        """Returns the length of any geocode associated with this node."""
+        return self._tree._record(self._index)[-3]
+
+    ######### COMPARISONS #########
+    def __eq__(self, node: 'MappedNode') -> bool:
+        """Check if another node has the same Merkle hash as this node."""
+        return self.hashcode == node.hashcode
+
+    ######### STRINGS #########
+    def __str__(self) -> str:
+        return f'\nNode hash: {self.hashcode.hex()}\nNode geocode: {self.geocode}' +\
+              ''.join(f'\nChild: {child}' for child in self.children)
+
+
+class MappedSpasyTree:
+    """
+    A read-only SpasyTree backed by a memory-mapped snapshot file (see write_snapshot).
+    Opening it only maps the file; the root hash, lookups and reads of nodes work directly
+    off the mapping, and materialize() builds a regular SpasyTree once the tree must change.
+    """
+
+    def __init__(self, path: str, lazy_merkle: bool=False) -> None:
+        """
+        Args:
+            path (str): the snapshot file.
+            lazy_merkle (bool, optional): passed to the SpasyTree built by materialize(). Defaults to False.
+        """
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._map) < _HEADER.size:
+            raise ValueError(f'{path} is not a SpasyTree snapshot')
+        (magic, version, branching, leaf_hash, max_depth, max_queue, node_count,
+         name_count, leaf_count, root_length, build_length) = _HEADER.unpack_from(self._map)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f'{path} is not a SpasyTree snapshot')
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f'{path} is a version {version} snapshot, expected version {SNAPSHOT_VERSION}')
+        if branching not in CHILD_SLOTS or leaf_hash >= len(LEAF_HASHES) or node_count == 0:
+            raise ValueError(f'{path} has a malformed header')
+        sections_offset = _HEADER.size + root_length + build_length
+        if len(self._map) < sections_offset + _SECTIONS.size:
+            raise ValueError(f'{path} is truncated')
+
+        self._branching = branching
+        self._leaf_hash = LEAF_HASHES[leaf_hash]
+        self._max_depth = max_depth
+        self._max_number_recent_updates = max_queue
+        self._node_count = node_count
+        self._name_count = name_count
+        self._leaf_count = leaf_count
+        self._root_geocode = self._map[_HEADER.size:_HEADER.size + root_length].decode()
+        self._build = self._map[_HEADER.size + root_length:sections_offset].decode()
+        (self._nodes_offset, self._leaves_offset, self._name_offsets_offset, self._names_offset,
+         self._log_offset, self._log_length) = _SECTIONS.unpack_from(self._map, sections_offset)
+
+        self._node_struct = _node_struct(branching)
+        self._leaf_struct = struct.Struct(f'<{max_depth + 1}sI')
+
+        # the sections follow each other in the order they are written, and the update log ends the file
+        expected_offsets = [sections_offset + _SECTIONS.size]
+        for section_size in (node_count * self._node_struct.size, leaf_count * self._leaf_struct.size, (name_count + 1) * 8):
+            expected_offsets.append(expected_offsets[-1] + section_size)
+        if ([self._nodes_offset, self._leaves_offset, self._name_offsets_offset, self._names_offset] != expected_offsets
+                or self._log_offset + self._log_length != len(self._map)):
+            raise ValueError(f'{path} is truncated or its sections are malformed')
+        if self._names_offset + struct.unpack_from('<Q', self._map, self._names_offset - 8)[0] != self._log_offset:
+            raise ValueError(f'{path} is truncated or its sections are malformed')
+        self._lazy_merkle = lazy_merkle
+        self._update_log = None # decoded when first needed
+        self._checkpointed = False
+
+    ######### ACCESSORS #########
+    @property
+    def root(self) -> MappedNode:
+        """Get the tree's root."""
+        return MappedNode(self, 0)
+
+    @property
+    def root_geocode(self) -> str:
+        """Get the geocode of the tree's root."""
+        return self._root_geocode
+
+    @property
+    def build(self) -> str:
+        """Get the description of how the tree was built, given to write_snapshot."""
+        return self._build
+
+    @property
+    def max_depth(self) -> int:
+        """Get the tree's maximum allowable depth."""
+        return self._max_depth
+
+    @property
+    def region(self) -> None:
+        """Get the geohash prefix kept by a partial tree, which is always None since snapshots hold whole trees."""
+        return None
+
+    @property
+    def branching(self) -> int:
+        """Get the number of children per node."""
+        return self._branching
+
+    @property
+    def leaf_hash(self) -> str:
+        """Get the scheme used to hash the tree's leaves."""
+        return self._leaf_hash
+
+    @property
+    def lazy_merkle(self) -> bool:
+        """Get whether the materialized tree recomputes Merkle hashes lazily."""
+        return self._lazy_merkle
+
+    @property
+    def size(self) -> int:
+        """Get the number of nodes in the snapshot."""
+        return self._node_count
+
+    @property
+    def update_log(self) -> UpdateLog:
+        """Get the log of the latest changes made to the tree."""
+        if self._update_log is None:
+            self._update_log = UpdateLog.from_bytes(self._map[self._log_offset:self._log_offset + self._log_length])
+        return self._update_log
+
+    @property
+    def recent_updates(self) -> list:
+        """Get the recent updates that have been made to the tree, oldest first."""
+        return self.update_log.latest(self._max_number_recent_updates)
+
+    @property
+    def max_number_recent_updates(self) -> int:
+        return self._max_number_recent_updates
+
+    def checkpoint(self) -> bytes:
+        """
+        Record the current root hash, so peers with it can later be sent just the changes made since
+        (see SpasyTree.checkpoint). A mapped tree never changes, so it is the only checkpoint.
+
+        Returns:
+            bytes: the root hash (raw digest).
+        """
+        self._checkpointed = True
+        return self.root.hashcode
+
+    def changes_since(self, root_hash: bytes, until_hash: bytes | None = None) -> list | None:
+        """Get the changes between two checkpointed root hashes (see SpasyTree.changes_since)."""
+        if not self._checkpointed or root_hash != self.root.hashcode:
+            return None
+        if until_hash is not None and until_hash != root_hash:
+            return None
+        return []
+
+    def find_data(self, named_data: str) -> bool:
+        """
+        Determine if an element of named data is in the tree, reading only the leaf's
+        record and a binary search of its names from the mapped file.
+
+        Args:
+            named_data (str): the full hierarchical data name (with geocode).
+
+        Returns:
+            bool: True if in the tree;
+                  False otherwise.
+        """
+        named_data = named_data.lower()
+        leaf = self._find_leaf(named_data.split('/')[-1])
+        if leaf is None:
+            return False
+
+        first, count = self._record(leaf)[-2:]
+        low, high = first, first + count
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(middle) < named_data:
+                low = middle + 1
+            else:
+                high = middle
+        return low < first + count and self._name(low) == named_data
+
+    def _find_leaf(self, geocode: str) -> int | None:
+        """Binary search the sorted leaf geocodes for the record of the leaf storing a geocode."""
+        if len(geocode) != self._max_depth + 1:
+            return None
+        target = geocode.encode()
+        low, high = 0, self._leaf_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._leaf(middle)[0] < target:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._leaf_count and self._leaf(low)[0] == target:
+            return self._leaf(low)[1]
+        return None
+
+    def _record(self, index: int) -> tuple:
+        """Read a node record: digest, parent, children, geocode length, first name and number of names."""
+        return self._node_struct.unpack_from(self._map, self._nodes_offset + index * self._node_struct.size)
+
+    def _leaf(self, position: int) -> tuple:
+        """Read a leaf geocode and the record of the leaf storing it."""
+        return self._leaf_struct.unpack_from(self._map, self._leaves_offset + position * self._leaf_struct.size)
+
+    def _leaf_geocodes(self):
+        """Iterate over the leaf geocodes and the records of the leaves storing them."""
+        for position in range(self._leaf_count):
+            geocode, index = self._leaf(position)
+            yield geocode.decode(), index
+
+    def _name(self, position: int) -> str:
+        """Read a name."""
+        start, end = struct.unpack_from('<QQ', self._map, self._name_offsets_offset + position * 8)
+        return self._map[self._names_offset + start:self._names_offset + end].decode()
+
+    ######### MATERIALIZATION #########
+    def materialize(self) -> SpasyTree:
+        """
+        Build a regular, mutable SpasyTree from the snapshot. The stored hashes are reused,
+        so nothing is rehashed.
+
+        Returns:
+            SpasyTree: the tree.
+        """
+        records = [self._record(index) for index in range(self._node_count)]
+        geocodes = [set() for _ in range(self._node_count)]
+        geocodes[0].add(self._root_geocode)
+        for geocode, index in self._leaf_geocodes():
+            while index > 0:
+                geocodes[index].add(geocode[:records[index][-3]])
+                index = records[index][1]
+
+        nodes = [Node(geocode, self._leaf_hash, self._branching) for geocode in geocodes]
+        for node, record in zip(nodes, records):
+            first, count = record[-2:]
+            node.restore([self._name(position) for position in range(first, first + count)], record[0])
+            for child in record[2:2 + self._branching]:
+                if child != _NO_NODE:
+                    node.add_child(nodes[child])
+
+        tree = SpasyTree(self._max_depth, self._max_number_recent_updates, nodes[0], self._lazy_merkle,
+                         self._leaf_hash, self._branching, self.update_log.capacity)
+        tree.update_log = self.update_log
+        if self._checkpointed:
+            tree.checkpoint()
+        return tree
+
+    def close(self) -> None:
+        """Unmap the snapshot file."""
+        self._map.close()
+
+    ######### STRINGS #########
+    def __str__(self) -> str:
+        return f"Root: {self.root.geocode}"
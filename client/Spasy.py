@@ -1,4 +1,7 @@
 from SpasyTree import *
+from Snapshot import MappedSpasyTree, write_snapshot
+from UpdateLog import to_nanoseconds
+from Clock import HybridLogicalClock
 from random import randint, seed
 from pprint import pprint
 import time
@@ -15,9 +18,31 @@ class Spasy:
     at Geohash Level 10.
     """
 
-    def __init__(self, geocode: str, max_updates: int=50) -> None:
-        self._trees = {str(geocode): SpasyTree(9, max_updates, Node(geocode))}
+    def __init__(self, geocode: str, max_updates: int=50, lazy_merkle: bool=False,
+                 leaf_hash: str=LEAF_HASH_SEQUENTIAL, branching: int=4, max_change_log: int=1000, node_id: int=0,
+                 max_clock_offset: int=60 * 10**9) -> None:
+        """
+        Args:
+            geocode (str): the geocode of the user's tree.
+            max_updates (int, optional): the size of each tree's recent updates queue. Defaults to 50.
+            lazy_merkle (bool, optional): defer Merkle hashing until the root hash is read, so a batch
+                                          of changes rehashes each shared ancestor once. Defaults to False.
+            leaf_hash (str, optional): the scheme used to hash the tree's leaves (see SpasyTree). 
+                                       Defaults to 'sequential'.
+            branching (int, optional): the number of children per tree node, 4 or 32 (see SpasyTree).
+                                       Defaults to 4.
+            max_change_log (int, optional): the number of changes each tree keeps in its change log (see 
+                                            SpasyTree.changes_since). Defaults to 1000.
+            node_id (int, optional): the id of this node in the timestamps of its changes (see 
+                                     Clock.HybridLogicalClock). Defaults to 0.
+            max_clock_offset (int, optional): how far ahead of this node's physical clock, in nanoseconds, 
+                                              another user's timestamps may be before the clock ignores 
+                                              them. Defaults to 60 seconds.
+        """
+        self._trees = {str(geocode): SpasyTree(9, max_updates, Node(geocode, leaf_hash, branching), 
+                                               lazy_merkle, leaf_hash, branching, max_change_log)}
         self._subscribed_trees = [geocode]
+        self._clock = HybridLogicalClock(node_id, max_clock_offset) # timestamps this user's changes; advanced past the changes received
 
     ######### ACCESSORS #########
     @property
@@ -30,6 +55,90 @@ class Spasy:
         """Get or set the subscribed trees."""
         return self._subscribed_trees
 
+    @property
+    def clock(self) -> HybridLogicalClock:
+        """Get the hybrid logical clock that timestamps this user's changes."""
+        return self._clock
+
+    def _materialized(self, geocode: str) -> SpasyTree:
+        """
+        Get a tree that can be changed, replacing a tree loaded from a snapshot with a 
+        regular SpasyTree the first time it is needed.
+
+        Args:
+            geocode (str): the geocode of the tree.
+
+        Returns:
+            SpasyTree: the tree.
+        """
+        tree = self._trees[geocode]
+        if isinstance(tree, MappedSpasyTree):
+            mapped_tree = tree
+            tree = mapped_tree.materialize()
+            mapped_tree.close()
+            self._trees[geocode] = tree
+        return tree
+
+    def materialize_tree(self, geocode: str) -> SpasyTree:
+        """
+        Get a tree as a regular SpasyTree (e.g. to serialize it), materializing it if it 
+        was loaded from a snapshot.
+
+        Args:
+            geocode (str): the geocode of the tree.
+
+        Returns:
+            SpasyTree: the tree.
+        """
+        return self._materialized(geocode)
+
+    def load_snapshot(self, geocode: str, path: str, lazy_merkle: bool=False, build: str='') -> None:
+        """
+        Replace a tree with one memory-mapped from a snapshot file (see Snapshot.write_snapshot).
+        Loading only maps the file, so the tree's root hash, recent updates and nodes can be 
+        served immediately; the tree is materialized the first time it has to change. The
+        snapshot must have the layout of the tree it replaces, since a tree with another layout
+        has other root hashes than the peers' trees. For the same reason, it must have been built
+        the same way (see save_snapshot).
+
+        Args:
+            geocode (str): the geocode of the tree.
+            path (str): the snapshot file.
+            lazy_merkle (bool, optional): defer Merkle hashing once the tree is materialized. 
+                                          Defaults to False.
+            build (str, optional): how the tree is expected to have been built. Defaults to ''.
+
+        Raises:
+            ValueError: if the snapshot holds another geocode's tree, was built another way, or its depth, 
+                        branching, leaf hash or recent updates queue size differ from those of the tree it replaces.
+        """
+        tree = MappedSpasyTree(path, lazy_merkle)
+        if tree.root_geocode != geocode:
+            tree.close()
+            raise ValueError(f'{path} holds the tree for geocode {tree.root_geocode}, not {geocode}')
+        if tree.build != build:
+            tree.close()
+            raise ValueError(f'{path} holds a tree built from {tree.build!r}, not {build!r}')
+        current = self._trees.get(geocode)
+        if current is not None:
+            for attribute in ('max_depth', 'branching', 'leaf_hash', 'max_number_recent_updates'):
+                if getattr(tree, attribute) != getattr(current, attribute):
+                    tree.close()
+                    raise ValueError(f'{path} holds a tree with {attribute} {getattr(tree, attribute)}, '
+                                     f'not {getattr(current, attribute)}')
+        self._trees[geocode] = tree
+
+    def save_snapshot(self, geocode: str, path: str, build: str='') -> None:
+        """
+        Write a tree to a snapshot file that later runs can load with load_snapshot.
+
+        Args:
+            geocode (str): the geocode of the tree.
+            path (str): the snapshot file.
+            build (str, optional): how the tree was built (e.g. the number of names and where they
+                                   came from), which load_snapshot checks. Defaults to ''.
+        """
+        write_snapshot(self._materialized(geocode), path, build)
 
     def build_tree(self, geocode: str, size: int=0, timestamp: bool=False) -> None:
         """Insert elements into the tree to automate the building of trees.
@@ -43,7 +152,7 @@ class Spasy:
         # generate a name with a geocode and insert it in the tree
         for i in range(size):
             name = self._generate_name() + self._generate_geocode(geocode)
-            self.add_data_to_tree(geocode,name,str(time.time()))
+            self.add_data_to_tree(geocode, name)
 
     def build_tree_from_file(self, geocode: str, filename: str, size: int, timestamp: bool=False) -> None:
         """
@@ -58,11 +167,14 @@ class Spasy:
                                         False otherwise. Defaults to False.
         """
 
+        named_data_list = []
+        timestamps = []
         if not timestamp:
             with open(filename, 'r') as file:
                 count = 0
                 while count <= size:
-                    self.add_data_to_tree(geocode, file.readline().strip())
+                    named_data_list.append(file.readline().strip())
+                    timestamps.append(self._clock.now())
                     count += 1
 
         else:
@@ -73,11 +185,12 @@ class Spasy:
                     # if the line is empty, we've reached the end of the file
                     if line == ['']:
                         break
-                    named_data = line[0]
-                    time_added = line[1]
-                    self.add_data_to_tree(geocode, named_data, time_added)
+                    named_data_list.append(line[0])
+                    timestamps.append(line[1])
                     count += 1
 
+        self.add_bulk_data_to_tree(geocode, named_data_list, timestamps)
+
     def _create_experiment_tree(self, size: int, max_length_name: int, timestamp: bool=False) -> None:
         """
         Create a file that builds randomly named data strings to be used to build a
@@ -240,8 +353,9 @@ class Spasy:
         current_set = set(self.trees[geocode].recent_updates)
         update_set = set(recent_changes)
 
-        # find differences
-        set_difference = update_set.difference(current_set)
+        # find differences; they are applied in timestamp order (the order of the hybrid logical clock 
+        # timestamps, which every user agrees on), so a later change to the same named data wins
+        set_difference = sorted(update_set.difference(current_set))
         set_intersection = update_set.intersection(current_set)
         print(f'SET INTERSECTION: {set_intersection}')
         print(f'SET DIFF: {set_difference}')
@@ -259,37 +373,99 @@ class Spasy:
                     self.add_data_to_tree(geocode, data, timestamp)
                 elif element[1] == 'd':
                     self.remove_data_from_tree(geocode, data, timestamp)
+                elif element[1] == 'r':
+                    self.remove_region_from_tree(geocode, data, timestamp)
             return True
         
         return False
+
+    def apply_changes(self, geocode: str, changes: list) -> None:
+        """
+        Apply, in order, the changes another user made since their tree had the same hash as ours
+        (see SpasyTree.changes_since).
+
+        Args:
+            geocode (str): the geocode of the tree that requires an update.
+            changes (list): the changes, oldest first, each a tuple of timestamp, action and named data.
+        """
+        for timestamp, action, data in changes:
+            if action == 'i':
+                self.add_data_to_tree(geocode, data, timestamp)
+            elif action == 'd':
+                self.remove_data_from_tree(geocode, data, timestamp)
+            elif action == 'r':
+                self.remove_region_from_tree(geocode, data, timestamp)
+
+    def apply_reconciliation(self, geocode: str, additions: set, deletions: set, recent_changes: list) -> None:
+        """
+        Apply the differences found by reconciling a tree with another user's tree (see Reconcile.reconcile),
+        used when update_tree finds no overlap between the recent changes.
+
+        Args:
+            geocode (str): the geocode of the reconciled tree.
+            additions (set): the named data to insert.
+            deletions (set): the named data to delete.
+            recent_changes (list): the other user's priority queue of recent changes.
+        """
+        tree = self._materialized(geocode)
+
+        # deletions come first so that older versions are removed before newer ones are inserted
+        # each difference is logged with the other user's update for it, if they still have it, so the recent
+        # updates overlap again
+        if recent_changes:
+            self._advance_clock(max(element[0] for element in recent_changes))
+        timestamp = self._clock.now()
+        remote_updates = {(element[1], element[2]): element for element in recent_changes}
+        for named_data in deletions:
+            tree.delete(tree.root, named_data, tree.root.length_geocode())
+            tree.add_to_recent_updates(remote_updates.get(('d', named_data), (timestamp, 'd', named_data)))
+        for named_data in additions:
+            tree.insert(named_data)
+            tree.add_to_recent_updates(remote_updates.get(('i', named_data), (timestamp, 'i', named_data)))
         
 
-    def add_data_to_tree(self, geocode: str, data_to_add: str, timestamp: str="") -> None:
+    def add_data_to_tree(self, geocode: str, data_to_add: str, timestamp: int | str="") -> None:
         """
         Inserts named data in the SpasyTree.
 
         Args:
             data_to_add (str): the named data to be inserted in the SpasyTree.
-            timestamp (str, optional): the timestamp from when the data was added 
+            timestamp (int | str, optional): the timestamp (see UpdateLog.to_nanoseconds) from when the data was added 
                                        to another tree. 
                                        Defaults to "", which occurs when the caller 
-                                       is the data's publisher.
+                                       is the data's publisher; the data is then timestamped by the clock.
         """
-        if timestamp == "":
-            timestamp = str(time.time())
-        self._trees[geocode].insert(data_to_add)
-        self.trees[geocode].add_to_recent_updates((timestamp, 'i', data_to_add))
+        timestamp = self._timestamp(timestamp)
+        tree = self._materialized(geocode)
+        tree.insert(data_to_add)
+        tree.add_to_recent_updates((timestamp, 'i', data_to_add))
 
-    def remove_data_from_tree(self, geocode: str, delete_data: str, timestamp: str="") -> None:
+    def add_bulk_data_to_tree(self, geocode: str, named_data_list: list, timestamps: list) -> None:
+        """
+        Inserts many pieces of named data in the SpasyTree at once. An empty tree is built 
+        bottom-up in a single pass (see SpasyTree.bulk_insert).
+
+        Args:
+            named_data_list (list): the named data to be inserted in the SpasyTree.
+            timestamps (list): the timestamp for each piece of named data.
+        """
+        tree = self._materialized(geocode)
+        tree.bulk_insert(named_data_list)
+        for named_data, timestamp in zip(named_data_list, timestamps):
+            tree.add_to_recent_updates((timestamp, 'i', named_data))
+        if timestamps:
+            self._advance_clock(max(to_nanoseconds(timestamp) for timestamp in timestamps))
+
+    def remove_data_from_tree(self, geocode: str, delete_data: str, timestamp: int | str="") -> None:
         """
         Deletes named data from the SpasyTree.
 
         Args:
             delete_data (str): the named data to delete.
-            timestamp (str, optional): the timestamp from when the data was deleted 
+            timestamp (int | str, optional): the timestamp (see UpdateLog.to_nanoseconds) from when the data was deleted 
                                        from another tree. 
                                        Defaults to "", which occurs when the caller is 
-                                       the one publishing the deletion. 
+                                       the one publishing the deletion; the deletion is then timestamped by the clock. 
         """
         data_to_delete = delete_data.lower()
         delete_geocode = delete_data.split('/')[-1]
@@ -300,22 +476,75 @@ class Spasy:
             return 
 
         else: 
-            if timestamp == "":
-                timestamp = time.time()
+            timestamp = self._timestamp(timestamp)
             print(f'DELETE: {timestamp, delete_data}')
 
-            self._trees[geocode].delete(self._trees[geocode].root, delete_data, self._trees[geocode].root.length_geocode())
-            self._trees[geocode].add_to_recent_updates((str(timestamp), 'd', delete_data))
+            tree = self._materialized(geocode)
+            tree.delete(tree.root, delete_data, tree.root.length_geocode())
+            tree.add_to_recent_updates((timestamp, 'd', delete_data))
+
+    def remove_region_from_tree(self, geocode: str, geocode_prefix: str, timestamp: int | str="") -> list:
+        """
+        Deletes all of the named data in a region (the geocodes starting with a geohash prefix) from 
+        the SpasyTree in one step (see SpasyTree.delete_prefix). A single update (a range tombstone with 
+        the action 'r' and the prefix as its data) is recorded, so peers also delete the region in one step.
+
+        Args:
+            geocode_prefix (str): the geohash prefix of the region.
+            timestamp (int | str, optional): the timestamp (see UpdateLog.to_nanoseconds) from when the region was 
+                                       deleted from another tree. 
+                                       Defaults to "", which occurs when the caller is 
+                                       the one publishing the deletion; the deletion is then timestamped by the clock.
+
+        Returns:
+            list: the named data that was deleted.
+        """
+        geocode_prefix = geocode_prefix.lower()
+        tree = self._materialized(geocode)
+        removed = tree.delete_prefix(geocode_prefix)
+        if not removed:
+            print(f"Sorry, but there is no data in the region '{geocode_prefix}' of the tree.")
+            return removed
+
+        timestamp = self._timestamp(timestamp)
+        print(f'DELETE REGION: {timestamp, geocode_prefix} ({len(removed)} names)')
+        tree.add_to_recent_updates((timestamp, 'r', geocode_prefix))
+        return removed
 
     
+    def _timestamp(self, timestamp: int | str) -> int:
+        """
+        Get the timestamp of a change: a new timestamp from the clock for this user's own change,
+        or the timestamp of another user's change, which the clock is advanced past.
+
+        Args:
+            timestamp (int | str): the timestamp of another user's change (see UpdateLog.to_nanoseconds), 
+                                   or "" for this user's own change.
+
+        Returns:
+            int: the timestamp.
+        """
+        if timestamp == "":
+            return self._clock.now()
+        timestamp = to_nanoseconds(timestamp)
+        self._advance_clock(timestamp)
+        return timestamp
+
+    def _advance_clock(self, timestamp: int) -> None:
+        """Advance the clock past another user's timestamp, unless the clock rejects it as out of range."""
+        try:
+            self._clock.update(timestamp)
+        except ValueError as error:
+            print(f"Not advancing the clock: {error}")
+
     ######### OTHER #########
-    def is_newer_tree(self, tree_geocode: str, sync_tree_hash: str) -> bool:
+    def is_newer_tree(self, tree_geocode: str, sync_tree_hash: bytes) -> bool:
         """
         When a Sync Interest is received, the hashcodes must be compared.
 
         Args:
             tree_geocode (str): the current tree's geocode.
-            sync_tree_hash (str): the root hashcode of a SpasyTree.
+            sync_tree_hash (bytes): the root hashcode (raw digest) of a SpasyTree.
 
         Returns:
             bool: False if they match;
@@ -328,25 +557,28 @@ class Spasy:
             # This is a newer version of the tree. Send an Interest packet.
             return True
 
-    def search(self, data_to_find: str) -> bool:
+    def search(self, geocode: str, data_to_find: str) -> bool:
         """
-        Find all of the geohashes in which the named data is stored.
+        Determine if the named data is stored in a tree.
 
         Args:
+            geocode (str): the geocode of the tree to search.
             data_to_find (str): the named data being sought.
 
         Returns:
-            list: a list of geohashes where the data is stored.
+            bool: True if the data is in the tree;
+                  False otherwise.
         """
-        return self._tree.find_data(data_to_find)
+        return self._trees[geocode].find_data(data_to_find)
     
-    def search_without_geocode(self, data_to_find: str, geocode_list: list | None = None) -> list:
+    def search_without_geocode(self, geocode: str, data_to_find: str, geocode_list: list | None = None) -> list:
         """
         Checks for data in the tree independently of the geocode it is associated with. For example,
         if a user is looking for /some/data, that may exist as /some/data/dpwhwts0123 and 
         /some/data/dpwhwt0bcqr. This method will find both.
 
         Args:
+            geocode (str): the geocode of the tree to search.
             data_to_find (str): the named data (independent of geocode) being sought.
             geocode_list (list | None, optional): a list of geocodes where the named data can be found. 
                                                   Defaults to None.
@@ -354,7 +586,8 @@ class Spasy:
         Returns:
             list: a list of geocodes where the named data can be found.
         """
-        return self._tree.find_data_without_geocode(self._tree.root, data_to_find, geocode_list)
+        tree = self._materialized(geocode)
+        return tree.find_data_without_geocode(tree.root, data_to_find, geocode_list)
     
     def gather_all_data_by_namespace(self, geocode: str) -> dict:
         """
@@ -364,7 +597,8 @@ class Spasy:
             dict: a dictionary containing all of the data in the tree
                   organized into namespaces.  
         """
-        return self._trees[geocode].find_data_by_namespace(self._trees[geocode].root)
+        tree = self._materialized(geocode)
+        return tree.find_data_by_namespace(tree.root)
     
     def gather_all_data_by_geocode(self, geocode: str) -> dict:
         """
@@ -374,18 +608,46 @@ class Spasy:
             dict: a dictionary containing all of the data in the tree
                   organized into geocodes. 
         """
-        return self._trees[geocode].find_data_by_geocode(self._trees[geocode].root)
+        tree = self._materialized(geocode)
+        return tree.find_data_by_geocode(tree.root)
+
+    def iter_data_by_namespace(self, geocode: str, namespace: str | None = None) -> Iterator[tuple[str, str]]:
+        """
+        Iterate over the data in a SpasyTree by namespace without building a dictionary of the whole tree.
+
+        Args:
+            geocode (str): the geocode of the tree.
+            namespace (str | None, optional): only iterate over this namespace. Defaults to None (all namespaces).
+
+        Yields:
+            tuple[str, str]: the namespace and a piece of named data in it.
+        """
+        yield from self._materialized(geocode).iter_data_by_namespace(namespace)
+
+    def iter_data_by_geocode(self, geocode: str, data_geocode: str | None = None) -> Iterator[tuple[str, str]]:
+        """
+        Iterate over the data in a SpasyTree by geocode without building a dictionary of the whole tree.
+
+        Args:
+            geocode (str): the geocode of the tree.
+            data_geocode (str | None, optional): only iterate over the data at this leaf geocode. 
+                                                 Defaults to None (all geocodes).
+
+        Yields:
+            tuple[str, str]: the leaf geocode and a piece of named data stored at it.
+        """
+        yield from self._materialized(geocode).iter_data_by_geocode(data_geocode)
     
     def can_request_item(self, action: str) -> bool:
         """
         Determine whether a Notification Interest is and insertion or deletion.
 
         Args:
-            named_data (str): the hierarchical name contained in a Notification Interest.
+            action (str): the action contained in a Notification Interest.
 
         Returns:
             bool: True, if there was an insertion to the tree.
-                  False, if there was a deletion from the tree. 
+                  False, if there was a deletion (of named data, 'd', or of a region, 'r') from the tree. 
         """
         if action == 'i':
             return True
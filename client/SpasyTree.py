@@ -1,27 +1,89 @@
+import heapq
+import math
+from itertools import count
+
 from Node import *
-from heapq import heappush, heappushpop, heapify
+from UpdateLog import UpdateLog, to_nanoseconds
+from Geohash import bounding_box, decode, distance, distance_to_box, farthest_distance_to_box
+from typing import Callable, Iterator
+
+
+# for each branching factor, maps each geohash character to a sort key for the child slot it is stored in
+_BUCKET_KEYS = {branching: str.maketrans({char: chr(ord('0') + slot) for char, slot in slots.items()})
+                for branching, slots in CHILD_SLOTS.items()}
+
 
+def _name_key(named_data: str) -> str:
+    """The key of a name in the index of names: the name without its version and geocode (see split_version)."""
+    end = named_data.rfind('/')
+    start = named_data.rfind('/', 0, end) if end > 0 else -1
+    if start >= 0 and named_data.startswith('_v', start + 1) and named_data[start + 3:end].isdigit():
+        return named_data[:start]
+    return named_data[:end] if end >= 0 else named_data
 
 
 class SpasyTree:
     """
     A Merkle-based quaternary tree used as a dataset representation for 
     Spatial Sync (SPASY), a Named Data Networking (NDN) Sync 
-    protocol.
+    protocol. The tree can also be built with 32 children per node 
+    (one per geohash character).
 
     Assumes the use of Geohash.
     """
 
-    def __init__(self, max_depth: int, max_queue: int=30, node: Node=None) -> None:
+    def __init__(self, max_depth: int, max_queue: int=30, node: Node=None, lazy_merkle: bool=False,
+                 leaf_hash: str=LEAF_HASH_SEQUENTIAL, branching: int=4, max_change_log: int=1000,
+                 region: str | None = None) -> None:
         """
         Args:
             node (Node, optional): a node object representing the tree's root. 
                                    Defaults to None.
+            lazy_merkle (bool, optional): defer Merkle hashing; changes only mark the path to the root
+                                          as dirty, and the dirty nodes are rehashed once, bottom-up, 
+                                          the next time the root hash is read. Defaults to False.
+            leaf_hash (str, optional): the scheme used to hash leaves, one of LEAF_HASHES. 'additive' 
+                                       updates a leaf's hash in constant time when one name is added
+                                       or removed. It is sent with the tree, so peers that join 
+                                       the tree use the same scheme. Defaults to 'sequential'.
+            branching (int, optional): the number of children per node, one of the keys of CHILD_SLOTS.
+                                       4 groups the geohash characters into quadtree buckets, so nodes
+                                       hold several geocodes; 32 gives every geohash character its own
+                                       child. The root must be created with the same branching. 
+                                       Defaults to 4.
+            max_change_log (int, optional): the number of changes kept in the sequence-numbered update log,
+                                            which lets a peer be sent only the changes made since a root 
+                                            hash it has (see changes_since). The recent updates are the 
+                                            newest max_queue changes of the same log. Defaults to 1000.
+            region (str | None, optional): for a partial tree (e.g. one joined for a sub-geohash region), the 
+                                           geohash prefix whose subtree is kept. The rest of the tree is a 
+                                           skeleton of stub nodes that only hold their digests, and changes 
+                                           outside the region are ignored. Defaults to None (the whole tree).
         """
+        if leaf_hash not in LEAF_HASHES:
+            raise ValueError(f'Unknown leaf hash scheme {leaf_hash}, expected one of {LEAF_HASHES}')
+        if branching not in CHILD_SLOTS:
+            raise ValueError(f'Unsupported branching factor {branching}, expected one of {tuple(CHILD_SLOTS)}')
+        if node is not None and node.branching != branching:
+            raise ValueError(f'The root has {node.branching} children per node but the tree expects {branching}')
+
         self._root = node 
         self._max_depth = max_depth
-        self._recent_updates = [] # a list that will be treated as a heap
-        self._max_number_recent_updates = max_queue # maximum size of priority queue
+        self._max_number_recent_updates = max_queue # number of updates shared as the recent updates
+        self._update_log = UpdateLog(max(max_queue, max_change_log, 1)) # ring buffer of the latest changes
+        self._hash_positions = {} # checkpointed root hash -> sequence number of the first change made after it
+        self._lazy_merkle = lazy_merkle
+        self._leaf_hash = leaf_hash
+        self._branching = branching
+        self._region = region
+        self._leaves = {} # full leaf geocode -> the leaf Node storing its data
+        self._names = {} # unversioned name without geocode -> geocodes of the leaves storing it
+        self._by_namespace = {} # first name component -> the named data in that namespace
+        self._by_geocode = {} # leaf geocode -> the named data stored at that geocode
+        self._strings = {} # interned stored names and leaf geocodes, so nodes, indexes and the update log share one copy
+        if node is not None:
+            node.leaf_hash = leaf_hash
+            self._rebuild_indexes()
         
  
     ######### ACCESSORS #########
@@ -41,12 +103,78 @@ class SpasyTree:
     
     @property
     def recent_updates(self) -> list:
-        """Get the recent updates that have been made to SPASY's tree."""
-        return self._recent_updates
+        """Get the recent updates that have been made to SPASY's tree, oldest first."""
+        return self._update_log.latest(self._max_number_recent_updates)
     
     @property
     def max_number_recent_updates(self) -> int:
         return self._max_number_recent_updates
+
+    @property
+    def update_log(self) -> UpdateLog:
+        """Get the log of the latest changes made to the tree."""
+        return self._update_log
+
+    def changes_since(self, root_hash: bytes, until_hash: bytes | None = None) -> list | None:
+        """
+        Get the changes that turn the tree with one checkpointed root hash into the tree with another.
+
+        Args:
+            root_hash (bytes): the root hash (raw digest) of the older tree, normally a peer's current hash.
+            until_hash (bytes | None, optional): the root hash of the newer tree. Defaults to None, 
+                                                 which is the tree's latest change.
+
+        Returns:
+            list | None: the updates (in the same format as the recent updates), oldest first;
+                         or None if either hash was never checkpointed, or the changes between them 
+                         are no longer in the log.
+        """
+        start = self._hash_positions.get(root_hash)
+        end = self._update_log.next_sequence if until_hash is None else self._hash_positions.get(until_hash)
+        if start is None or end is None or start > end:
+            return None
+        # None if the log no longer reaches back to the older tree
+        return self._update_log.entries_since(start, end)
+
+    @property
+    def leaf_hash(self) -> str:
+        """Get the scheme used to hash the tree's leaves."""
+        return self._leaf_hash
+
+    @property
+    def branching(self) -> int:
+        """Get the number of children per node."""
+        return self._branching
+
+    @property
+    def lazy_merkle(self) -> bool:
+        """Get whether Merkle hashes are recomputed lazily when the root hash is read."""
+        return self._lazy_merkle
+
+    @property
+    def region(self) -> str | None:
+        """Get the geohash prefix kept by a partial tree, or None if the whole tree is kept."""
+        return self._region
+
+    def in_region(self, geocode: str) -> bool:
+        """
+        Check if a geocode (or geocode prefix) lies in the region kept by a partial tree. 
+        Regions follow the tree's child slots, so in a quaternary tree a region also holds
+        the geocodes that share its last character's bucket.
+
+        Args:
+            geocode (str): the geocode.
+
+        Returns:
+            bool: True if the geocode is in the region, or the tree is not partial;
+                  False otherwise.
+        """
+        if self._region is None:
+            return True
+        start = self._root.length_geocode()
+        end = min(len(geocode), len(self._region))
+        bucket_keys = _BUCKET_KEYS[self._branching]
+        return geocode[start:end].translate(bucket_keys) == self._region[start:end].translate(bucket_keys)
     
     def find_data(self, named_data: str) -> bool:
         """
@@ -59,22 +187,9 @@ class SpasyTree:
             bool: True if in the tree;
                   False otherwise.
         """
-        current_node = self._root
         named_data = named_data.lower()
-        geocode = named_data.split('/')[-1]
-        current_level = current_node.length_geocode()
-        while current_level <= self._max_depth + 1:
-            for child in current_node.children:
-                if child is not None:
-                    if geocode[:current_level] in child.geocode:
-                        # we found the child
-                        if named_data in child.data:
-                            return True
-                        else:
-                            current_node = child
-                            break
-            current_level += 1
-        return False
+        leaf = self._leaves.get(named_data.split('/')[-1])
+        return leaf is not None and leaf.has_data(named_data)
     
     def find_data_without_geocode(self, node: Node, named_data_without_geocode: str,
                                   geocode_list: list | None = None) -> list:
@@ -90,6 +205,7 @@ class SpasyTree:
 
         Returns:
             list: a list of geocodes identifying where the data (regardless of geocode) is located.
+                  Answered from the tree's index of names, so the tree is not traversed.
         """
         if geocode_list is None:
             geocode_list = []
@@ -97,22 +213,20 @@ class SpasyTree:
         named_data_without_geocode = named_data_without_geocode.lower()
 
         if node is not None:
-            if node.in_data(named_data_without_geocode):
-                # because we are using buckets, we will add each possible geocode individually
-                for code in node.geocode:
-                    if code not in geocode_list:
-                        geocode_list.append(code)
-            else:
-                for child in node.children:
-                    self.find_data_without_geocode(child, named_data_without_geocode, geocode_list)
+            # the index narrows the search to the geocodes storing some version of the name
+            for geocode in sorted(self._names.get(_name_key(named_data_without_geocode + '/'), ())):
+                if geocode in geocode_list or not any(geocode.startswith(code) for code in node.geocode):
+                    continue
+                if self._leaves[geocode].has_data(named_data_without_geocode + '/' + geocode):
+                    geocode_list.append(geocode)
 
         return geocode_list
 
     # TODO: it is possible it makes more sense for this to be part of Spasy
     def find_data_by_namespace(self, node: Node, data_by_namespace: dict | None = None) -> dict:
         """
-        Traverses the tree to gather all of the namespaces and their data. 
-        This can be used by applications to allow a user to filter the namespaces they want.
+        Gathers all of the namespaces and their data from the tree's namespace view, which insert 
+        and delete keep up to date, so the tree is not traversed. This can be used by applications to allow a user to filter the namespaces they want.
 
         Args:
             node (Node): the node being started at.
@@ -126,35 +240,16 @@ class SpasyTree:
         if data_by_namespace is None:
             data_by_namespace = dict()
 
-        current_node = node
-
-        # recursion will stop once all nodes have been considered
-        for child in current_node.children:
-            # if there is a child that stores data
-            if child is not None:
-                if child.data:
-                    for name in child.data:
-                        string_split = name.split('/')
-                        namespace = string_split[1]
-                        data_to_add = name
-                        # if already in the dictionary
-                        if namespace in data_by_namespace:
-                            data_by_namespace[namespace].add(data_to_add)
-                        
-                        # if the namespace doesn't exist in the dictionary, create it, and add the data
-                        else:
-                            data_by_namespace[namespace] = {data_to_add}
-                # recurse
-                else:
-                    current_node = child
-                    self.find_data_by_namespace(child, data_by_namespace)
+        for namespace, name in self.iter_data_by_namespace(node=node):
+            data_by_namespace.setdefault(namespace, set()).add(name)
     
         return data_by_namespace
     
     # TODO: it is possible it makes more sense for this to be part of Spasy
     def find_data_by_geocode(self, node: Node, data_by_geocode: dict | None = None) -> dict:
         """
-        Reorganize the SpasyTree into a dictionary using geocodes.
+        Reorganize the SpasyTree into a dictionary using geocodes. Built from the tree's geocode view, 
+        which insert and delete keep up to date, so the tree is not traversed.
 
         Args:
             node (Node): the root of the tree.
@@ -168,36 +263,235 @@ class SpasyTree:
         if data_by_geocode is None:
             data_by_geocode = dict()
 
-        current_node = node
-
-        # recursion will stop once all nodes have been considered
-        for child in current_node.children:
-            # if there is a child that stores data
-            if child is not None:
-                if child.data:
-                    for name in child.data:
-                        string_split = name.split('/')
-                        geocode = string_split[-1]
-                        data_to_add = name
-                        # if already in the dictionary
-                        if geocode in data_by_geocode:
-                            data_by_geocode[geocode].add(data_to_add)
-                        
-                        # if the geocode doesn't exist in the dictionary, create it, and add the data
-                        else:
-                            data_by_geocode[geocode] = {data_to_add}
-                # recurse
-                else:
-                    current_node = child
-                    self.find_data_by_geocode(child, data_by_geocode)
+        for geocode, name in self.iter_data_by_geocode(node=node):
+            data_by_geocode.setdefault(geocode, set()).add(name)
     
         return data_by_geocode
-    
+
+    def iter_data_by_namespace(self, namespace: str | None = None, node: Node | None = None) -> Iterator[tuple[str, str]]:
+        """
+        Iterate over the named data in the tree by namespace, without materializing the tree. 
+        The view is kept up to date as data is inserted and deleted.
+
+        Args:
+            namespace (str | None, optional): only iterate over this namespace. Defaults to None (all namespaces).
+            node (Node | None, optional): only include data stored below this node. Defaults to None (the root).
+
+        Yields:
+            tuple[str, str]: the namespace and a piece of named data in it.
+        """
+        namespaces = self._by_namespace if namespace is None else {namespace: self._by_namespace.get(namespace, ())}
+        for current_namespace, names in namespaces.items():
+            for name in names:
+                if self._in_subtree(node, name.split('/')[-1]):
+                    yield current_namespace, name
+
+    def iter_data_by_geocode(self, geocode: str | None = None, node: Node | None = None) -> Iterator[tuple[str, str]]:
+        """
+        Iterate over the named data in the tree by leaf geocode, without materializing the tree.
+        The view is kept up to date as data is inserted and deleted.
+
+        Args:
+            geocode (str | None, optional): only iterate over this leaf geocode. Defaults to None (all geocodes).
+            node (Node | None, optional): only include data stored below this node. Defaults to None (the root).
+
+        Yields:
+            tuple[str, str]: the leaf geocode and a piece of named data stored at it.
+        """
+        geocodes = self._by_geocode if geocode is None else {geocode: self._by_geocode.get(geocode, ())}
+        for current_geocode, names in geocodes.items():
+            if self._in_subtree(node, current_geocode):
+                for name in names:
+                    yield current_geocode, name
+
+    def _in_subtree(self, node: Node | None, geocode: str) -> bool:
+        """Check if a leaf geocode lies below a node (every geocode lies below the root)."""
+        if node is None or node is self._root:
+            return True
+        return any(geocode.startswith(code) for code in node.geocode)
+
+    def query_box(self, min_latitude: float, min_longitude: float, max_latitude: float,
+                  max_longitude: float) -> Iterator[str]:
+        """
+        Iterate over the named data located in a bounding box (named data is located at the center
+        of its geocode's cell). Only the subtrees whose cells intersect the box are visited, and the
+        named data is yielded as it is found. The tree should not change during the iteration.
+
+        Args:
+            min_latitude (float): the box's minimum latitude in degrees.
+            min_longitude (float): the box's minimum longitude in degrees.
+            max_latitude (float): the box's maximum latitude in degrees.
+            max_longitude (float): the box's maximum longitude in degrees.
+
+        Yields:
+            str: a piece of named data in the box.
+        """
+        def intersects(cell: tuple) -> bool:
+            return (cell[0] <= max_latitude and cell[2] >= min_latitude and 
+                    cell[1] <= max_longitude and cell[3] >= min_longitude)
+
+        def contains(position: tuple) -> bool:
+            return min_latitude <= position[0] <= max_latitude and min_longitude <= position[1] <= max_longitude
+
+        def covers(cell: tuple) -> bool:
+            return contains(cell[:2]) and contains(cell[2:])
+
+        yield from self._query(intersects, contains, covers)
+
+    def query_radius(self, latitude: float, longitude: float, radius: float) -> Iterator[str]:
+        """
+        Iterate over the named data located within a distance of a position (named data is located 
+        at the center of its geocode's cell). Only the subtrees whose cells come within the distance
+        are visited, and the named data is yielded as it is found. The tree should not change during 
+        the iteration.
+
+        Args:
+            latitude (float): the position's latitude in degrees.
+            longitude (float): the position's longitude in degrees.
+            radius (float): the distance in meters.
+
+        Yields:
+            str: a piece of named data within the distance.
+        """
+        def contains(position: tuple) -> bool:
+            return distance(latitude, longitude, *position) <= radius
+
+        yield from self._query(lambda cell: distance_to_box(latitude, longitude, cell) <= radius, contains,
+                               lambda cell: farthest_distance_to_box(latitude, longitude, cell) <= radius)
+
+    def query_nearest(self, latitude: float, longitude: float, k: int) -> list[str]:
+        """
+        Find the k pieces of named data located nearest to a position (named data is located at 
+        the center of its geocode's cell). The subtrees are searched best-first, in the order of the
+        distance to their nearest cell. The number of named data in each subtree (see Node.count) 
+        bounds the distance to the k-th nearest piece as soon as enough subtrees are found, so the 
+        subtrees beyond it are pruned without being visited.
+
+        Args:
+            latitude (float): the position's latitude in degrees.
+            longitude (float): the position's longitude in degrees.
+            k (int): the number of pieces of named data to find.
+
+        Returns:
+            list[str]: up to k pieces of named data, nearest first.
+        """
+        nearest = []
+        if self._root is None or k <= 0:
+            return nearest
+
+        # the heap holds subtrees by the distance to their nearest cell and named data (with no subtree)
+        # by its distance; the counter breaks ties in the order they were found
+        order = count()
+        queue = [(0.0, next(order), self._root, None)]
+        bound = math.inf # the k-th nearest piece of named data is no farther than this
+        while queue and len(nearest) < k:
+            found_distance, _, node, named_data = heapq.heappop(queue)
+            if found_distance > bound:
+                break
+            if node is None:
+                nearest.append(named_data)
+                continue
+
+            # each entry found holds named data no farther than its farthest distance, so the pieces found
+            # so far and the nearest entries holding the rest of the k bound the k-th nearest piece
+            entries = []
+            positions = {}
+            for named_data in node.data:
+                geocode = named_data[named_data.rfind('/') + 1:]
+                if geocode not in positions:
+                    positions[geocode] = distance(latitude, longitude, *decode(geocode))
+                entries.append((positions[geocode], positions[geocode], None, named_data, 1))
+            for child in node.children:
+                if child is not None and child.count:
+                    cells = [bounding_box(geocode) for geocode in child.geocode]
+                    entries.append((min(distance_to_box(latitude, longitude, cell) for cell in cells),
+                                    max(farthest_distance_to_box(latitude, longitude, cell) for cell in cells),
+                                    child, None, child.count))
+
+            missing = k - len(nearest)
+            for _, farthest, _, _, entry_count in sorted(entries, key=lambda entry: entry[1]):
+                missing -= entry_count
+                if missing <= 0:
+                    bound = min(bound, farthest)
+                    break
+            for nearest_distance, _, child, named_data, _ in entries:
+                if nearest_distance <= bound:
+                    heapq.heappush(queue, (nearest_distance, next(order), child, named_data))
+        return nearest
+
+    def _query(self, intersects: Callable[[tuple], bool], contains: Callable[[tuple], bool], 
+               covers: Callable[[tuple], bool]) -> Iterator[str]:
+        """
+        Walk the subtrees whose cells intersect a spatial query, yielding the named data whose
+        positions the query contains. Once the query covers a subtree's cells, all of the subtree's
+        named data is yielded without checking any more cells or positions.
+
+        Args:
+            intersects (Callable): checks if a cell (see Geohash.bounding_box) intersects the query.
+            contains (Callable): checks if a position (see Geohash.decode) is in the query.
+            covers (Callable): checks if a cell lies entirely in the query.
+
+        Yields:
+            str: a piece of named data in the query.
+        """
+        if self._root is None:
+            return
+
+        # the geocodes whose cells intersect the query, and whether the query covers them; a cell
+        # is only checked if its parent's cell intersects the query without being covered by it
+        root_geocodes = self._root.geocode or {''}
+        in_query = {geocode[:-1]: False for geocode in root_geocodes}
+        stack = [(self._root, self._classify(root_geocodes, in_query, intersects, covers))]
+        while stack:
+            node, state = stack.pop()
+            if state is None:
+                continue
+            if state:
+                yield from node.data
+                stack.extend((child, True) for child in reversed(node.children) if child is not None)
+                continue
+
+            for named_data in node.data:
+                geocode = named_data[named_data.rfind('/') + 1:]
+                covered = in_query.get(geocode)
+                if covered is False:
+                    # names at the same geocode share its position, so it is only checked once
+                    covered = in_query[geocode] = contains(decode(geocode)) or None
+                if covered:
+                    yield named_data
+            for child in reversed(node.children):
+                if child is not None:
+                    stack.append((child, self._classify(child.geocode, in_query, intersects, covers)))
+
+    @staticmethod
+    def _classify(geocodes: set, in_query: dict, intersects: Callable[[tuple], bool],
+                  covers: Callable[[tuple], bool]) -> bool | None:
+        """Record which of a node's geocodes are in a query, returning if the query covers the node (None if it misses it)."""
+        found = False
+        covered = True
+        for geocode in geocodes:
+            cell_covered = in_query.get(geocode[:-1])
+            if cell_covered is None:
+                covered = False
+                continue
+            if not cell_covered:
+                cell = bounding_box(geocode)
+                if not intersects(cell):
+                    covered = False
+                    continue
+                cell_covered = covers(cell)
+            in_query[geocode] = cell_covered
+            found = True
+            covered = covered and cell_covered
+        return covered if found else None
+
     def delete(self, node: Node, data_to_delete: str, current_position: int) -> bool:
         """
-        Removes a specific piece of named data from the tree.
+        Removes a specific piece of named data from the tree, pruning any nodes left empty.
+        The leaf holding the data is found through the leaf index, so only its ancestors are visited.
 
         Args:
+            node (Node): the node to start from (normally the root).
             data_to_delete (str): The named data to be removed.
             current_position (int): The length of the geocode being considered.
 
@@ -205,56 +499,163 @@ class SpasyTree:
             bool: True if it is safe to delete the data;
                   False otherwise.
         """
-        # CASE 1: Trivial case - the data to be deleted isn't in the tree
         data_to_delete = data_to_delete.lower()
         delete_geocode = data_to_delete.split('/')[-1]
 
-        siblings = node.number_children()
-        next_position = current_position + 1
-        for i in range(len(node.children)):
-            child_node = node.children[i]
-            if child_node is None:
+        # the leaf is looked up directly; it must lie below the node we were asked to start from
+        leaf = self._leaves.get(delete_geocode)
+        if leaf is None or leaf is node:
+            return False
+        if node is not self._root and delete_geocode[:current_position] not in node.geocode:
+            return False
+        if not leaf.delete_data(data_to_delete, rehash=False):
+            return False
+        self._unindex_data(data_to_delete)
+
+        # prune the emptied leaf and every ancestor it leaves without children
+        current_node = leaf
+        while current_node is not node and not current_node.data and current_node.number_children() == 0:
+            parent = current_node.parent
+            parent.remove_child(parent.slot(next(iter(current_node.geocode))[-1]))
+            if current_node is leaf:
+                for geocode in leaf.geocode:
+                    del self._leaves[geocode]
+                    self._strings.pop(geocode, None)
+            current_node = parent
+        self._update_merkle(current_node)  # removing data or a child requires an update to hashes
+        return current_node is node and node.number_children() == 0
+
+    def delete_prefix(self, geocode_prefix: str) -> list:
+        """
+        Removes all of the named data whose geocodes start with a geohash prefix (e.g. to clear
+        a region) in one step. A subtree that lies wholly in the region is detached as a whole,
+        only the nodes that hold both data in the region and data outside of it (e.g. the buckets
+        of a quaternary tree) are filtered, and each changed node is rehashed once.
+
+        Args:
+            geocode_prefix (str): the geohash prefix of the region.
+
+        Returns:
+            list: the named data that was removed.
+        """
+        removed = []
+        if len(geocode_prefix) <= self._max_depth + 1:
+            self._delete_prefix_below(self._root, geocode_prefix.lower(), removed)
+        return removed
+
+    def _delete_prefix_below(self, node: Node, geocode_prefix: str, removed: list) -> bool:
+        """
+        Remove the named data whose geocodes start with a prefix from below (and in) a node,
+        pruning the children left empty and rehashing the node after its children.
+
+        Args:
+            node (Node): the root of the subtree.
+            geocode_prefix (str): the geohash prefix of the region.
+            removed (list): collects the named data that was removed.
+
+        Returns:
+            bool: True if the subtree changed;
+                  False otherwise.
+        """
+        changed = False
+        if node.data:
+            for named_data in [named_data for named_data in node.data
+                               if named_data[named_data.rfind('/') + 1:].startswith(geocode_prefix)]:
+                node.delete_data(named_data, rehash=False)
+                self._unindex_data(named_data)
+                removed.append(named_data)
+                changed = True
+
+        for slot, child in enumerate(node.children):
+            if child is None:
                 continue
-            # Case 2: the child node has the right geocode, but it has siblings, so we can't delete its parent node
-            elif child_node is not None and delete_geocode in child_node.geocode:
-                child_node.delete_data(data_to_delete)
-                # if the child has no data, we set it to None, but we return True if there is no sibling, False otherwise
-                if not child_node.data and siblings > 1:
-                    node.remove_child(i)
-                    self._update_merkle(node) # removing a child requires an update to hashes
-                    return False
-                elif not child_node.data:
-                    node.remove_children()
-                    self._update_merkle(node)              
-                    return True
-                else:
-                    # there is still data, so we calculate a new hash
-                    self._update_merkle(child_node)  # the child remains, so we need to update the hash
-                    return False
-  
-            # the next position stores the next geocode in the path to the geocode that holds the data
-            elif child_node is not None:
-                for code in child_node.geocode:
-                    if code[0:next_position] == delete_geocode[0:next_position]:
-                        safe_to_delete = self.delete(child_node, data_to_delete, next_position) 
-                        # Case 3: if there is only one geocode, we can safely delete
-                        if safe_to_delete:
-                            node.remove_child(i)
-                            self._update_merkle(node) 
-                            #check if there are still children
-                            for child in node.children:
-                                if child is not None:
-                                    return False
-                            return True
-                        else:
-                            return False
+            if all(geocode.startswith(geocode_prefix) for geocode in child.geocode):
+                # the whole subtree is in the region
+                self._unindex_subtree(child, removed)
+                node.remove_child(slot)
+                changed = True
+            elif (any(geocode.startswith(geocode_prefix) or geocode_prefix.startswith(geocode) for geocode in child.geocode)
+                  and self._delete_prefix_below(child, geocode_prefix, removed)):
+                if not child.data and child.number_children() == 0:
+                    self._unindex_subtree(child, removed)
+                    node.remove_child(slot)
+                changed = True
+
+        if changed:
+            if self._lazy_merkle:
+                node.invalidate()
             else:
-                return True
+                node.generate_hash()
+        return changed
+
+    def _unindex_subtree(self, node: Node, removed: list) -> None:
+        """Remove the named data and leaves of a subtree that is being detached from the indexes."""
+        leaf_level = self._max_depth + 1
+        stack = [node]
+        while stack:
+            current_node = stack.pop()
+            for named_data in current_node.data:
+                self._unindex_data(named_data)
+            removed.extend(current_node.data)
+            if current_node.length_geocode() == leaf_level:
+                for geocode in current_node.geocode:
+                    if self._leaves.get(geocode) is current_node:
+                        del self._leaves[geocode]
+                        self._strings.pop(geocode, None)
+            stack.extend(child for child in current_node.children if child is not None)
 
     ######### MUTATORS #########
     @root.setter
     def root(self, new_root: Node):
         self._root = new_root
+        self._rebuild_indexes()
+
+    def adopt(self, new_root: Node) -> None:
+        """
+        Make a node the root without rebuilding the lookup indexes, which must already hold 
+        every leaf below it (see index_leaf).
+
+        Args:
+            new_root (Node): the new root.
+        """
+        if new_root.branching != self._branching:
+            raise ValueError(f'The root has {new_root.branching} children per node but the tree expects {self._branching}')
+        new_root.leaf_hash = self._leaf_hash
+        self._root = new_root
+
+    def update_stub(self, parent: Node, slot: int, digest: bytes | None) -> None:
+        """
+        Give a stub node outside a partial tree's region (see region) a peer's digest for it,
+        creating the stub if the peer has a new branch there or removing it if the peer no
+        longer has one, then update the hashes above it.
+
+        Args:
+            parent (Node): the stub's parent.
+            slot (int): the stub's slot in the parent.
+            digest (bytes | None): the peer's digest, or None if the peer has no branch there.
+        """
+        stub = parent.children[slot]
+        if stub is not None and (stub.data or stub.number_children()):
+            raise ValueError(f'The node at {next(iter(stub.geocode))} holds data, so it is not a stub')
+        if stub is not None and stub.hashcode == digest:
+            return
+
+        if digest is None:
+            parent.remove_child(slot)
+        else:
+            if stub is None:
+                geocode = next(iter(parent.geocode)) + next(char for char, char_slot in CHILD_SLOTS[self._branching].items()
+                                                            if char_slot == slot)
+                stub = Node(geocode, self._leaf_hash, self._branching)
+                parent.add_child(stub)
+            stub.restore([], digest)
+        self._update_merkle(parent)
+
+    @update_log.setter
+    def update_log(self, update_log: UpdateLog) -> None:
+        """Replace the update log (e.g. with one restored from a snapshot), dropping the checkpoints."""
+        self._update_log = update_log
+        self._hash_positions = {}
 
     @max_number_recent_updates.setter
     def max_number_recent_updates(self, value: int) -> None:
@@ -262,21 +663,35 @@ class SpasyTree:
 
     def add_to_recent_updates(self, updated_item: tuple) -> None:        
         """
-        Add tuples containing timestamps, actions, and new_items to a priority queue of 
-        recent changes. The oldest element is removed when new elements are added to the 
-        priority queue.
+        Add tuples containing timestamps, actions, and new_items to the update log. The 
+        oldest update (and the checkpoints that rely on it) is dropped once the log is full.
 
         Args:
-            updated_item (tuple): contains a timestamp, action (i.e., 'i' or 'd'),
-                                  and the data being inserted or deleted. 
+            updated_item (tuple): contains a timestamp (integer nanoseconds, or seconds as 
+                                  a float or string), action (i.e., 'i', 'd' or 'r' for a region 
+                                  deleted with delete_prefix), and the data being inserted or 
+                                  deleted (the geohash prefix of a deleted region). 
         """
-        # if the priority queue is larger than the default size, pop an element while pushing
-        if len(self.recent_updates) >= self._max_number_recent_updates:
-            heappushpop(self.recent_updates, updated_item)
-        # just push an element
-        else:
-            heappush(self.recent_updates, updated_item)
+        timestamp, action, named_data = updated_item
+        named_data = named_data.lower()
+        self._update_log.append(to_nanoseconds(timestamp), action, self._strings.get(named_data, named_data))
 
+        if len(self._hash_positions) > self._update_log.capacity + 1:
+            oldest = self._update_log.first_sequence
+            self._hash_positions = {root_hash: sequence for root_hash, sequence in self._hash_positions.items()
+                                    if sequence >= oldest}
+
+    def checkpoint(self) -> bytes:
+        """
+        Record the current root hash at the current position of the update log, so peers 
+        with a tree with this hash can later be sent just the changes made since.
+
+        Returns:
+            bytes: the root hash (raw digest).
+        """
+        root_hash = self._root.hashcode
+        self._hash_positions[root_hash] = self._update_log.next_sequence
+        return root_hash
 
     def insert(self, named_data: str) -> None:
         """
@@ -287,80 +702,248 @@ class SpasyTree:
             named_data (str): the data to insert in the tree
             depth (int): the maximum depth of the tree 
         """
+        named_data = named_data.lower()
+        insert_geocode = named_data[named_data.rfind('/') + 1:]
+
+        if not self._belongs_in_tree(insert_geocode):
+            return
+        insert_geocode = self._intern(insert_geocode)
+        
+        leaf = self._leaves.get(insert_geocode)
+        if leaf is None:
+            leaf = self._insert_path(insert_geocode)
+        replaced = leaf.stored_data(named_data)
+        if leaf.insert_data(named_data, rehash=False):
+            self._index_data(named_data, replaced)
+            self._update_merkle(leaf)
+
+    def _insert_path(self, insert_geocode: str) -> Node:
+        """
+        Create (or join) the nodes along the path to a new leaf geocode.
+
+        Args:
+            insert_geocode (str): the geocode of the leaf.
+
+        Returns:
+            Node: the leaf that will store the geocode's data.
+        """
         current_node = self._root
         current_level = self._root.length_geocode()
-        named_data = named_data.lower()
-        insert_geocode = named_data.split('/')[-1].lower()
-        start_level = current_level
+
+        # each geocode character selects the child slot to follow
+        while current_level <= self._max_depth:
+            current_level += 1  # we need to move down the tree
+            geocode_to_add = insert_geocode[0:current_level]
+            index = current_node.slot(insert_geocode[current_level - 1])
+            child = current_node.children[index]
+
+            # we must create the child or add this geocode to the existing node in its slot
+            if child is None:
+                node_to_insert = Node(geocode_to_add, self._leaf_hash, self._branching)  # the node to be added to the tree
+                current_node.add_child(node_to_insert)
+            else:
+                child.add_geocode(geocode_to_add)
+            current_node = current_node.children[index]
+
+        # we have reached the deepest level of the tree, which is where the data is stored
+        self._leaves[insert_geocode] = current_node
+        return current_node
+    
+    def bulk_insert(self, named_data_list: list) -> None:
+        """
+        Build the tree from many pieces of named data in one bottom-up pass. The names are
+        sorted by the buckets of their geocodes (stably, so names sharing a leaf keep their order),
+        so each leaf and internal node is created once and hashed exactly once after all of
+        its data or children are in place. The result is identical to inserting the names one
+        at a time. Falls back to individual insertion if the tree already holds data.
+
+        Args:
+            named_data_list (list): the named data to insert in the tree.
+        """
+        if self._root.number_children() > 0:
+            for named_data in named_data_list:
+                self.insert(named_data)
+            return
+
+        start_level = self._root.length_geocode()
+        bucket_keys = _BUCKET_KEYS[self._branching]
+        entries = []
+        for named_data in named_data_list:
+            named_data = named_data.lower()
+            insert_geocode = named_data[named_data.rfind('/') + 1:]
+            if self._belongs_in_tree(insert_geocode):
+                insert_geocode = self._intern(insert_geocode)
+                entries.append((insert_geocode[start_level:].translate(bucket_keys), insert_geocode, named_data))
+        entries.sort(key=lambda entry: entry[0])
+
+        # path[i] is the open node at level start_level + i, and path_key is the bucket path leading to it
+        path = [self._root]
+        path_key = ''
+        for key, insert_geocode, named_data in entries:
+            if key != path_key:
+                # hash the nodes that are not on the new path; all of their data and children are in place
+                shared = 0
+                while shared < len(path_key) and key[shared] == path_key[shared]:
+                    shared += 1
+                while len(path) > shared + 1:
+                    path.pop().generate_hash()
+
+                for level in range(start_level + shared + 1, len(insert_geocode) + 1):
+                    node_to_insert = Node(insert_geocode[:level], self._leaf_hash, self._branching)
+                    index = path[-1].add_child(node_to_insert)
+                    path.append(path[-1].children[index])
+                path_key = key
+
+            # every geocode on the path belongs to the bucket node at its level
+            for level in range(1, len(path)):
+                path[level].add_geocode(insert_geocode[:start_level + level])
+            replaced = path[-1].stored_data(named_data)
+            if path[-1].insert_data(named_data, rehash=False):
+                self._index_data(named_data, replaced)
+            self._leaves[insert_geocode] = path[-1]
+
+        while path:
+            path.pop().generate_hash()
+
+    def _belongs_in_tree(self, insert_geocode: str) -> bool:
+        """
+        Check that a geocode can be stored in this tree's leaves.
+
+        Args:
+            insert_geocode (str): the geocode of the named data being inserted.
+
+        Returns:
+            bool: True if the geocode belongs in the tree;
+                  False otherwise.
+        """
+        start_level = self._root.length_geocode()
 
         # because all data is at leaf level, the geocode must match the height of the tree
         if self._max_depth != len(insert_geocode) - 1:
             print(f'The leaf level {self._max_depth} does not match the length of the geocode being inserted {len(insert_geocode) - 1}')
-            return
+            return False
         
         # if the set of geocodes doesn't contain the insertion geocode, then 
         # the named data object doesn't belong in this tree
-        for geocode in current_node.geocode:
+        for geocode in self._root.geocode:
             # the object is from a higher level if there are fewer characters
             if start_level > len(insert_geocode):
                 print(f"{insert_geocode} does not belong in the tree because it has a shorter geocode.") 
-                return
+                return False
             for i in range(start_level):
                 if insert_geocode[i] != geocode[i]:
                     print(f"{insert_geocode} does not belong in this tree because it does not match the"
                           f" substring of the tree's geocode: {geocode}." )
-                    return
-        
-        while current_level <= self._max_depth:
-            found = False
-            child_count = 0
-            for child in current_node.children:
-                child_count += 1
-                if not found and child is not None:
-                    for code in child.geocode:
-                        # we have found the node to which this data belongs
-                        if code == insert_geocode:
-                            child.insert_data(named_data)
-                            self._update_merkle(child)
-                            return
-                        # we have found a parent of the node we wish to add data to
-                        elif code in insert_geocode:
-                            current_level += 1
-                            current_node = child
-                            #current_level += 1
-                            found = True
-                            break
-
-            # we must create the child or add this geocode to an existing node
-            if not found:
-                current_level += 1  # we need to move down the tree         
-                geocode_to_add = insert_geocode[0:current_level]
-                
-                node_to_insert = Node(geocode_to_add)  # the node to be added to the tree
-                index = current_node.add_child(node_to_insert)
-                current_node = current_node.children[index]
-                
-                # we haven't found the node, and we have reached the deepest level of the tree, 
-                # so we should add the data
-                if current_level > self._max_depth:
-                    current_node.insert_data(named_data)
-                    self._update_merkle(current_node)
-    
+                    return False
+
+        if any(self._root.slot(char) is None for char in insert_geocode[start_level:]):
+            print(f"{insert_geocode} does not belong in this tree because it is not a valid geohash.")
+            return False
+
+        if not self.in_region(insert_geocode):
+            print(f"{insert_geocode} is outside of the region {self._region} kept by this partial tree.")
+            return False
+        return True
+
     def _update_merkle(self, node: Node) -> None:
         """
-        Update each of the Merkle hashes along a path (from leaf to root).
+        Update each of the Merkle hashes along a path (from the changed node to root).
+        In lazy mode the path is only marked dirty and is rehashed when the root hash is next read.
         """
-        if node is self._root:
-            node.generate_hash() # the tree is empty, so this will generate the empty string hash
-        else:
-            reached_root = False
-            current_node = node
-            
-            while not reached_root:
-                current_node.parent.generate_hash()
-                current_node = current_node.parent
-                if current_node is self._root:
-                    reached_root = True
+        if self._lazy_merkle:
+            node.invalidate()
+            return
+
+        current_node = node
+        current_node.generate_hash()
+        while current_node is not self._root:
+            current_node = current_node.parent
+            current_node.generate_hash()
+
+    def _index_data(self, named_data: str, replaced: str | None = None) -> None:
+        """
+        Add newly stored named data to the indexes and views of the tree.
+
+        Args:
+            named_data (str): the named data that was stored.
+            replaced (str | None, optional): the older version it replaced. Defaults to None.
+        """
+        if replaced is not None:
+            self._unindex_data(replaced)
+        named_data = self._intern(named_data)
+        geocode = self._intern(named_data[named_data.rfind('/') + 1:])
+        self._names.setdefault(_name_key(named_data), set()).add(geocode)
+        self._by_namespace.setdefault(named_data.split('/', 2)[1], set()).add(named_data)
+        self._by_geocode.setdefault(geocode, set()).add(named_data)
+
+    def _unindex_data(self, named_data: str) -> None:
+        """Remove named data that is no longer stored from the indexes and views of the tree."""
+        self._strings.pop(named_data, None)
+        geocode = named_data[named_data.rfind('/') + 1:]
+        for index, key, value in ((self._names, _name_key(named_data), geocode),
+                                  (self._by_namespace, named_data.split('/', 2)[1], named_data),
+                                  (self._by_geocode, geocode, named_data)):
+            values = index.get(key)
+            if values is not None:
+                values.discard(value)
+                if not values:
+                    del index[key]
+
+    def _intern(self, string: str) -> str:
+        """
+        Get the tree's single copy of a stored name or leaf geocode, making the string 
+        that copy if the tree has none yet.
+
+        Args:
+            string (str): the name or geocode.
+
+        Returns:
+            str: the interned string, equal to the one given.
+        """
+        return self._strings.setdefault(string, string)
+
+    def _rebuild_indexes(self) -> None:
+        """Rebuild the lookup indexes (which are derived from the nodes) by walking the whole tree."""
+        self._leaves = {}
+        self._names = {}
+        self._by_namespace = {}
+        self._by_geocode = {}
+        self._strings = {}
+        leaf_level = self._max_depth + 1
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            current_node = stack.pop()
+            if current_node.length_geocode() == leaf_level:
+                self.index_leaf(current_node)
+            stack.extend(child for child in current_node.children if child is not None)
+
+    def index_leaf(self, leaf: Node) -> None:
+        """
+        Add a leaf's geocodes and named data to the lookup indexes. Lets a tree that is built 
+        outside of the SpasyTree (e.g. while it is decoded) be indexed one leaf at a time (see adopt).
+
+        Args:
+            leaf (Node): the leaf.
+        """
+        for geocode in leaf.geocode:
+            self._leaves[self._intern(geocode)] = leaf
+        for named_data in leaf.data:
+            self._index_data(named_data)
+
+    ######### PICKLING #########
+    def __getstate__(self) -> dict:
+        """Leave the lookup indexes out of pickled trees; they are rebuilt from the nodes."""
+        state = self.__dict__.copy()
+        del state['_leaves']
+        del state['_names']
+        del state['_by_namespace']
+        del state['_by_geocode']
+        del state['_strings']
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self._rebuild_indexes()
 
     ######### STRINGS #########
     def __str__(self) -> str:
@@ -383,8 +966,8 @@ if __name__ == '__main__':
     bob_hash = paper_tree.root.hashcode
     paper_tree.insert('/alice/ball/_v0/dpwhwtmpz0')
     print(f'\nAfter Alice: {paper_tree.root}')
-    print(f'\nAfter Bob hash: {bob_hash}')
-    print(f'\nAfter Alice hash: {paper_tree.root.hashcode}')
+    print(f'\nAfter Bob hash: {bob_hash.hex()}')
+    print(f'\nAfter Alice hash: {paper_tree.root.hashcode.hex()}')
 
     
     # print(paper_tree.root)
@@ -0,0 +1,434 @@
+import gc
+import struct
+from hashlib import sha256
+
+from Node import Node, LEAF_HASHES, CHILD_SLOTS
+from SpasyTree import SpasyTree
+from UpdateLog import UpdateLog
+
+
+# An encoded tree is a header (followed by the region for a partial tree), the table of distinct name components, the nodes in preorder and
+# the encoded update log. Each node is its digest followed, for an internal node, by a bit mask of
+# the child slots in use or, for a leaf, by its number of names, the number of components in each
+# name (one byte each) and the components' numbers in the table (all of the same width). Counts
+# and lengths are unsigned LEB128 varints. A partial tree holds the subtree of a region in full, and
+# only the digests of the nodes beside the path down to it. Decoding never recurses, and only allocates as the data
+# it describes arrives.
+TREE_MAGIC = b'SPTC'
+TREE_VERSION = 1
+
+# magic, version, branching, leaf hash scheme (index in LEAF_HASHES), flags, max depth, recent updates size
+_HEADER = struct.Struct('<4sBBBBHI')
+_FLAG_LAZY_MERKLE = 1
+_FLAG_PARTIAL = 2
+# the largest update log accepted from a peer, so a forged capacity cannot exhaust memory
+MAX_LOG_CAPACITY = 1 << 20
+_DIGEST_SIZE = sha256().digest_size
+# the struct format of a component number, by its width in bytes
+_ID_FORMATS = {1: 'B', 2: 'H', 4: 'I'}
+# for each branching factor, maps each geohash character to its child slot, so a geocode maps to its path below the root
+_PATH_KEYS = {branching: str.maketrans({char: chr(slot) for char, slot in slots.items()})
+              for branching, slots in CHILD_SLOTS.items()}
+
+
+def _write_varint(encoded: bytearray, value: int) -> None:
+    """Append an unsigned integer as an LEB128 varint."""
+    while value > 0x7f:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+
+
+def _check_region(region: str, root_geocode: str, leaf_level: int, branching: int) -> None:
+    """Check that a region is a valid geohash prefix within a tree."""
+    if (not region.startswith(root_geocode) or len(region) > leaf_level
+            or not CHILD_SLOTS[branching].keys() >= set(region)):
+        raise ValueError(f'{region!r} is not a region of the tree for {root_geocode}')
+
+
+def encode_tree(tree: SpasyTree, region: str | None = None) -> bytes:
+    """
+    Encode a tree (its nodes, hashes and update log) for transfer to a peer joining it.
+
+    Args:
+        tree (SpasyTree): the tree to encode.
+        region (str | None, optional): a geohash prefix, to encode a partial tree with only the subtree
+                                       holding the region (see SpasyTree.region) and the digests of the
+                                       nodes beside the path to it. Defaults to None (the whole tree).
+
+    Returns:
+        bytes: the encoded tree.
+    """
+    root_geocode = next(iter(tree.root.geocode), '')
+    leaf_level = tree.max_depth + 1
+    flags = (_FLAG_LAZY_MERKLE if tree.lazy_merkle else 0) | (_FLAG_PARTIAL if region is not None else 0)
+    encoded = bytearray(_HEADER.pack(TREE_MAGIC, TREE_VERSION, tree.branching, LEAF_HASHES.index(tree.leaf_hash),
+                                     flags, tree.max_depth, tree.max_number_recent_updates))
+    _write_varint(encoded, len(root_geocode.encode()))
+    encoded += root_geocode.encode()
+
+    region_path = ''
+    if region is not None:
+        _check_region(region, root_geocode, leaf_level, tree.branching)
+        region_path = region[len(root_geocode):].translate(_PATH_KEYS[tree.branching])
+        _write_varint(encoded, len(region.encode()))
+        encoded += region.encode()
+
+    # every name component is stored once and names refer to components by number
+    components = {}
+    leaves = [] # the names of each leaf, as the number of components of each name and all their numbers
+    structure = [] # each node's digest and child mask (empty for a stub), or its digest and None for a leaf
+    mask_size = tree.branching // 8 or 1
+    stack = [(tree.root, '')]
+    while stack:
+        node, path = stack.pop()
+        if not path.startswith(region_path[:len(path)]):
+            # beside the path to the region, so only the digest is sent
+            structure.append((node.hashcode, b''))
+            continue
+        if node.length_geocode() == leaf_level:
+            lengths = bytearray()
+            numbers = []
+            for named_data in node.data:
+                name_components = named_data.split('/')[1:]
+                if len(name_components) > 255:
+                    raise ValueError(f'{named_data} has more than 255 components')
+                lengths.append(len(name_components))
+                numbers.extend(components.setdefault(component, len(components)) for component in name_components)
+            structure.append((node.hashcode, None))
+            leaves.append((lengths, numbers))
+            continue
+
+        mask = 0
+        for slot, child in enumerate(node.children):
+            if child is not None:
+                mask |= 1 << slot
+        structure.append((node.hashcode, mask.to_bytes(mask_size, 'little')))
+        stack.extend((child, path + chr(slot)) for slot, child in reversed(list(enumerate(node.children)))
+                     if child is not None)
+
+    _write_varint(encoded, len(components))
+    for component in components:
+        component = component.encode()
+        _write_varint(encoded, len(component))
+        encoded += component
+    id_width = 1 if len(components) <= 1 << 8 else 2 if len(components) <= 1 << 16 else 4
+    encoded.append(id_width)
+
+    leaf = iter(leaves)
+    for digest, mask in structure:
+        encoded += digest
+        if mask is not None:
+            encoded += mask
+            continue
+        lengths, numbers = next(leaf)
+        _write_varint(encoded, len(lengths))
+        encoded += lengths
+        encoded += struct.pack(f'<{len(numbers)}{_ID_FORMATS[id_width]}', *numbers)
+
+    # the changes in the log are mostly outside of a partial tree's region, which never serves them, so it gets an empty log
+    log = tree.update_log.to_bytes() if region is None else UpdateLog(tree.update_log.capacity).to_bytes()
+    _write_varint(encoded, len(log))
+    encoded += log
+    return bytes(encoded)
+
+
+class TreeDecoder:
+    """
+    Decodes a tree encoded by encode_tree from chunks of the encoding fed in order (e.g. the
+    segments of a JOIN response as they arrive). Each subtree is built as soon as its last
+    leaf has been read, so little work is left once the final chunk is fed.
+
+    The data is only parsed, never executed, so trees from untrusted peers can be decoded: the
+    structure is checked (every name must sit in the leaf its geocode leads to, in sorted order)
+    and anything malformed raises ValueError.
+    """
+
+    def __init__(self, verify: bool=False) -> None:
+        """
+        Args:
+            verify (bool, optional): also rehash every node as it is built and check its digest,
+                                     rather than trusting the digests sent. Defaults to False.
+        """
+        self._verify = verify
+        self._buffer = bytearray()
+        self._offset = 0
+        self._tree = None
+        self._parser = self._parse()
+        next(self._parser)
+
+    ######### ACCESSORS #########
+    @property
+    def done(self) -> bool:
+        """Get whether the whole tree has been read."""
+        return self._tree is not None
+
+    ######### DECODING #########
+    def feed(self, data: bytes) -> None:
+        """
+        Decode the next chunk of the encoded tree, as far as it goes.
+
+        Args:
+            data (bytes): the chunk.
+        """
+        if self._tree is not None:
+            if data:
+                raise ValueError(f'{len(data)} unexpected bytes after the tree')
+            return
+
+        self._buffer += data
+        # decoding allocates many nodes that all stay alive, which would only set off garbage collections that find nothing to free
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            self._parser.send(None)
+        except StopIteration as stop:
+            self._tree = stop.value
+            if self._offset < len(self._buffer):
+                raise ValueError(f'{len(self._buffer) - self._offset} unexpected bytes after the tree')
+        finally:
+            if collecting:
+                gc.enable()
+
+        # drop the bytes already read so the buffer only holds the part of the tree still being read
+        if self._offset > 1 << 16:
+            del self._buffer[:self._offset]
+            self._offset = 0
+
+    def finish(self) -> SpasyTree:
+        """
+        Get the decoded tree once every chunk has been fed.
+
+        Returns:
+            SpasyTree: the decoded tree.
+        """
+        if self._tree is None:
+            raise ValueError('Truncated tree')
+        return self._tree
+
+    def _read(self, length: int):
+        """Read a number of bytes, waiting for more chunks until they have all arrived."""
+        while len(self._buffer) - self._offset < length:
+            yield
+        return self._take(length)
+
+    def _take(self, length: int) -> bytes | None:
+        """Read a number of bytes if they have all arrived, without waiting (None if they have not)."""
+        start = self._offset
+        if len(self._buffer) - start < length:
+            return None
+        self._offset = start + length
+        return bytes(self._buffer[start:start + length])
+
+    def _varint(self):
+        """Read an LEB128 varint of at most 64 bits."""
+        value = self._take_varint()
+        if value is not None:
+            return value
+        value = 0
+        for shift in range(0, 64, 7):
+            byte = (yield from self._read(1))[0]
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                return value
+        raise ValueError('Malformed varint')
+
+    def _take_varint(self) -> int | None:
+        """Read a varint if it has all arrived, without waiting (None if it has not)."""
+        buffer = self._buffer
+        offset = self._offset
+        value = 0
+        for shift in range(0, 64, 7):
+            if offset >= len(buffer):
+                return None
+            byte = buffer[offset]
+            offset += 1
+            value |= (byte & 0x7f) << shift
+            if not byte & 0x80:
+                self._offset = offset
+                return value
+        raise ValueError('Malformed varint')
+
+    def _parse(self):
+        """Parse the encoded tree, yielding whenever the next part has not arrived yet."""
+        yield # wait for the first chunk
+        header = yield from self._read(_HEADER.size)
+        magic, version, branching, leaf_hash, flags, max_depth, max_queue = _HEADER.unpack(header)
+        if magic != TREE_MAGIC:
+            raise ValueError('Not an encoded SpasyTree')
+        if version != TREE_VERSION:
+            raise ValueError(f'Encoded tree version {version}, expected version {TREE_VERSION}')
+        if branching not in CHILD_SLOTS:
+            raise ValueError(f'Unsupported branching factor {branching}, expected one of {tuple(CHILD_SLOTS)}')
+        if leaf_hash >= len(LEAF_HASHES):
+            raise ValueError(f'Unknown leaf hash scheme {leaf_hash}')
+        if max_queue > MAX_LOG_CAPACITY:
+            raise ValueError(f'Update logs hold at most {MAX_LOG_CAPACITY} changes')
+        leaf_hash = LEAF_HASHES[leaf_hash]
+        slots = CHILD_SLOTS[branching]
+
+        root_geocode = (yield from self._read((yield from self._varint()))).decode()
+        leaf_level = max_depth + 1
+        if not root_geocode or len(root_geocode) > leaf_level or not slots.keys() >= set(root_geocode):
+            raise ValueError(f'Invalid root geocode {root_geocode!r}')
+
+        region = None
+        region_path = ''
+        to_path = _PATH_KEYS[branching]
+        if flags & _FLAG_PARTIAL:
+            region = (yield from self._read((yield from self._varint()))).decode()
+            _check_region(region, root_geocode, leaf_level, branching)
+            region_path = region[len(root_geocode):].translate(to_path)
+        slot_chars = {} # the first geohash character of each child slot, to give stubs a geocode
+        for char, slot in slots.items():
+            slot_chars.setdefault(slot, char)
+
+        # a component that is a geocode in the tree is mapped to its path of child slots below the root
+        prefixed = [] # each component, with the '/' that precedes it in a name
+        paths = []
+        for _ in range((yield from self._varint())):
+            length = self._take_varint()
+            if length is None:
+                length = yield from self._varint()
+            component = self._take(length)
+            if component is None:
+                component = yield from self._read(length)
+            component = component.decode()
+            if '/' in component:
+                raise ValueError(f'Invalid name component {component!r}')
+            prefixed.append('/' + component)
+            is_geocode = (len(component) == leaf_level and component.startswith(root_geocode)
+                          and slots.keys() >= set(component))
+            paths.append(component[len(root_geocode):].translate(to_path) if is_geocode else None)
+        id_width = (yield from self._read(1))[0]
+        if id_width not in _ID_FORMATS:
+            raise ValueError(f'Invalid component number width {id_width}')
+
+        # leaves are indexed as they are built, so the tree does not have to be walked once it is complete
+        tree = SpasyTree(max_depth, max_queue, None, bool(flags & _FLAG_LAZY_MERKLE), leaf_hash, branching, 1, region)
+
+        # the nodes are read in preorder; each open internal node is its path of child slots, its digest,
+        # the slots of the children still to be read and the children already built. In a partial tree the
+        # nodes beside the path to the region are stubs, which only hold their digests
+        mask_size = branching // 8 or 1
+        open_nodes = []
+        root = None
+        path = ''
+        while root is None:
+            # the parts of a node have usually all arrived, so they are taken without waiting when they can be
+            digest = self._take(_DIGEST_SIZE) or (yield from self._read(_DIGEST_SIZE))
+            length = len(root_geocode) + len(path)
+            if not path.startswith(region_path[:len(path)]):
+                node = Node(region[:length - 1] + slot_chars[ord(path[-1])], leaf_hash, branching)
+                node.restore([], digest)
+            elif length < leaf_level:
+                mask = int.from_bytes(self._take(mask_size) or (yield from self._read(mask_size)), 'little')
+                if mask >> branching:
+                    raise ValueError('Child slot out of range')
+                slots_to_read = []
+                while mask:
+                    lowest = mask & -mask
+                    slots_to_read.append(lowest.bit_length() - 1)
+                    mask ^= lowest
+                slots_to_read.reverse()
+                open_nodes.append((path, digest, slots_to_read, [None] * branching))
+                node = None
+            else:
+                node = yield from self._read_leaf(path, digest, leaf_hash, branching, id_width, prefixed, paths)
+                tree.index_leaf(node)
+
+            if node is not None:
+                if not open_nodes:
+                    root = node
+                    break
+                open_nodes[-1][3][ord(path[-1])] = node
+
+            # build every internal node whose children have all been read
+            while open_nodes and not open_nodes[-1][2]:
+                node_path, node_digest, _, children = open_nodes.pop()
+                length = len(root_geocode) + len(node_path)
+                geocode = {child_geocode[:length] for child in children if child is not None for child_geocode in child.geocode}
+                if not node_path:
+                    geocode = {root_geocode}
+                elif len(node_path) < len(region_path):
+                    # on the path to the region, which may have no data yet
+                    geocode.add(region[:length])
+                elif not geocode:
+                    raise ValueError('The tree has a branch without any names')
+                node = Node(geocode, leaf_hash, branching)
+                node.set_children(children)
+                self._restore(node, [], node_digest)
+                if open_nodes:
+                    open_nodes[-1][3][ord(node_path[-1])] = node
+                else:
+                    root = node
+            if open_nodes:
+                path = open_nodes[-1][0] + chr(open_nodes[-1][2].pop())
+
+        log = yield from self._read((yield from self._varint()))
+        if len(log) >= 4 and int.from_bytes(log[:4], 'little') > MAX_LOG_CAPACITY:
+            raise ValueError(f'Update logs hold at most {MAX_LOG_CAPACITY} changes')
+        tree.update_log = UpdateLog.from_bytes(log)
+        tree.adopt(root)
+        return tree
+
+    def _read_leaf(self, path: str, digest: bytes, leaf_hash: str, branching: int, id_width: int,
+                   prefixed: list, paths: list):
+        """Read a leaf's names and build the leaf."""
+        count = self._take_varint()
+        if count is None:
+            count = yield from self._varint()
+        lengths = self._take(count)
+        if lengths is None:
+            lengths = yield from self._read(count)
+        size = sum(lengths) * id_width
+        encoded_numbers = self._take(size)
+        if encoded_numbers is None:
+            encoded_numbers = yield from self._read(size)
+        numbers = struct.unpack(f'<{sum(lengths)}{_ID_FORMATS[id_width]}', encoded_numbers)
+        if numbers and max(numbers) >= len(prefixed):
+            raise ValueError(f'Unknown name component {max(numbers)}')
+
+        # every name must end with a geocode that leads to this leaf
+        names = []
+        geocode = set()
+        end = 0
+        for name_length in lengths:
+            start, end = end, end + name_length
+            if not name_length or paths[numbers[end - 1]] != path:
+                raise ValueError('A name is not stored in the leaf for its geocode')
+            names.append(''.join([prefixed[number] for number in numbers[start:end]]))
+            geocode.add(prefixed[numbers[end - 1]][1:])
+        if not names:
+            raise ValueError('The tree has a branch without any names')
+        if any(first >= second for first, second in zip(names, names[1:])):
+            raise ValueError('The names in a leaf must be sorted and distinct')
+
+        node = Node(geocode, leaf_hash, branching)
+        self._restore(node, names, digest)
+        return node
+
+    def _restore(self, node: Node, names: list, digest: bytes) -> None:
+        """Give a newly built node its names and digest, checking the digest if asked to."""
+        node.restore(names, digest)
+        if self._verify:
+            node.generate_hash()
+            if node.hashcode != digest:
+                raise ValueError(f'The digest sent for the node at {next(iter(node.geocode))} does not match its contents')
+
+
+def decode_tree(data: bytes, verify: bool=False) -> SpasyTree:
+    """
+    Decode a tree encoded by encode_tree (see TreeDecoder).
+
+    Args:
+        data (bytes): the encoded tree.
+        verify (bool, optional): also rehash the whole tree and check every node's digest, rather
+                                 than trusting the digests sent. Defaults to False.
+
+    Returns:
+        SpasyTree: the decoded tree.
+    """
+    decoder = TreeDecoder(verify)
+    decoder.feed(data)
+    return decoder.finish()
@@ -0,0 +1,250 @@
+import struct
+import time
+from typing import Iterator, Self
+
+
+# an encoded log starts with its capacity, the sequence number of its first entry and its number of entries;
+# each entry is its timestamp, its action and the length of its name, followed by the name
+_HEADER = struct.Struct('<IQI')
+_ENTRY = struct.Struct('<qcH')
+
+
+def to_nanoseconds(timestamp: int | float | str) -> int:
+    """
+    Convert a timestamp to integer nanoseconds since the epoch. Integers are taken to be nanoseconds
+    already; floats and strings (as written by time.time()) are taken to be seconds.
+
+    Args:
+        timestamp (int | float | str): the timestamp. An empty string is the current time.
+
+    Returns:
+        int: the timestamp in nanoseconds.
+    """
+    if isinstance(timestamp, int):
+        return timestamp
+    if timestamp == "":
+        return time.time_ns()
+    return round(float(timestamp) * 1_000_000_000)
+
+
+def encode_entries(entries: list) -> bytes:
+    """
+    Encode updates compactly for transfer.
+
+    Args:
+        entries (list): the updates, each a tuple of timestamp (ns), action ('i', 'd' or 'r') and named data.
+
+    Returns:
+        bytes: the encoded updates.
+    """
+    encoded = bytearray()
+    for timestamp, action, named_data in entries:
+        name = named_data.encode()
+        encoded += _ENTRY.pack(timestamp, action.encode(), len(name))
+        encoded += name
+    return bytes(encoded)
+
+
+def decode_entries(data: bytes) -> list:
+    """
+    Decode updates encoded by encode_entries.
+
+    Args:
+        data (bytes): the encoded updates.
+
+    Returns:
+        list: the updates, each a tuple of timestamp (ns), action and named data.
+    """
+    entries = []
+    offset = 0
+    while offset < len(data):
+        if offset + _ENTRY.size > len(data):
+            raise ValueError('Truncated update')
+        timestamp, action, length = _ENTRY.unpack_from(data, offset)
+        offset += _ENTRY.size
+        if offset + length > len(data):
+            raise ValueError('Truncated update')
+        entries.append((timestamp, action.decode(), bytes(data[offset:offset + length]).decode()))
+        offset += length
+    return entries
+
+
+class UpdateLog:
+    """
+    A fixed-capacity ring buffer of the latest updates made to a tree. Each update is a
+    tuple of an integer timestamp (nanoseconds), an action ('i', 'd' or 'r') and the named
+    data (or, for 'r', the geohash prefix of a deleted region), and is given the next of a monotonically increasing sequence of numbers.
+    Appending and evicting the oldest update take constant time, and the updates after
+    a sequence number or a timestamp are found with a binary search.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        """
+        Args:
+            capacity (int): the number of updates kept; the oldest is evicted when a new one is appended.
+        """
+        if capacity < 1:
+            raise ValueError(f'An update log needs a capacity of at least 1, not {capacity}')
+
+        self._capacity = capacity
+        self._timestamps = [0] * capacity
+        self._actions = [''] * capacity
+        self._names = [''] * capacity
+        # the largest timestamp up to and including each entry, so timestamps can be searched even when out of order
+        self._max_timestamps = [0] * capacity
+        self._start = 0 # the slot holding the oldest entry
+        self._count = 0
+        self._first_sequence = 0
+
+    ######### ACCESSORS #########
+    @property
+    def capacity(self) -> int:
+        """Get the number of updates kept."""
+        return self._capacity
+
+    @property
+    def first_sequence(self) -> int:
+        """Get the sequence number of the oldest update still in the log."""
+        return self._first_sequence
+
+    @property
+    def next_sequence(self) -> int:
+        """Get the sequence number the next update will be given."""
+        return self._first_sequence + self._count
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[tuple]:
+        return self._entries(0, self._count)
+
+    def __getitem__(self, position: int) -> tuple:
+        """Get the update at a position, counting from the oldest (negative positions count from the newest)."""
+        if position < 0:
+            position += self._count
+        if not 0 <= position < self._count:
+            raise IndexError('update log index out of range')
+        slot = self._slot(position)
+        return self._timestamps[slot], self._actions[slot], self._names[slot]
+
+    def _slot(self, position: int) -> int:
+        """Get the slot of the entry at a position, counting from the oldest."""
+        return (self._start + position) % self._capacity
+
+    def _entries(self, first: int, last: int) -> Iterator[tuple]:
+        """Iterate over the updates from one position up to (but not including) another."""
+        for position in range(first, last):
+            slot = self._slot(position)
+            yield self._timestamps[slot], self._actions[slot], self._names[slot]
+
+    def latest(self, number: int) -> list:
+        """
+        Get the newest updates.
+
+        Args:
+            number (int): the number of updates.
+
+        Returns:
+            list: up to that many updates, oldest first.
+        """
+        return list(self._entries(max(0, self._count - number), self._count))
+
+    def entries_since(self, sequence: int, until: int | None = None) -> list | None:
+        """
+        Get the updates with sequence numbers from one number up to (but not including) another.
+
+        Args:
+            sequence (int): the sequence number of the first update.
+            until (int | None, optional): the sequence number after the last update. Defaults to None (the newest update).
+
+        Returns:
+            list | None: the updates, oldest first; or None if the first of them was already evicted.
+        """
+        until = self.next_sequence if until is None else min(until, self.next_sequence)
+        if sequence < self._first_sequence:
+            return None
+        return list(self._entries(sequence - self._first_sequence, max(sequence, until) - self._first_sequence))
+
+    def entries_after(self, timestamp: int) -> list:
+        """
+        Get the updates with timestamps later than the given one.
+
+        Args:
+            timestamp (int): the timestamp in nanoseconds.
+
+        Returns:
+            list: the updates, oldest first.
+        """
+        # the running maximum never decreases, so every later update comes after the first one to exceed the timestamp
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._max_timestamps[self._slot(middle)] > timestamp:
+                high = middle
+            else:
+                low = middle + 1
+        return [entry for entry in self._entries(low, self._count) if entry[0] > timestamp]
+
+    ######### MUTATORS #########
+    def append(self, timestamp: int, action: str, named_data: str) -> int:
+        """
+        Add an update, evicting the oldest update if the log is full.
+
+        Args:
+            timestamp (int): the timestamp in nanoseconds.
+            action (str): 'i' for an insertion, 'd' for a deletion, 'r' for the deletion of a region.
+            named_data (str): the named data.
+
+        Returns:
+            int: the update's sequence number.
+        """
+        if self._count == self._capacity:
+            self._start = (self._start + 1) % self._capacity
+            self._first_sequence += 1
+            self._count -= 1
+
+        previous_max = self._max_timestamps[self._slot(self._count - 1)] if self._count else timestamp
+        slot = self._slot(self._count)
+        self._timestamps[slot] = timestamp
+        self._actions[slot] = action
+        self._names[slot] = named_data
+        self._max_timestamps[slot] = max(previous_max, timestamp)
+        self._count += 1
+        return self.next_sequence - 1
+
+    ######### ENCODING #########
+    def to_bytes(self) -> bytes:
+        """Encode the log (its capacity, sequence numbers and updates) compactly."""
+        return _HEADER.pack(self._capacity, self._first_sequence, self._count) + encode_entries(list(self))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> Self:
+        """
+        Decode a log encoded by to_bytes.
+
+        Args:
+            data (bytes): the encoded log.
+
+        Returns:
+            UpdateLog: the log, with the same sequence numbers.
+        """
+        if len(data) < _HEADER.size:
+            raise ValueError('Truncated update log')
+        capacity, first_sequence, count = _HEADER.unpack_from(data)
+        entries = decode_entries(data[_HEADER.size:])
+        if len(entries) != count or count > capacity:
+            raise ValueError(f'Expected {count} updates in a log of capacity {capacity}, found {len(entries)}')
+
+        log = cls(capacity)
+        for entry in entries:
+            log.append(*entry)
+        log._first_sequence = first_sequence
+        return log
+
+    ######### PICKLING #########
+    def __getstate__(self) -> dict:
+        """Pickle the log in its compact encoding."""
+        return {'encoded': self.to_bytes()}
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(UpdateLog.from_bytes(state['encoded']).__dict__)
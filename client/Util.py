@@ -1,18 +1,114 @@
 import logging
+import lzma
+import zlib
 
 from ndn.encoding import Name, Component
 from ndn.encoding.tlv_type import VarBinaryStr
 
 import Config
+from UpdateLog import encode_entries, decode_entries
 
 
-def pack_data(data: any, name: str) -> tuple[list[VarBinaryStr], int]:
+# markers sent with a response to a root hash request, saying whether it holds the changes made since the
+# requester's root hash, the updates missing from the requester's IBLT of its recent updates or (when neither
+# can be found) the full recent updates queue
+UPDATES_DELTA = "delta"
+UPDATES_MISSING = "missing"
+UPDATES_FULL = "full"
+_UPDATES_KINDS = (UPDATES_DELTA, UPDATES_MISSING, UPDATES_FULL)
+
+# codecs that content can be compressed with before it is segmented; the codec is sent as the content type in the
+# MetaInfo of every segment (the NDN content types from 1024 up are application specific)
+COMPRESSION_NONE = "none"
+COMPRESSION_ZLIB = "zlib"
+COMPRESSION_LZMA = "lzma"
+_CONTENT_TYPES = {COMPRESSION_NONE: 0, COMPRESSION_ZLIB: 1024, COMPRESSION_LZMA: 1025}
+
+
+def compress_data(data: bytes, compression: str) -> bytes:
     """
-    Split given data (binary) into signed packets based on configured packet size
+    Compress data with a codec at the configured compression level
+
+    Args:
+        data: Binary data to compress
+        compression: Codec to compress with (COMPRESSION_NONE, COMPRESSION_ZLIB or COMPRESSION_LZMA)
+
+    Returns:
+        Compressed data
+    """
+
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(data, Config.config["compression_level"])
+    if compression == COMPRESSION_LZMA:
+        return lzma.compress(data, preset=Config.config["compression_level"])
+    if compression == COMPRESSION_NONE:
+        return data
+    raise ValueError(f"Unknown compression codec {compression}")
+
+
+class SegmentDecompressor:
+    """
+    Decompresses content segment by segment as the segments arrive, using the codec given by the content type
+    of the segments' MetaInfo
+    """
+
+    def __init__(self, content_type: int | None) -> None:
+        """
+        Args:
+            content_type: Content type of the segments (None or 0 if the content is not compressed)
+        """
+
+        if not content_type:
+            self._decompressor = None
+        elif content_type == _CONTENT_TYPES[COMPRESSION_ZLIB]:
+            self._decompressor = zlib.decompressobj()
+        elif content_type == _CONTENT_TYPES[COMPRESSION_LZMA]:
+            self._decompressor = lzma.LZMADecompressor()
+        else:
+            raise ValueError(f"Unknown content type {content_type}")
+
+    def feed(self, segment: bytes) -> bytes:
+        """
+        Decompress the next segment
+
+        Args:
+            segment: Content of the segment
+
+        Returns:
+            The decompressed data the segment completes
+        """
+
+        if self._decompressor is None:
+            return bytes(segment)
+        try:
+            return self._decompressor.decompress(segment)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise ValueError(f"Malformed compressed content: {e}")
+
+    def finish(self) -> None:
+        """
+        Check that the content was complete once every segment has been fed
+        """
+
+        if self._decompressor is None:
+            return
+        if not self._decompressor.eof:
+            raise ValueError("Truncated compressed content")
+        if self._decompressor.unused_data:
+            raise ValueError("Unexpected data after the compressed content")
+
+
+def pack_data(data: any, name: str, compression: str = COMPRESSION_NONE,
+              compressed: bool = False) -> tuple[list[VarBinaryStr], int]:
+    """
+    Split given data (binary) into signed packets based on configured packet size, optionally compressing it first
 
     Args:
         data: Binary data to pack
         name: Name of content
+        compression: Codec to compress the data with before it is split, sent as the content type of each packet
+                     (COMPRESSION_NONE, COMPRESSION_ZLIB or COMPRESSION_LZMA)
+        compressed: True if the data was already compressed with the codec (see compress_data), so it is only split
 
     Returns:
         packets: List of packets making up given content
@@ -21,12 +117,51 @@ def pack_data(data: any, name: str) -> tuple[list[VarBinaryStr], int]:
 
     logging.info(f"Packing data under name {name}")
 
+    size = len(data)
+    if not compressed:
+        data = compress_data(data, compression)
+    if compression != COMPRESSION_NONE and not compressed:
+        logging.info(f"Compressed data under name {name} from {size} to {len(data)} bytes with {compression}")
+
     seg_cnt = (len(data) + Config.config["packet_segment_size"] - 1) // Config.config["packet_segment_size"]
     packets = [Config.app.prepare_data(Name.normalize(name) + [Component.from_segment(i)],
                                 data[i * Config.config["packet_segment_size"]:(i + 1) * Config.config["packet_segment_size"]],
                                 freshness_period=100000,
+                                content_type=_CONTENT_TYPES[compression],
                                 final_block_id=Component.from_segment(seg_cnt - 1))
                for i in range(seg_cnt)]
 
     logging.info(f"Packed data with name {name} into {seg_cnt} segments")
     return packets, seg_cnt
+
+
+def pack_updates(kind: str, updates: list) -> bytes:
+    """
+    Serialize a response to a root hash request: a marker followed by the compactly encoded updates
+
+    Args:
+        kind: Marker saying what the updates are (UPDATES_DELTA, UPDATES_MISSING or UPDATES_FULL)
+        updates: List of updates, each a tuple of timestamp (ns), action and named data
+
+    Returns:
+        Serialized response
+    """
+
+    return bytes([_UPDATES_KINDS.index(kind)]) + encode_entries(updates)
+
+
+def unpack_updates(data: bytes) -> tuple[str, list]:
+    """
+    Deserialize a response to a root hash request serialized by pack_updates
+
+    Args:
+        data: Serialized response
+
+    Returns:
+        kind: Marker saying what the updates are
+        updates: List of updates
+    """
+
+    if not data or data[0] >= len(_UPDATES_KINDS):
+        raise ValueError("Malformed updates response")
+    return _UPDATES_KINDS[data[0]], decode_entries(data[1:])
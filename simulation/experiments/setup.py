@@ -15,6 +15,7 @@ class Setup:
         direct_root_hash_path: Base prefix for update interests by root hash
         direct_geocode_path: Base prefix for tree interests by geocode
         direct_asset_path: Base prefix for asset interests
+        direct_node_path: Base prefix for tree node interests (reconciliation)
         multi_path: Base prefix for multicast interests
         initialization_path: Base prefix for initialization interests
 
@@ -31,10 +32,31 @@ class Setup:
         use_timestamp: True if timestamps should be used when updating tree, False if not
         use_keychain_digest: True if NDN app should use dummy keychain for packet signing (improves performance), False if not.
                              If ndn-cxx was not patched during installation to use dummy keychain then dummy keychain must be used.
+        lazy_merkle: True if tree hashes should only be recomputed when the root hash is read (batches updates), False if
+                     every change should rehash its path to the root immediately
+        leaf_hash: Scheme used to hash tree leaves. sequential = hash of the sorted names in the leaf,
+                   additive = sum of per-name hashes, updated in constant time when a name is added or removed
+        branching: Number of children per tree node. 4 = quadtree buckets of eight geohash characters,
+                   32 = one child per geohash character (shallower lookups, wider nodes)
+        change_log_size: Number of changes each tree keeps in its change log, so peers can be sent just the
+                         changes made since their root hash
+        max_clock_offset: Seconds another node's clock may be ahead of this node's before the timestamps it sends are
+                          ignored by the hybrid logical clock
+        iblt_cells: Number of cells in the IBLT of recent updates sent with update requests, about 1.5 cells are needed per
+                    update that differs between two nodes
+        snapshot_path: File the node's tree is memory-mapped from at startup if it exists and was saved with the
+                       configured branching, leaf_hash and update queue size and built with the same build_tree_method,
+                       number of assets and word list, or saved to once built otherwise.
+                       Empty to always build the tree
+        compression: Codec trees, update queues and (with compress_assets) assets are compressed with before they are
+                     segmented. none, zlib or lzma
+        compression_level: Compression level, 0-9 for both zlib and lzma
+        compress_assets: True if assets should be compressed as well, False to send them as they are
         action_list: List of action lists to distribute among nodes
 
         direct_root_hash_prefix: Prefix for update interests by root hash
         direct_geocode_prefix: Prefix for tree interests by geocode
+        direct_node_prefix: Prefix for tree node interests by geocode and node hash
 
         node_name: Name of node
         node_prefix: Base prefix for node
@@ -52,6 +74,7 @@ class Setup:
     direct_root_hash_path = "/direct/root"
     direct_geocode_path = "/direct/geocode"
     direct_asset_path = "/direct/asset"
+    direct_node_path = "/direct/node"
     multi_path = "/multi"
     initialization_path = "/init"
 
@@ -67,10 +90,21 @@ class Setup:
     build_tree_method = "file"
     use_timestamp = True
     use_keychain_digest = True
+    lazy_merkle = False
+    leaf_hash = "sequential"
+    branching = 4
+    change_log_size = 1000
+    max_clock_offset = 60
+    iblt_cells = 60
+    snapshot_path = ""
+    compression = "none"
+    compression_level = 6
+    compress_assets = False
     action_list = deque()
 
     direct_root_hash_prefix = ""
     direct_geocode_prefix = ""
+    direct_node_prefix = ""
 
 
     def __init__(self, node_name: str) -> None:
@@ -104,6 +138,7 @@ class Setup:
         cls.direct_root_hash_prefix = cls.base_path + cls.direct_root_hash_path
         cls.direct_geocode_prefix = cls.base_path + cls.direct_geocode_path
         cls.direct_asset_prefix = cls.base_path + cls.direct_asset_path
+        cls.direct_node_prefix = cls.base_path + cls.direct_node_path
 
 
     @classmethod
@@ -190,6 +225,7 @@ class Setup:
             "direct_root_hash_path": self.direct_root_hash_path,
             "direct_geocode_path": self.direct_geocode_path,
             "direct_asset_prefix": self.direct_asset_prefix,
+            "direct_node_prefix": self.direct_node_prefix,
             "base_path": self.base_path,
             "packet_segment_size": self.packet_segment_size - self.packet_segment_size_overhead,
             "batch_size": self.batch_size,
@@ -199,7 +235,17 @@ class Setup:
             "max_packets": self.max_packets,
             "build_tree_method": self.build_tree_method,
             "use_timestamp": self.use_timestamp,
-            "use_keychain_digest": self.use_keychain_digest
+            "use_keychain_digest": self.use_keychain_digest,
+            "lazy_merkle": self.lazy_merkle,
+            "leaf_hash": self.leaf_hash,
+            "branching": self.branching,
+            "change_log_size": self.change_log_size,
+            "max_clock_offset": self.max_clock_offset,
+            "iblt_cells": self.iblt_cells,
+            "snapshot_path": self.snapshot_path,
+            "compression": self.compression,
+            "compression_level": self.compression_level,
+            "compress_assets": self.compress_assets
         }
 
         self.config_file = path.join(self.setup_dir, f'{self.node_name}config.json')